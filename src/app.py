@@ -1,23 +1,25 @@
 import os
 import sys
+import functools
 from models import run_cluster, run_classification, common
-from utils.logger_utils import logger, upload_log_to_s3
-from flask import Flask, render_template, request, redirect, url_for, send_file, flash, jsonify, session, Response
+from utils.logger_utils import logger, upload_log_to_s3, bind_log_context, reset_log_context
+from flask import Flask, render_template, request, redirect, url_for, send_file, flash, jsonify, session, Response, stream_with_context, g
 from werkzeug.utils import secure_filename
 import boto3
 from dotenv import load_dotenv
 from flask_swagger_ui import get_swaggerui_blueprint
-from pyspark import SparkConf, SparkContext
-from pyspark.sql import SparkSession
 import io
 import pandas as pd
 from fpdf import FPDF
 import pickle
 import torch
 from rag_index import create_vectorstore_from_s3
-from rag_qa import run_qa
+from rag_qa import run_qa, stream_qa
+from utils.upload_utils import stream_dataframe_to_s3, stream_fileobj_to_s3
+from utils.timing_utils import span, timed
 from utils.download_utils import load_model_from_s3, download_llm_model_from_s3, download_model_from_huggingface
-from lora_train import train_lora_from_user_data, get_finedtuned_model_path, run_train_thread
+from lora_train import train_lora_from_user_data, get_finedtuned_model_path, run_train_thread, read_training_key, dataset_version
+from training_scheduler import get_training_scheduler
 import threading
 import json
 from peft import PeftModel
@@ -26,7 +28,11 @@ import re
 # Load environment variables from .env file
 load_dotenv()
 
-download_model_from_huggingface()
+# Warm the base model cache; a Hub outage must not stop the worker from booting, the loaders retry on first use
+try:
+    download_model_from_huggingface()
+except Exception as e:
+    logger.error(f"Base model download failed at startup, retrying on first use: {e}")
 
 sys.path.append(os.path.abspath(os.path.dirname(__file__)))
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
@@ -39,23 +45,7 @@ app.secret_key = os.environ.get("FLASK_SECRET_KEY")
 if not app.secret_key:
     raise ValueError("FLASK_SECRET_KEY is not set! Set the environment variable before running the app.")
 
-# Setting the port that Spark UI uses
-# Memory usage limit (default 512MB -> 1GB)
-# Executor Memory Limit
-# Troubleshooting Network Timeout
-conf = SparkConf() \
-    .setAppName("DataPreprocessing") \
-    .setMaster("local[*]") \
-    .set("spark.driver.memory", "2g")  \
-    .set("spark.executor.memory", "2g") \
-    .set("spark.driver.maxResultSize", "1g") \
-    .set("spark.executor.heartbeatInterval", "30s") \
-    .set("spark.network.timeout", "120s") \
-
-if SparkContext._active_spark_context:
-    SparkContext._active_spark_context.stop()
-
-sc = SparkSession.builder.config(conf=conf).getOrCreate()
+# Spark is started on first use by models.common.get_spark(), with the same settings
 
 S3_REGION = "us-east-2"
 S3_BUCKET_NAME = "ml-platform-service"
@@ -83,6 +73,31 @@ current_filename = None
 
 device = "cpu"
 
+@app.before_request
+def bind_request_log_context():
+    # Records logged while handling this request go to the log of the file it works on
+    filename = (request.view_args or {}).get("filename") or session.get("filename")
+    if filename:
+        g.log_context_token = bind_log_context(filename)
+
+def ship_log_after(func):
+    '''
+    Ship the request's log once the route returns, after any span around it has logged its [TIMING] record
+    '''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            upload_log_to_s3()
+    return wrapper
+
+@app.teardown_request
+def reset_request_log_context(exc=None):
+    token = g.pop("log_context_token", None)
+    if token is not None:
+        reset_log_context(token)
+
 @app.route('/')
 def home():
     return render_template('index.html')
@@ -117,7 +132,11 @@ def upload_file():
         current_filename = filename
         print(f"[DEBUG] File name to upload: {filename}")
 
-        logger.log_filename = current_filename
+        # Replaces the session's binding (if any); teardown resets whichever token is stored last
+        previous_token = g.pop("log_context_token", None)
+        if previous_token is not None:
+            reset_log_context(previous_token)
+        g.log_context_token = bind_log_context(filename)
 
         # Use the existing function to upload the file directly to S3
         s3_file_path = f"uploaded/{file.filename}"
@@ -145,6 +164,7 @@ def delete_file_from_s3(bucket_name, file_key):
     print(f"File {file_key} deleted from S3 bucket {bucket_name}")
 
 @app.route('/process_clustering/<filename>', methods=['GET', 'POST'])
+@timed("clustering_request")
 def process_clustering(filename):
     try:
         s3_file_path = f"s3://{S3_BUCKET_NAME}/uploaded/{filename}"
@@ -160,16 +180,17 @@ def process_clustering(filename):
             threshold = float(threshold)
 
             # Implement main function and generate report and result file
-            pdf_file, csv_file = run_cluster(s3_file_path, threshold, algorithm, plot)
+            pdf_file, result_df = run_cluster(s3_file_path, threshold, algorithm, plot)
 
             files_to_upload = {
                 f"{filename}_report.pdf": pdf_file,
-                f"{filename}_results.csv": csv_file
+                f"{filename}_results.csv": result_df
             }
 
             # Upload the generated report and result file directly to S3
             print("\nUploading files to S3...\n")
-            upload_to_s3_direct(S3_BUCKET_NAME, files_to_upload)
+            with span("upload"):
+                upload_to_s3_direct(S3_BUCKET_NAME, files_to_upload)
 
             # Generate presigned URL
             pdf_url = generate_presigned_url(S3_BUCKET_NAME, f"result/{filename}_report.pdf")
@@ -211,13 +232,17 @@ def process_classification(filename):
         
         logger.debug("[DEBUG] Calling train_lora_from_user_data")
         print("[DEBUG] Calling train_lora_from_user_data")
-        threading.Thread(target=run_train_thread, args=(s3_file_path, filename, model_choice)).start()
+        # Bounded, deduplicated training in a separate process; the same content and model share one job
+        job_id = get_training_scheduler().submit(s3_file_path, filename, model_choice, dataset_version(s3_file_path))
+        session['training_job_id'] = job_id
         
         # After choose the model, move to loading page
         return render_template('loading.html', filename=filename, model_choice=model_choice)
     return render_template('select_model.html', filename=filename)
 
 @app.route('/start_classification/<filename>', methods=['POST'])
+@ship_log_after
+@timed("classification_request")
 def start_classification(filename):
     global progress_status
 
@@ -250,7 +275,8 @@ def start_classification(filename):
             # Generate vector DB
             print(f"Creating vector DB for: {s3_file_path}")
             logger.debug(f"Creating vector DB for: {s3_file_path}")
-            create_vectorstore_from_s3(s3_file_path)
+            with span("vector_index"):
+                create_vectorstore_from_s3(s3_file_path)
 
             # logger.debug("[DEBUG] Calling train_lora_from_user_data")
             # print("[DEBUG] Calling train_lora_from_user_data")
@@ -270,8 +296,8 @@ def start_classification(filename):
             pdf_filename: pdf_file
         }
 
-        upload_to_s3_direct(S3_BUCKET_NAME, files=files_to_uploads)
-        upload_log_to_s3()
+        with span("upload"):
+            upload_to_s3_direct(S3_BUCKET_NAME, files=files_to_uploads)
 
         # Generate Download URL
         model_url = generate_presigned_url(S3_BUCKET_NAME, f"result/{filename}_{model_choice}_model_and_info.zip")
@@ -377,16 +403,30 @@ def upload_to_s3_direct(bucket_name, files):
     '''
     # Iterate through the files and upload each one to S3
     for file_name, file_data in files.items():
+        s3_key = f'result/{file_name}'
+
+        try:
+            # Large results are streamed in fixed-size multipart parts instead of being copied into a new buffer
+            if isinstance(file_data, pd.DataFrame):     # For CSV
+                print(f"\nStreaming {file_name} to S3 as CSV...")
+                stream_dataframe_to_s3(file_data, s3, bucket_name, s3_key)
+                print(f"File {file_name} uploaded to S3 bucket {bucket_name}.")
+                continue
+
+            if isinstance(file_data, io.BytesIO):
+                print(f"\nStreaming {file_name} to S3...")
+                stream_fileobj_to_s3(file_data, s3, bucket_name, s3_key)
+                print(f"File {file_name} uploaded to S3 bucket {bucket_name}.")
+                continue
+
+        except Exception as e:
+            print(f"Error uploading {file_name} to S3: {e}")
+            continue
+
         file_buffer = io.BytesIO()
 
         # Handle different file types
-        if isinstance(file_data, io.BytesIO):
-            file_buffer = file_data
-            print(f"\nCOnvertin {file_name} to ...")
-        elif isinstance(file_data, pd.DataFrame):     # For CSV
-            print(f"\nCOnverting {file_name} to CSV format...")
-            file_data.to_csv(file_buffer, index=False)
-        elif isinstance(file_data, type(FPDF())):   # For PDF
+        if isinstance(file_data, type(FPDF())):   # For PDF
             print(f"\nGenerating PDF: {file_name}...\n")
             file_data.output(file_buffer)
         elif isinstance(file_data, str):    # For log or other text files
@@ -403,7 +443,7 @@ def upload_to_s3_direct(bucket_name, files):
         try:
             # Upload the file to S3
             print(f"Uploading {file_name} to S3...")
-            s3.upload_fileobj(file_buffer, bucket_name, f'result/{file_name}')
+            s3.upload_fileobj(file_buffer, bucket_name, s3_key)
             print(f"File {file_name} uploaded to S3 bucket {bucket_name}.")
         
         except Exception as e:
@@ -465,14 +505,34 @@ def check_lora_ready():
     model_choice = session.get("model_choice")
 
     model_path = get_finedtuned_model_path(filename, model_choice)
-    config_path = os.path.join(model_path, "config.json")
-    model_file = os.path.join(model_path, "model.safetensors")
+    config_path = os.path.join(model_path, "adapter_config.json")
+    model_file = os.path.join(model_path, "adapter_model.safetensors")
 
-    if os.path.isdir(model_path) and os.path.exists(config_path) and os.path.exists(model_file):
-        return jsonify({"ready": True})
-    else:
+    if not (os.path.isdir(model_path) and os.path.exists(config_path) and os.path.exists(model_file)):
         return jsonify({"ready": False})
 
+    # An adapter trained on an earlier upload of the same filename is not ready for this one:
+    # it must carry the training key recorded by this session's job
+    job_id = session.get("training_job_id")
+    job = get_training_scheduler().status(job_id) if job_id else None
+    if job is None:
+        job = get_training_scheduler().find(filename, model_choice)
+    up_to_date = job is not None and job.get("training_key") is not None \
+        and read_training_key(model_path) == job["training_key"]
+    return jsonify({"ready": up_to_date})
+
+@app.route('/training_status', methods=['GET'])
+def training_status():
+    job_id = request.args.get("job_id") or session.get("training_job_id")
+    status = get_training_scheduler().status(job_id) if job_id else None
+
+    if status is None:
+        status = get_training_scheduler().find(session.get("filename"), session.get("model_choice"))
+
+    if status is None:
+        return jsonify({"error": "No training job found."}), 404
+    return jsonify(status)
+
 @app.route('/ask', methods=['POST'])
 def ask_question():
 
@@ -547,6 +607,35 @@ def ask_question():
         "prediction": prediction
     })
 
+@app.route('/ask_stream', methods=['POST'])
+def ask_question_stream():
+    """Stream the RAG answer as Server-Sent Events while tokens are generated"""
+    data = request.json
+    question = data.get("question", "")
+    filename = session.get("filename")
+    model_choice = session.get("model_choice")
+    print(f"ask_question_stream: {data}")
+
+    def generate():
+        stop_event = threading.Event()
+        tokens = stream_qa(question, filename, model_choice, stop_event)
+        try:
+            for text in tokens:
+                yield f"data: {json.dumps({'token': text})}\n\n"
+            yield "event: done\ndata: {}\n\n"
+        except Exception as e:
+            yield f"event: error\ndata: {json.dumps({'error': f'RAG error: {str(e)}'})}\n\n"
+        finally:
+            # Runs on GeneratorExit when the client disconnects, which stops generation
+            stop_event.set()
+            tokens.close()
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 def extract_numbers_from_text(text):
     """Extract only numbers from natural language sentences"""
     return [float(n) for n in re.findall(r"[-+]?\d*\.\d+|\d+", text)]
@@ -0,0 +1,268 @@
+import os
+import time
+from concurrent.futures import Future
+from queue import Queue, Empty
+from threading import Thread, Lock
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList
+from transformers.generation.streamers import BaseStreamer
+from utils.logger_utils import logger
+from lora_serving import get_tokenizer, use_adapter
+
+GEN_BATCH_WINDOW_MS = float(os.getenv("GEN_BATCH_WINDOW_MS", "25"))
+GEN_MAX_BATCH_SIZE = int(os.getenv("GEN_MAX_BATCH_SIZE", "8"))
+GEN_MAX_NEW_TOKENS = 200
+# Seconds a caller waits for its completion (or for the next streamed piece) before giving up
+GEN_REQUEST_TIMEOUT = float(os.getenv("GEN_REQUEST_TIMEOUT", "120"))
+
+
+class GenerationRequest:
+    """
+    One prompt waiting for a batch; streaming requests also receive text pieces on self.pieces
+
+    Parameters
+    - stop_event: Set by a streaming caller that went away; the request is skipped or cut short
+    """
+    def __init__(self, adapter_name, prompt, max_new_tokens, stream=False, stop_event=None):
+        self.adapter_name = adapter_name
+        self.prompt = prompt
+        self.max_new_tokens = max_new_tokens
+        self.future = Future()
+        self.pieces = Queue() if stream else None
+        self.stop_event = stop_event
+
+    def stopped(self):
+        return self.stop_event is not None and self.stop_event.is_set()
+
+    def finish(self, output):
+        # The stream ends only once the result is set, so the caller never sees the end before the outcome
+        self.future.set_result(output)
+        if self.pieces is not None:
+            self.pieces.put(None)
+
+    def fail(self, error):
+        if not self.future.done():
+            self.future.set_exception(error)
+        if self.pieces is not None:
+            self.pieces.put(None)
+
+
+class BatchStreamer(BaseStreamer):
+    """
+    Splits the tokens of a batched generate() call by row and hands each streaming request its own text
+
+    Text is released up to the last space, as TextStreamer does, so words are not split mid-token.
+    """
+    def __init__(self, tokenizer, requests):
+        self.tokenizer = tokenizer
+        self.requests = requests
+        self.tokens = [[] for _ in requests]
+        self.sent = [0] * len(requests)
+        self.prompt_seen = False
+
+    def _decode(self, i):
+        request = self.requests[i]
+        return self.tokenizer.decode(self.tokens[i][:request.max_new_tokens], skip_special_tokens=True,
+                                     clean_up_tokenization_spaces=True)
+
+    def put(self, value):
+        # The first call carries the prompts, which are not part of the answer
+        if not self.prompt_seen:
+            self.prompt_seen = True
+            return
+        for i, request in enumerate(self.requests):
+            if request.pieces is None or request.stopped():
+                continue
+            self.tokens[i].extend(value[i].reshape(-1).tolist())
+            text = self._decode(i)
+            end = text.rfind(" ") + 1 if not text.endswith("\n") else len(text)
+            if end > self.sent[i]:
+                request.pieces.put(text[self.sent[i]:end])
+                self.sent[i] = end
+
+    def end(self):
+        for i, request in enumerate(self.requests):
+            if request.pieces is None:
+                continue
+            text = self._decode(i)
+            if len(text) > self.sent[i] and not request.stopped():
+                request.pieces.put(text[self.sent[i]:])
+                self.sent[i] = len(text)
+        # The end-of-stream sentinel is sent by GenerationRequest.finish/fail once the batch's outcome is known
+
+
+class StopWhenAllStopped(StoppingCriteria):
+    """
+    Ends a batch early once every request in it is a stream whose caller went away
+    """
+    def __init__(self, requests):
+        self.requests = requests
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return all(request.stopped() for request in self.requests)
+
+
+class GenerationScheduler:
+    """
+    Collects generation requests that arrive within a short window and runs them as one padded batch
+
+    Requests for the same LoRA adapter share a batch (set_adapter is model-wide); each
+    caller blocks on its own Future and gets back only its own completion, or iterates
+    over its own text pieces when streaming. If the worker thread dies, every pending
+    request fails and get_scheduler() starts a new scheduler.
+
+    Parameters
+    - window_ms: How long to wait for more requests after the first one arrives
+    - max_batch_size: Maximum number of prompts per generate() call
+    """
+    def __init__(self, window_ms=GEN_BATCH_WINDOW_MS, max_batch_size=GEN_MAX_BATCH_SIZE):
+        self.window = window_ms / 1000.0
+        self.max_batch_size = max_batch_size
+        self.queue = Queue()
+        self.batches = 0
+        self.requests = 0
+        self._pending = set()
+        self._pending_lock = Lock()
+        self._worker = Thread(target=self._run_forever, daemon=True, name="generation-scheduler")
+        self._worker.start()
+
+    def is_alive(self) -> bool:
+        return self._worker.is_alive()
+
+    def _enqueue(self, request):
+        with self._pending_lock:
+            if not self._worker.is_alive():
+                raise RuntimeError("Generation scheduler is not running")
+            self._pending.add(request)
+        self.queue.put(request)
+
+    def submit(self, adapter_name: str, prompt: str, max_new_tokens: int = GEN_MAX_NEW_TOKENS,
+               timeout: float = GEN_REQUEST_TIMEOUT) -> str:
+        request = GenerationRequest(adapter_name, prompt, max_new_tokens)
+        self._enqueue(request)
+        return request.future.result(timeout=timeout)
+
+    def stream(self, adapter_name: str, prompt: str, max_new_tokens: int = GEN_MAX_NEW_TOKENS,
+               stop_event=None, timeout: float = GEN_REQUEST_TIMEOUT):
+        """
+        Yield the completion of prompt piece by piece as its batch generates
+
+        Raises queue.Empty if no piece arrives within timeout, and the generation error if the batch fails.
+        """
+        request = GenerationRequest(adapter_name, prompt, max_new_tokens, stream=True, stop_event=stop_event)
+        self._enqueue(request)
+        while True:
+            piece = request.pieces.get(timeout=timeout)
+            if piece is None:
+                break
+            yield piece
+        # The sentinel follows set_result/set_exception, so this only surfaces a failed batch
+        request.future.result(timeout=0)
+
+    def _collect(self):
+        first = self.queue.get()
+        batch = [first]
+        deadline = time.monotonic() + self.window
+
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except Empty:
+                break
+        return batch
+
+    def _run_forever(self):
+        error = RuntimeError("Generation scheduler stopped")
+        try:
+            self._run()
+        except BaseException as e:
+            error = RuntimeError(f"Generation scheduler stopped: {e}")
+            logger.error(f"Generation scheduler worker died: {e}")
+            raise
+        finally:
+            # No one else will ever complete these requests, so fail them instead of leaving callers waiting
+            with self._pending_lock:
+                pending, self._pending = self._pending, set()
+            for request in pending:
+                request.fail(error)
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            # Streams whose caller went away while queued are not generated at all
+            cancelled = [request for request in batch if request.stopped()]
+            for request in cancelled:
+                request.fail(RuntimeError("Generation cancelled"))
+            with self._pending_lock:
+                self._pending.difference_update(cancelled)
+            batch = [request for request in batch if request not in cancelled]
+
+            groups = {}
+            for request in batch:
+                groups.setdefault(request.adapter_name, []).append(request)
+
+            for adapter_name, requests in groups.items():
+                try:
+                    outputs = self._generate(adapter_name, requests)
+                    for request, output in zip(requests, outputs):
+                        request.finish(output)
+                except Exception as e:
+                    logger.error(f"Batched generation failed for {adapter_name}: {e}")
+                    for request in requests:
+                        request.fail(e)
+                finally:
+                    with self._pending_lock:
+                        self._pending.difference_update(requests)
+
+    def _generate(self, adapter_name, requests):
+        tokenizer = get_tokenizer()
+        max_new_tokens = max(r.max_new_tokens for r in requests)
+
+        with use_adapter(adapter_name) as model:
+            # Left padding (set on the serving tokenizer) keeps every prompt's last token adjacent to its continuation
+            max_prompt_tokens = model.config.n_positions - max_new_tokens
+            encoded = tokenizer([r.prompt for r in requests], return_tensors="pt", padding=True,
+                                truncation=True, max_length=max_prompt_tokens)
+            streaming = any(r.pieces is not None for r in requests)
+
+            start = time.monotonic()
+            with torch.inference_mode():
+                generated = model.generate(
+                    **encoded,
+                    max_new_tokens=max_new_tokens,
+                    do_sample=True,
+                    temperature=0.7,
+                    top_p=0.95,
+                    use_cache=True,
+                    pad_token_id=tokenizer.pad_token_id,
+                    streamer=BatchStreamer(tokenizer, requests) if streaming else None,
+                    stopping_criteria=StoppingCriteriaList([StopWhenAllStopped(requests)]) if streaming else None
+                )
+
+        self.batches += 1
+        self.requests += len(requests)
+        logger.info(f"Generated batch of {len(requests)} for {adapter_name} in {time.monotonic() - start:.2f}s")
+
+        prompt_length = encoded["input_ids"].shape[1]
+        return [
+            tokenizer.decode(tokens[prompt_length:prompt_length + r.max_new_tokens], skip_special_tokens=True, clean_up_tokenization_spaces=True)
+            for r, tokens in zip(requests, generated)
+        ]
+
+
+_scheduler = None
+_scheduler_lock = Lock()
+
+
+def get_scheduler() -> GenerationScheduler:
+    """
+    One scheduler per process, since there is one shared base model
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None or not _scheduler.is_alive():
+            _scheduler = GenerationScheduler()
+        return _scheduler
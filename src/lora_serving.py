@@ -0,0 +1,246 @@
+import os
+import re
+import json
+from contextlib import contextmanager
+from threading import Lock, RLock
+import torch
+from torch import nn
+from transformers import AutoTokenizer, GPT2LMHeadModel, TextGenerationPipeline
+from transformers.pytorch_utils import Conv1D
+from peft import PeftModel
+from utils.logger_utils import logger
+from utils.download_utils import download_model_from_huggingface
+
+BASE_MODEL_DIR = "/tmp/distilgpt2"
+HF_CACHE = "/tmp/hf_cache"
+
+# "auto" serves each adapter in the precision its post-training parity check accepted
+INFERENCE_PRECISION = os.getenv("INFERENCE_PRECISION", "auto")
+INFERENCE_CONFIG_FILE = "inference.json"
+# Projections that are int8-quantized; c_attn is left alone because the LoRA adapters wrap it
+QUANTIZED_MODULES = ("attn.c_proj", "mlp.c_fc", "mlp.c_proj", "lm_head")
+
+# One base model per precision in use; LoRA adapters are attached to it by name
+_peft_models = {}
+_adapter_precision = {}
+_tokenizer = None
+_llm_pipelines = {}
+_load_lock = Lock()
+# Requests holding each adapter (queued or generating); an evicted adapter is deleted when its count drops to 0
+_adapter_users = {}
+_pending_unload = set()
+
+# set_adapter() changes the whole model, so generation holds this lock for its duration
+generation_lock = RLock()
+
+
+def adapter_name_for(key: str) -> str:
+    """
+    Adapter names become module keys, so keep them to word characters
+    """
+    return re.sub(r"\W", "_", key)
+
+
+def get_tokenizer():
+    global _tokenizer
+    with _load_lock:
+        if _tokenizer is None:
+            download_model_from_huggingface()
+            _tokenizer = AutoTokenizer.from_pretrained(BASE_MODEL_DIR, cache_dir=HF_CACHE, use_fast=False, local_files_only=True, add_prefix_space=True)
+            if _tokenizer.pad_token is None:
+                _tokenizer.pad_token = _tokenizer.eos_token
+            # Batched generation pads on the left; over-long prompts keep their end (the question)
+            _tokenizer.padding_side = "left"
+            _tokenizer.truncation_side = "left"
+        return _tokenizer
+
+
+def cpu_supports_bf16() -> bool:
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except Exception:
+        return False
+
+
+def conv1d_to_linear(conv: Conv1D) -> nn.Linear:
+    # Conv1D computes x @ W + b with W of shape (in, out); nn.Linear stores the transpose
+    linear = nn.Linear(conv.weight.shape[0], conv.nf)
+    linear.weight = nn.Parameter(conv.weight.detach().t().contiguous())
+    linear.bias = nn.Parameter(conv.bias.detach().clone())
+    return linear
+
+
+def apply_inference_precision(model, precision: str):
+    """
+    Prepare a GPT-2 model, with or without LoRA layers, for CPU inference in the given precision
+
+    Parameters
+    - model: GPT2LMHeadModel or a PeftModel wrapping one
+    - precision: "float32", "int8" (dynamic quantization of QUANTIZED_MODULES) or "bf16"
+    """
+    if precision == "bf16":
+        return model.to(torch.bfloat16)
+    if precision != "int8":
+        return model
+
+    names = set()
+    for name, module in list(model.named_modules()):
+        if not name.endswith(QUANTIZED_MODULES):
+            continue
+        # GPT-2 projections are Conv1D, which quantize_dynamic does not handle
+        if isinstance(module, Conv1D):
+            parent_name, _, child_name = name.rpartition(".")
+            setattr(model.get_submodule(parent_name), child_name, conv1d_to_linear(module))
+            names.add(name)
+        elif isinstance(module, nn.Linear):
+            names.add(name)
+
+    return torch.ao.quantization.quantize_dynamic(model, qconfig_spec=names, dtype=torch.qint8, inplace=True)
+
+
+def read_inference_precision(adapter_path: str) -> str:
+    """
+    Precision to serve an adapter in: INFERENCE_PRECISION, or in "auto" mode the one recorded at training time
+    """
+    precision = INFERENCE_PRECISION
+    if precision == "auto":
+        try:
+            with open(os.path.join(adapter_path, INFERENCE_CONFIG_FILE)) as f:
+                precision = json.load(f).get("precision", "float32")
+        except (OSError, ValueError):
+            precision = "float32"
+
+    if precision == "bf16" and not cpu_supports_bf16():
+        logger.info("CPU has no native bf16 support; serving in float32")
+        precision = "float32"
+    return precision
+
+
+def get_llm_pipeline(adapter_name: str):
+    """
+    Text-generation pipeline over the shared base model the adapter is attached to
+    """
+    tokenizer = get_tokenizer()
+    with _load_lock:
+        precision = _adapter_precision.get(adapter_name)
+        if precision is None:
+            raise ValueError(f"LoRA adapter {adapter_name} has not been loaded yet.")
+        if precision not in _llm_pipelines:
+            # LoRA layers are injected into the base model, so generating through it uses the active adapter
+            _llm_pipelines[precision] = TextGenerationPipeline(
+                model=_peft_models[precision].base_model.model,
+                tokenizer=tokenizer,
+                max_new_tokens=200,
+                do_sample=True,
+                temperature=0.7,
+                top_p=0.95,
+                clean_up_tokenization_spaces=True,
+                return_full_text=False
+            )
+        return _llm_pipelines[precision]
+
+
+def load_adapter(adapter_name: str, adapter_path: str):
+    """
+    Attach a saved LoRA adapter to the shared base model for its precision, loading that base model on first use
+    """
+    if not os.path.exists(os.path.join(adapter_path, "adapter_config.json")):
+        raise ValueError(f"No LoRA adapter found at {adapter_path}.")
+
+    precision = read_inference_precision(adapter_path)
+
+    with generation_lock, _load_lock:
+        peft_model = _peft_models.get(precision)
+        if peft_model is None:
+            download_model_from_huggingface()
+            logger.info(f"Loading shared base model from {BASE_MODEL_DIR} ({precision})")
+            base_model = GPT2LMHeadModel.from_pretrained(
+                BASE_MODEL_DIR,
+                cache_dir=HF_CACHE,
+                local_files_only=True,
+                use_safetensors=True
+            ).to("cpu")
+            base_model = apply_inference_precision(base_model, precision)
+            peft_model = PeftModel.from_pretrained(base_model, adapter_path, adapter_name=adapter_name, is_trainable=False)
+            peft_model.eval()
+            _peft_models[precision] = peft_model
+        elif adapter_name not in peft_model.peft_config:
+            peft_model.load_adapter(adapter_path, adapter_name=adapter_name, is_trainable=False)
+        # Loaded again before its deferred unload ran
+        _pending_unload.discard(adapter_name)
+
+        if precision == "bf16":
+            # Adapter weights load in float32
+            peft_model.to(torch.bfloat16)
+
+        _adapter_precision[adapter_name] = precision
+        logger.info(f"LoRA adapter ready: {adapter_name} ({precision})")
+        return adapter_size_bytes(adapter_name)
+
+
+def adapter_size_bytes(adapter_name: str) -> int:
+    peft_model = _peft_models.get(_adapter_precision.get(adapter_name))
+    if peft_model is None:
+        return 0
+    return sum(p.numel() * p.element_size() for n, p in peft_model.named_parameters() if f".{adapter_name}." in n)
+
+
+def _delete_adapter(adapter_name: str):
+    # Callers hold generation_lock and _load_lock
+    _pending_unload.discard(adapter_name)
+    peft_model = _peft_models.get(_adapter_precision.get(adapter_name))
+    if peft_model is None or adapter_name not in peft_model.peft_config:
+        return
+    # Keep at least one adapter attached so the shared model always has an active adapter
+    if len(peft_model.peft_config) > 1:
+        peft_model.delete_adapter(adapter_name)
+        _adapter_precision.pop(adapter_name, None)
+        logger.info(f"LoRA adapter unloaded: {adapter_name}")
+
+
+def unload_adapter(adapter_name: str):
+    """
+    Remove an adapter's weights from the shared model, once no request holds it any more
+    """
+    with generation_lock, _load_lock:
+        if _adapter_users.get(adapter_name, 0) > 0:
+            _pending_unload.add(adapter_name)
+            logger.info(f"LoRA adapter unload deferred until {_adapter_users[adapter_name]} request(s) finish: {adapter_name}")
+            return
+        _delete_adapter(adapter_name)
+
+
+def hold_adapter(adapter_name: str) -> bool:
+    """
+    Keep an adapter attached until release_adapter() is called
+
+    Returns
+    - False if the adapter has already been unloaded (the caller should load it again)
+    """
+    with _load_lock:
+        if adapter_name not in _adapter_precision:
+            return False
+        _adapter_users[adapter_name] = _adapter_users.get(adapter_name, 0) + 1
+        return True
+
+
+def release_adapter(adapter_name: str):
+    with generation_lock, _load_lock:
+        users = _adapter_users.get(adapter_name, 0) - 1
+        if users > 0:
+            _adapter_users[adapter_name] = users
+            return
+        _adapter_users.pop(adapter_name, None)
+        if adapter_name in _pending_unload:
+            _delete_adapter(adapter_name)
+
+
+@contextmanager
+def use_adapter(adapter_name: str):
+    """
+    Activate an adapter for the duration of one generation
+    """
+    with generation_lock:
+        peft_model = _peft_models[_adapter_precision[adapter_name]]
+        peft_model.set_adapter(adapter_name)
+        yield peft_model.base_model.model
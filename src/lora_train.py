@@ -1,12 +1,23 @@
-from transformers import AutoTokenizer, AutoModelForCausalLM, GPT2LMHeadModel
-from peft import LoraConfig, get_peft_model
+from transformers import AutoTokenizer, AutoModelForCausalLM, GPT2LMHeadModel, DataCollatorForLanguageModeling
+from peft import LoraConfig, get_peft_model, get_peft_model_state_dict, set_peft_model_state_dict
 import torch
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler
 import os
 import json
 import boto3
-from utils.logger_utils import logger
+from botocore.exceptions import ClientError
+from utils.logger_utils import logger, job_log_context, upload_log_to_s3, shutdown_logging
+from utils.timing_utils import span, record_span
 from models.common import load_file
+from models.classification_models import preprocess
+from utils.text_utils import format_rows
+from utils.hash_utils import hash_dataframe
+from utils.download_utils import fetch_s3_artifacts, directory_lock, publish_directory, download_model_from_huggingface
+from lora_serving import apply_inference_precision, cpu_supports_bf16, INFERENCE_CONFIG_FILE
+import pandas as pd
+import hashlib
+import copy
+import math
 import shutil
 import time
 from pathlib import Path
@@ -14,26 +25,413 @@ from pathlib import Path
 device = torch.device("cpu")
 
 
+# Prompts are padded per batch, so the batch size no longer multiplies padding cost
+LORA_BATCH_SIZE = int(os.getenv("LORA_BATCH_SIZE", "8"))
+LORA_GRAD_ACCUM = int(os.getenv("LORA_GRAD_ACCUM", "1"))
+LORA_MAX_LENGTH = int(os.getenv("LORA_MAX_LENGTH", "512"))
+# Per-step loss is logged only every LORA_LOG_EVERY batches
+LORA_LOG_EVERY = int(os.getenv("LORA_LOG_EVERY", "50"))
+
+# Training budget and early stopping
+LORA_MAX_SECONDS = float(os.getenv("LORA_MAX_SECONDS", "1800"))
+LORA_TOKEN_BUDGET = int(os.getenv("LORA_TOKEN_BUDGET", "2000000"))
+LORA_EVAL_EVERY = int(os.getenv("LORA_EVAL_EVERY", "20"))
+LORA_PATIENCE = int(os.getenv("LORA_PATIENCE", "3"))
+LORA_MIN_DELTA = float(os.getenv("LORA_MIN_DELTA", "0.01"))
+LORA_VAL_FRACTION = float(os.getenv("LORA_VAL_FRACTION", "0.1"))
+
+# Optimizer and schedule; (prompt count below, epochs) pairs, the last one applies to everything larger
+# The base rate was tuned with one prompt per optimizer step. Larger effective batches take proportionally
+# fewer steps per epoch, so the rate is scaled by sqrt(effective batch), the usual rule for Adam; the
+# StepLR decay counts epochs, so it already follows passes over the data rather than steps
+LORA_EFFECTIVE_BATCH_SIZE = LORA_BATCH_SIZE * LORA_GRAD_ACCUM
+LORA_BASE_LEARNING_RATE = 5e-5
+LORA_LEARNING_RATE = float(os.getenv("LORA_LEARNING_RATE", str(LORA_BASE_LEARNING_RATE * math.sqrt(LORA_EFFECTIVE_BATCH_SIZE))))
+LORA_WEIGHT_DECAY = 0.01
+LORA_LR_STEP_EPOCHS = 5
+LORA_LR_GAMMA = 0.8
+LORA_EPOCHS_BY_PROMPTS = ((50, 15), (200, 13), (None, 10))
+
+# Reduced-precision serving variants tried after training, in order; the first within tolerance is used
+INFERENCE_CANDIDATES = [p for p in os.getenv("INFERENCE_CANDIDATES", "int8,bf16").split(",") if p]
+INFERENCE_PPL_TOLERANCE = float(os.getenv("INFERENCE_PPL_TOLERANCE", "0.02"))
+
+# Prompt selection: at most LORA_PROMPT_BUDGET deduplicated, stratified rows become prompts
+LORA_PROMPT_BUDGET = int(os.getenv("LORA_PROMPT_BUDGET", "2000"))
+LORA_DEDUPE_DECIMALS = int(os.getenv("LORA_DEDUPE_DECIMALS", "2"))
+
+# Trained adapters are cached by training key (dataset content, base model, LoRA config, prompt template)
+BASE_MODEL_DIR = "/tmp/distilgpt2"
+BASE_MODEL_NAME = "distilgpt2"
+LORA_CONFIG = dict(r=8, lora_alpha=32, lora_dropout=0.1, bias="none", task_type="CAUSAL_LM")
+# Bump when format_rows or the prompt selection changes what a prompt looks like
+PROMPT_TEMPLATE_VERSION = "column_value_lines_v1"
+ADAPTER_CACHE_DIR = os.getenv("ADAPTER_CACHE_DIR", "/tmp/lora_adapter_cache")
+S3_ADAPTER_PREFIX = "models/lora_adapters"
+TRAINING_KEY_FILE = "training_key.json"
+ADAPTER_FILES = ("adapter_config.json", "adapter_model.safetensors")
+# Written last by upload_adapter; an S3 adapter without it is a partial upload and is not used
+ADAPTER_COMPLETE_FILE = "upload_complete.json"
+
+
 class PromptDataset(Dataset):
-    def __init__(self, prompts, tokenizer):
-        self.encodings = tokenizer(prompts, truncation=True, padding=True, return_tensors="pt")
-        self.labels = self.encodings["input_ids"].clone()
-        self.encodings["labels"] = self.labels
+    def __init__(self, prompts, tokenizer, max_length=LORA_MAX_LENGTH):
+        # Tokenize without padding; the collator pads each batch to its own longest prompt
+        self.encodings = tokenizer(prompts, truncation=True, max_length=max_length)["input_ids"]
+        self.lengths = [len(ids) for ids in self.encodings]
     
     def __getitem__(self, idx):
-        return {key: val[idx] for key, val in self.encodings.items()}
+        return {"input_ids": self.encodings[idx]}
     
     def __len__(self):
-        return len(self.labels)
+        return len(self.encodings)
+
+class LengthBucketSampler(Sampler):
+    """
+    Yields batches of indices whose prompts have similar lengths
+
+    Indices are shuffled, split into pools of batch_size * pool_batches, sorted by length
+    inside each pool and cut into batches; the batch order is shuffled again so training
+    still sees a random mix of lengths across steps.
+    """
+    def __init__(self, lengths, batch_size, pool_batches=50, seed=42):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.pool_size = batch_size * pool_batches
+        self.generator = torch.Generator().manual_seed(seed)
+
+    def __iter__(self):
+        indices = torch.randperm(len(self.lengths), generator=self.generator).tolist()
+        batches = []
+        for start in range(0, len(indices), self.pool_size):
+            pool = sorted(indices[start:start + self.pool_size], key=lambda i: self.lengths[i])
+            batches.extend(pool[i:i + self.batch_size] for i in range(0, len(pool), self.batch_size))
+
+        for i in torch.randperm(len(batches), generator=self.generator).tolist():
+            yield batches[i]
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+class TrainingController:
+    """
+    Bounds a LoRA training run by wall-clock time and token budget and stops early on a plateau
+
+    The held-out loss is evaluated every eval_every optimizer steps; the adapter weights with the
+    best held-out loss are kept in memory and restored before saving.
+
+    Parameters
+    - max_seconds: Wall-clock limit for the training loop
+    - token_budget: Maximum number of (non-padding) training tokens
+    - eval_every: Optimizer steps between held-out evaluations
+    - patience: Evaluations without improvement before stopping
+    - min_delta: Minimum decrease in held-out loss that counts as an improvement
+    """
+    def __init__(self, max_seconds=LORA_MAX_SECONDS, token_budget=LORA_TOKEN_BUDGET, eval_every=LORA_EVAL_EVERY,
+                 patience=LORA_PATIENCE, min_delta=LORA_MIN_DELTA):
+        self.max_seconds = max_seconds
+        self.token_budget = token_budget
+        self.eval_every = eval_every
+        self.patience = patience
+        self.min_delta = min_delta
+
+        self.start_time = time.monotonic()
+        self.tokens = 0
+        self.optimizer_steps = 0
+        self.best_loss = float("inf")
+        self.best_state = None
+        self.bad_evals = 0
+        self.stop_reason = None
+
+    def elapsed(self):
+        return time.monotonic() - self.start_time
+
+    def tokens_per_second(self):
+        return self.tokens / max(self.elapsed(), 1e-9)
+
+    def record_batch(self, batch):
+        self.tokens += int(batch["attention_mask"].sum().item())
+
+    def record_optimizer_step(self):
+        self.optimizer_steps += 1
+        return self.optimizer_steps % self.eval_every == 0
+
+    def update(self, val_loss, model):
+        logger.info(f"Held-out loss {val_loss:.4f} at step {self.optimizer_steps} | {self.tokens} tokens | {self.tokens_per_second():.1f} tokens/s")
+
+        if val_loss < self.best_loss - self.min_delta:
+            self.best_loss = val_loss
+            self.best_state = {k: v.detach().clone() for k, v in get_peft_model_state_dict(model).items()}
+            self.bad_evals = 0
+        else:
+            self.bad_evals += 1
+            if self.bad_evals >= self.patience:
+                self.stop_reason = f"held-out loss plateaued for {self.bad_evals} evaluations"
+
+    def should_stop(self):
+        if self.stop_reason is None:
+            if self.elapsed() >= self.max_seconds:
+                self.stop_reason = f"time limit of {self.max_seconds}s reached"
+            elif self.tokens >= self.token_budget:
+                self.stop_reason = f"token budget of {self.token_budget} reached"
+        return self.stop_reason is not None
+
+    def restore_best(self, model):
+        if self.best_state is not None:
+            set_peft_model_state_dict(model, self.best_state)
+            logger.info(f"Restored best adapter (held-out loss {self.best_loss:.4f})")
+
+def evaluate_loss(model, dataloader):
+    if dataloader is None:
+        return None
+
+    model.eval()
+    total_loss, batches = 0.0, 0
+    with torch.no_grad():
+        for batch in dataloader:
+            batch = {k: v.to(device) for k, v in batch.items()}
+            total_loss += model(**batch).loss.item()
+            batches += 1
+    model.train()
+
+    return total_loss / max(batches, 1)
+
+def choose_inference_precision(model, dataloader):
+    """
+    Pick the serving precision for a trained adapter with a perplexity parity check
+
+    Each candidate is applied to a copy of the trained model and accepted if its perplexity on
+    dataloader is within INFERENCE_PPL_TOLERANCE (relative) of the float32 model.
+
+    Returns
+    - dict with the chosen "precision" and the measured "perplexity" and "seconds" per precision
+    """
+    start = time.monotonic()
+    baseline = math.exp(evaluate_loss(model, dataloader))
+    result = {"precision": "float32", "perplexity": {"float32": baseline}, "seconds": {"float32": time.monotonic() - start}}
+
+    for precision in INFERENCE_CANDIDATES:
+        if precision == "bf16" and not cpu_supports_bf16():
+            logger.info("Skipping bf16 inference variant: no native bf16 support on this CPU")
+            continue
+
+        variant = apply_inference_precision(copy.deepcopy(model), precision)
+        start = time.monotonic()
+        perplexity = math.exp(evaluate_loss(variant, dataloader))
+        result["perplexity"][precision] = perplexity
+        result["seconds"][precision] = time.monotonic() - start
+        del variant
+
+        accepted = perplexity <= baseline * (1 + INFERENCE_PPL_TOLERANCE)
+        logger.info(f"Inference variant {precision}: perplexity {perplexity:.3f} vs {baseline:.3f} (float32), "
+                    f"{result['seconds'][precision]:.2f}s vs {result['seconds']['float32']:.2f}s -> {'accepted' if accepted else 'rejected'}")
+        if accepted:
+            result["precision"] = precision
+            break
+
+    return result
+
+def dedupe_rows(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Drop near-identical rows: numbers rounded and text normalized before hashing
+    """
+    normalized = pd.DataFrame(index=df.index)
+    for col in df.columns:
+        if pd.api.types.is_numeric_dtype(df[col]):
+            normalized[col] = df[col].round(LORA_DEDUPE_DECIMALS)
+        else:
+            normalized[col] = df[col].astype(str).str.strip().str.lower()
+
+    row_hashes = pd.util.hash_pandas_object(normalized, index=False)
+    return df[~row_hashes.duplicated()]
+
+def strata_column(df: pd.DataFrame):
+    """
+    Column to stratify the prompt sample by: a cluster label if present, else the detected target
+    """
+    cluster_cols = [c for c in df.columns if str(c).endswith("Cluster")]
+    if cluster_cols:
+        return df[cluster_cols[0]]
+
+    try:
+        target = preprocess.find_target_column(df)
+    except Exception:
+        target = None
+    if isinstance(target, list):
+        target = target[0] if target else None
+    if target is None or target not in df.columns:
+        return None
+
+    strata = df[target]
+    # Continuous targets are stratified by quantile bins
+    if pd.api.types.is_numeric_dtype(strata) and strata.nunique() > 20:
+        strata = pd.qcut(strata, q=10, duplicates="drop")
+    return strata
+
+def sample_rows(df: pd.DataFrame, budget: int) -> pd.DataFrame:
+    """
+    Representative sample of at most budget rows, stratified when a strata column exists
+    """
+    if len(df) <= budget:
+        return df
+
+    strata = strata_column(df)
+    if strata is None or strata.nunique() > budget:
+        return df.sample(n=budget, random_state=42)
+
+    # Proportional allocation with at least one row per stratum
+    frac = budget / len(df)
+    sampled = df.groupby(strata.astype(str), group_keys=False, observed=True).apply(
+        lambda g: g.sample(n=max(1, int(round(len(g) * frac))), random_state=42)
+    )
+    if len(sampled) > budget:
+        sampled = sampled.sample(n=budget, random_state=42)
+    return sampled
+
+def load_prompt_frame(s3_key: str, budget: int = LORA_PROMPT_BUDGET) -> pd.DataFrame:
+    df, mode = load_file(s3_key)
+    if mode == "spark":
+        # Only a bounded sample of a Spark-sized file is brought to the driver
+        fraction = min(1.0, (budget * 4) / max(df.count(), 1))
+        df = df.sample(fraction=fraction, seed=42).toPandas()
 
-def get_prompts_from_s3_dataset(s3_key: str) -> list[str]:
-    df, _ = load_file(s3_key)
-    prompts = []
     IGNORE_COLUMNS = ["ID", "Timestamp"]
-    for _, row in df.iterrows():
-        text = "\n".join([f"{col}: {row[col]}" for col in df.columns if col not in IGNORE_COLUMNS])
-        prompts.append(text)
-    return prompts
+    return df[[col for col in df.columns if col not in IGNORE_COLUMNS]]
+
+def build_prompts(df: pd.DataFrame, budget: int = LORA_PROMPT_BUDGET) -> list[str]:
+    total_rows = len(df)
+    df = dedupe_rows(df)
+    deduped_rows = len(df)
+    df = sample_rows(df, budget)
+    logger.info(f"Prompt selection: {total_rows} rows -> {deduped_rows} after dedupe -> {len(df)} prompts (budget {budget})")
+
+    return format_rows(df).tolist()
+
+def get_prompts_from_s3_dataset(s3_key: str, budget: int = LORA_PROMPT_BUDGET) -> list[str]:
+    return build_prompts(load_prompt_frame(s3_key, budget), budget)
+
+def compute_training_key(df: pd.DataFrame, budget: int = LORA_PROMPT_BUDGET) -> str:
+    """
+    Content address of a training run: the same data and settings always give the same adapter key
+    """
+    settings = {
+        "dataset": hash_dataframe(df),
+        "base_model": BASE_MODEL_NAME,
+        "lora_config": LORA_CONFIG,
+        "prompt_template": PROMPT_TEMPLATE_VERSION,
+        "prompt_budget": budget,
+        "dedupe_decimals": LORA_DEDUPE_DECIMALS,
+        "max_length": LORA_MAX_LENGTH,
+        # Everything that changes the trained weights or the chosen serving precision
+        "training": {
+            "batch_size": LORA_BATCH_SIZE,
+            "grad_accum": LORA_GRAD_ACCUM,
+            "learning_rate": LORA_LEARNING_RATE,
+            "weight_decay": LORA_WEIGHT_DECAY,
+            "lr_step_epochs": LORA_LR_STEP_EPOCHS,
+            "lr_gamma": LORA_LR_GAMMA,
+            "epochs": LORA_EPOCHS_BY_PROMPTS,
+            "max_seconds": LORA_MAX_SECONDS,
+            "token_budget": LORA_TOKEN_BUDGET,
+            "eval_every": LORA_EVAL_EVERY,
+            "patience": LORA_PATIENCE,
+            "min_delta": LORA_MIN_DELTA,
+            "val_fraction": LORA_VAL_FRACTION,
+        },
+        "inference": {
+            "candidates": INFERENCE_CANDIDATES,
+            "ppl_tolerance": INFERENCE_PPL_TOLERANCE,
+        },
+    }
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()
+
+def dataset_version(s3_key: str) -> str:
+    """
+    S3 ETag of an uploaded dataset; a re-upload with different content gets a new one
+    """
+    s3 = boto3.client('s3', region_name=os.getenv("AWS_REGION"), config=boto3.session.Config(signature_version='s3v4'))
+    return s3.head_object(Bucket=os.getenv("S3_BUCKET_NAME"), Key=s3_key)["ETag"].strip('"')
+
+def has_adapter_files(path: str) -> bool:
+    return all(os.path.exists(os.path.join(path, name)) for name in ADAPTER_FILES)
+
+def read_training_key(path: str):
+    """
+    Training key of the adapter published at path, or None if there is none
+    """
+    try:
+        with open(os.path.join(path, TRAINING_KEY_FILE)) as f:
+            return json.load(f).get("training_key")
+    except (OSError, ValueError):
+        return None
+
+def fetch_cached_adapter(s3, training_key: str) -> bool:
+    """
+    Make the adapter for training_key available in ADAPTER_CACHE_DIR, downloading it from S3 if needed
+
+    Returns
+    - True if the adapter is available locally, False if it has never been trained
+    """
+    cache_path = os.path.join(ADAPTER_CACHE_DIR, training_key)
+    if has_adapter_files(cache_path):
+        logger.info(f"LoRA adapter cache hit (local): {training_key}")
+        return True
+
+    bucket = os.getenv("S3_BUCKET_NAME")
+    prefix = f"{S3_ADAPTER_PREFIX}/{training_key}"
+    try:
+        s3.head_object(Bucket=bucket, Key=f"{prefix}/{ADAPTER_COMPLETE_FILE}")
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            # Never trained, or the upload was interrupted; training again overwrites it
+            return False
+        raise
+
+    try:
+        fetch_s3_artifacts(s3, bucket, f"{prefix}/", cache_path)
+    except FileNotFoundError:
+        return False
+    if not has_adapter_files(cache_path):
+        return False
+
+    logger.info(f"LoRA adapter cache hit (S3): {training_key}")
+    return True
+
+def upload_adapter(s3, local_dir: str, s3_prefix: str):
+    """
+    Upload an adapter directory, then ADAPTER_COMPLETE_FILE listing every file and its size
+    """
+    uploaded = {}
+    for root, _, files in os.walk(local_dir):
+        for file in sorted(files):
+            local_path = os.path.join(root, file)
+            name = os.path.relpath(local_path, local_dir)
+            if name == ADAPTER_COMPLETE_FILE:
+                continue
+            s3.upload_file(local_path, os.getenv("S3_BUCKET_NAME"), f"{s3_prefix}/{name}")
+            uploaded[name] = os.path.getsize(local_path)
+
+    s3.put_object(Bucket=os.getenv("S3_BUCKET_NAME"), Key=f"{s3_prefix}/{ADAPTER_COMPLETE_FILE}",
+                  Body=json.dumps({"files": uploaded}).encode("utf-8"))
+
+def publish_adapter(training_key: str, save_path: str):
+    """
+    Copy a cached adapter to the per-file serving path and record which training key it came from
+    """
+    if read_training_key(save_path) == training_key and has_adapter_files(save_path):
+        return
+
+    tmp_path = f"{save_path}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    shutil.copytree(os.path.join(ADAPTER_CACHE_DIR, training_key), tmp_path)
+    with open(os.path.join(tmp_path, TRAINING_KEY_FILE), "w") as f:
+        json.dump({"training_key": training_key}, f)
+
+    # A stale adapter from an older version of the same file is replaced, never reused;
+    # the old directory is moved aside before the swap, so readers never see a half-written one
+    with directory_lock(save_path):
+        publish_directory(tmp_path, save_path)
+    logger.info(f"Published LoRA adapter {training_key} to {save_path}")
 
 def sanitize_model_name(name: str) -> str:
     return name.strip().lower().replace(" ", "_")
@@ -51,9 +449,7 @@ def train_lora_from_user_data(s3_dataset_key: str, filename: str, selected_model
     try:
         SAVE_PATH = get_finedtuned_model_path(filename, selected_model)
         HF_CACHE = "/tmp/hf_cache"
-        BASE_MODEL_DIR = "/tmp/distilgpt2"
         logger.debug(f"[DEBUG] BASE_MODEL_DIR = {BASE_MODEL_DIR}")
-        logger.debug(f"[DEBUG] BASE_MODEL_DIR contents = {os.listdir(BASE_MODEL_DIR)}")
         
         safe_model = sanitize_model_name(selected_model)
         filename_no_ext = os.path.splitext(os.path.basename(filename))[0]
@@ -61,8 +457,24 @@ def train_lora_from_user_data(s3_dataset_key: str, filename: str, selected_model
         s3_model_path = f"models/lora_finetuned_model/{model_folder_name}"
         logger.info(f"train_lora_from: {selected_model}")
 
+        s3 = boto3.client('s3', region_name=os.getenv("AWS_REGION"), config=boto3.session.Config(signature_version='s3v4'))
+
+        # ✅ Step 0: Reuse an adapter already trained on the same content with the same settings
+        with span("load_prompts") as load_span:
+            prompt_df = load_prompt_frame(s3_dataset_key)
+            training_key = compute_training_key(prompt_df)
+            load_span.rows = len(prompt_df)
+        logger.info(f"Training key for {filename}: {training_key}")
 
-        # ✅ Step 1: Load tokenizer and base model from pre-downloaded path
+        with span("adapter_cache_lookup"):
+            cache_hit = fetch_cached_adapter(s3, training_key)
+        if cache_hit:
+            publish_adapter(training_key, SAVE_PATH)
+            logger.info(f"Skipping training for {filename}: adapter {training_key} already exists")
+            return training_key
+
+        # ✅ Step 1: Load tokenizer and base model from pre-downloaded path (fetched now if startup could not)
+        download_model_from_huggingface()
         try:
             logger.debug("[DEBUG] Trying to load tokenizer...")
             tokenizer = AutoTokenizer.from_pretrained(BASE_MODEL_DIR, cache_dir=HF_CACHE, use_fast=False, local_files_only=True)
@@ -74,7 +486,7 @@ def train_lora_from_user_data(s3_dataset_key: str, filename: str, selected_model
             logger.debug("✅ Tokenizer loaded successfully")
         except Exception as e:
             logger.error(f"[ERROR] Failed to load tokenizer: {e}")
-            return
+            raise
         try:
             logger.debug("[DEBUG] Trying to load base model...")
             torch_dtype = torch.bfloat16 if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else torch.float32
@@ -89,24 +501,18 @@ def train_lora_from_user_data(s3_dataset_key: str, filename: str, selected_model
             logger.debug("✅ Base model loaded successfully")
         except Exception as e:
             logger.error(f"[ERROR] Failed to load base model: {e}")
-            return
+            raise
         logger.debug("Loaded tokenizer successfully")
 
         # ✅ Step 2: Apply LoRA
-        lora_config = LoraConfig(
-            r=8,
-            lora_alpha=32,
-            lora_dropout=0.1,
-            bias="none",
-            task_type="CAUSAL_LM"
-            )
+        lora_config = LoraConfig(**LORA_CONFIG)
         model = get_peft_model(base_model, lora_config)
         logger.info("Applied lora_config")
         logger.info(f"✅ LoRA Model object: {model}")
         logger.info(f"✅ Using device: {device}")
 
         # ✅ Step 3: Prepare Data
-        prompts = get_prompts_from_s3_dataset(s3_dataset_key)
+        prompts = build_prompts(prompt_df)
 
         if len(prompts) < 10:
             prompts *= (10 // len(prompts)) + 1
@@ -114,109 +520,121 @@ def train_lora_from_user_data(s3_dataset_key: str, filename: str, selected_model
 
         prompt_count = len(prompts)
 
-        if prompt_count < 50:
-            num_epochs = 15
-        elif prompt_count < 200:
-            num_epochs = 13
-        else:
-            num_epochs = 10
+        num_epochs = next(epochs for limit, epochs in LORA_EPOCHS_BY_PROMPTS if limit is None or prompt_count < limit)
+
+        # Fixed held-out split for early stopping
+        split_generator = torch.Generator().manual_seed(42)
+        order = torch.randperm(prompt_count, generator=split_generator).tolist()
+        val_count = int(prompt_count * LORA_VAL_FRACTION) if prompt_count >= 20 else 0
+        val_prompts = [prompts[i] for i in order[:val_count]]
+        train_prompts = [prompts[i] for i in order[val_count:]]
+
+        dataset = PromptDataset(train_prompts, tokenizer)
+        # Pads per batch and masks padding out of the loss (labels = -100)
+        collator = DataCollatorForLanguageModeling(tokenizer=tokenizer, mlm=False)
+        sampler = LengthBucketSampler(dataset.lengths, LORA_BATCH_SIZE)
+        dataloader = DataLoader(dataset, batch_sampler=sampler, collate_fn=collator, num_workers=0)
 
-        dataset = PromptDataset(prompts, tokenizer)
+        val_dataloader = None
+        if val_prompts:
+            val_dataset = PromptDataset(val_prompts, tokenizer)
+            val_dataloader = DataLoader(val_dataset, batch_size=LORA_BATCH_SIZE, collate_fn=collator, num_workers=0)
+        logger.info(f"Training on {len(dataset)} prompts ({len(val_prompts)} held out): batch size {LORA_BATCH_SIZE}, gradient accumulation {LORA_GRAD_ACCUM}, {len(dataloader)} batches per epoch, lr {LORA_LEARNING_RATE:.2e}")
 
         # ✅ Step 4: Training
         model.train()
-        optimizer = torch.optim.AdamW(model.parameters(), lr=5e-5, weight_decay=0.01)
-        scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=5, gamma=0.8)
+        optimizer = torch.optim.AdamW(model.parameters(), lr=LORA_LEARNING_RATE, weight_decay=LORA_WEIGHT_DECAY)
+        scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=LORA_LR_STEP_EPOCHS, gamma=LORA_LR_GAMMA)
+        controller = TrainingController()
 
-        seen_batches = 0
         for epoch in range(num_epochs):
             total_loss = 0
-            dataloader = DataLoader(dataset, batch_size=1, shuffle=True, drop_last=False, num_workers=0)
-            assert len(dataloader) < 1000, "Dataloader length is unexpectedly large. Check dataset logic."
+            optimizer.zero_grad()
             
             for step, batch in enumerate(dataloader):
-                seen_batches += 1
-                if seen_batches > len(dataloader):
-                    logger.error("Too many steps, something's worng with dataloader")
-                    break
                 try:
-                    
-                    logger.debug("🧠 Moving batch to device...")
                     batch = {k: v.to(device) for k, v in batch.items()}
-                    logger.debug("✅ Batch moved to device")
-                    logger.debug("📥 Forward pass start")
                     outputs = model(**batch)
-                    logger.debug("📤 Forward pass complete")
                     loss = outputs.loss
-                    logger.debug(f"🧮 Epoch {epoch+1} | Step {step+1} | Loss: {loss.item()}")
+                    if step % LORA_LOG_EVERY == 0:
+                        logger.debug(f"🧮 Epoch {epoch+1} | Step {step+1} | Batch {tuple(batch['input_ids'].shape)} | Loss: {loss.item()}")
                     
                     if torch.isnan(loss):
                         logger.error("❌ NaN loss detected! Stopping training.")
                         break
 
-                    start = time.time()
-                    loss.backward()
-                    logger.debug(f"✅ Done Backward (time: {time.time() - start:.2f}seconds)")
-                    logger.debug("💾 Start Optimizer step")
-                    optimizer.step()
-                    logger.debug("💾 Done Optimizer step")
-                    optimizer.zero_grad()
+                    (loss / LORA_GRAD_ACCUM).backward()
+                    controller.record_batch(batch)
+
+                    if (step + 1) % LORA_GRAD_ACCUM == 0 or step + 1 == len(dataloader):
+                        optimizer.step()
+                        optimizer.zero_grad()
+                        if controller.record_optimizer_step() and val_dataloader is not None:
+                            controller.update(evaluate_loss(model, val_dataloader), model)
                     total_loss += loss.item()
                 except Exception as e:
                     logger.error(f"❌ Error during training step: {e}")
+                    optimizer.zero_grad()
+
+                if controller.should_stop():
+                    break
             scheduler.step()
-            logger.info(f"Epoch {epoch+1} Finished - Loss: {total_loss:.4f}")
+            logger.info(f"Epoch {epoch+1} Finished - Loss: {total_loss:.4f} | {controller.tokens} tokens in {controller.elapsed():.0f}s ({controller.tokens_per_second():.1f} tokens/s)")
+
+            if controller.should_stop():
+                logger.info(f"Stopping training early: {controller.stop_reason}")
+                break
+
+        # Score the final weights too, then keep whichever adapter had the lowest held-out loss
+        if val_dataloader is not None:
+            controller.update(evaluate_loss(model, val_dataloader), model)
+            controller.restore_best(model)
+        logger.info(f"Training used {controller.tokens} tokens in {controller.elapsed():.0f}s ({controller.tokens_per_second():.1f} tokens/s)")
+        record_span("train", controller.elapsed(), rows=len(dataset), tokens=controller.tokens, stop_reason=controller.stop_reason)
         
-        logger.info("✅ Finished all epochs. Proceeding to save model...")
-        # ✅ Step 5: Save
+        # ✅ Step 4b: Choose a reduced-precision serving variant that keeps held-out perplexity
+        parity_dataloader = val_dataloader or DataLoader(
+            PromptDataset(train_prompts[:4 * LORA_BATCH_SIZE], tokenizer),
+            batch_size=LORA_BATCH_SIZE, collate_fn=collator, num_workers=0
+        )
         try:
-            os.makedirs(SAVE_PATH, exist_ok=True)
-            if hasattr(model, "merge_and_unload"):
-                model = model.merge_and_unload()
+            with span("inference_parity"):
+                inference_config = choose_inference_precision(model, parity_dataloader)
+        except Exception as e:
+            logger.error(f"Inference parity check failed, serving in float32: {e}")
+            inference_config = {"precision": "float32"}
+        logger.info(f"Serving precision: {inference_config['precision']}")
 
-            model.save_pretrained(SAVE_PATH)
+        logger.info("✅ Finished all epochs. Proceeding to save adapter...")
+        # ✅ Step 5: Save the LoRA adapter only (adapter_config.json + adapter_model.safetensors)
+        # The base model is shared at serving time, so it is not merged into a full copy
+        cache_path = os.path.join(ADAPTER_CACHE_DIR, training_key)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        try:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            os.makedirs(tmp_path, exist_ok=True)
+            model.save_pretrained(tmp_path)
+            tokenizer.save_pretrained(os.path.join(tmp_path, "_tokenizer"))
+            with open(os.path.join(tmp_path, INFERENCE_CONFIG_FILE), "w") as f:
+                json.dump(inference_config, f, indent=2)
+            with directory_lock(cache_path):
+                publish_directory(tmp_path, cache_path)
         except Exception as save_err:
-            logger.error(f"Model saving failed: {save_err}")
+            logger.error(f"Adapter saving failed: {save_err}")
             raise
 
-        # ✅ After model.save_pretrained(SAVE_PATH)
-        # Copy base model config into SAVE_PATH
-        # base_config_path = os.path.join(BASE_MODEL_DIR, "config.json")
-        # target_config_path = os.path.join(SAVE_PATH, "config.json")
-        # shutil.copyfile(base_config_path, target_config_path)
-        
-        # ✅ Step 6: Add model_type to config.json
-        config_path = os.path.join(SAVE_PATH, "config.json")
-        config_dict = model.config.to_dict()
-        if "architectures" in config_dict:
-            del config_dict["architectures"]
-            
-        config_dict.update({
-            "model_type": "gpt2",
-            "architectures": ["GPT2LMHeadModel"],
-            "torch_dtype": "float32",
-            "task": "text-generation"
-        })
-
-        with open(config_path, "w") as f:
-            json.dump(config_dict, f, indent=2)
-        
-        tokenizer.save_pretrained(os.path.join(SAVE_PATH, "_tokenizer"))
-            
-            # logger.info("Done edit config.json")
-        
-        # else:
-        #     logger.info("config.json not found")
+        publish_adapter(training_key, SAVE_PATH)
 
-        # ✅ Step 7: Upload to S3
-        s3 = boto3.client('s3', region_name=os.getenv("AWS_REGION"), config=boto3.session.Config(signature_version='s3v4'))
-        for file in sorted(os.listdir(SAVE_PATH)):
-            local_path = os.path.join(SAVE_PATH, file)
-            s3_key = f"{s3_model_path}/{file}"
-            s3.upload_file(local_path, os.getenv("S3_BUCKET_NAME"), s3_key)
+        # ✅ Step 6: Upload to S3, under the content address for reuse and the per-file folder for browsing
+        with span("upload"):
+            upload_adapter(s3, cache_path, f"{S3_ADAPTER_PREFIX}/{training_key}")
+            upload_adapter(s3, SAVE_PATH, s3_model_path)
+        return training_key
     except Exception as e:
         logger.error(f"[ERROR] train_lora_from_user_data() Exception: {str(e)}")
         print(f"[ERROR] train_lora_from_user_data() Exception: {str(e)}")
+        # Let the caller (the training scheduler) record the job as failed
+        raise
 
 def run_train_thread(s3_path, filename, model_choice):
     try:
@@ -225,4 +643,24 @@ def run_train_thread(s3_path, filename, model_choice):
         train_lora_from_user_data(s3_path, filename, model_choice)
     except Exception as e:
         logger.error(f"Threaded training failed: {str(e)}")
-        print(f"Threaded training failed: {str(e)}")
\ No newline at end of file
+        print(f"Threaded training failed: {str(e)}")
+
+def run_training_job(s3_path, filename, model_choice, num_threads=None, job_id=None):
+    """
+    Entry point for a training worker process; limits torch to its share of the cores
+
+    Returns the training key of the published adapter.
+    The job's records are shipped to logs/<file>_lora_training_log.log when it ends.
+    """
+    with job_log_context(f"{filename}_lora_training", job_id):
+        try:
+            if num_threads:
+                torch.set_num_threads(num_threads)
+                torch.set_num_interop_threads(1)
+            logger.info(f"Training job for {filename} ({model_choice}) using {torch.get_num_threads()} threads")
+            with span("lora_training", filename=filename, model=model_choice):
+                return train_lora_from_user_data(s3_path, filename, model_choice)
+        finally:
+            upload_log_to_s3()
+            # The worker process is retired after one job, so wait for the upload here
+            shutdown_logging()
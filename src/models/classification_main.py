@@ -1,6 +1,7 @@
 from .common import load_file
 from .classification_models import preprocess, select_model, build_model_dict, BestModel, individual_model
 from utils.model_utils import save_model_with_info
+from utils.timing_utils import span, timing_table
 from pathlib import Path
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import letter, landscape
@@ -25,12 +26,15 @@ def run_classification(file_key, model_choice):
     file_name_para = Paragraph(f"File Name: {filename}", styles['Normal'])
 
     print("[DEBUG] Loading file...")
-    df, _ = load_file(file_key)
+    with span("load") as load_span:
+        df, _ = load_file(file_key)
+        load_span.rows = len(df)
     print("[DEBUG] File loaded")
     print(df.head())
 
     print("[DEBUG] Preprocessing text columns...")
-    df, target, language_column, bow_list = preprocess.preprocess_text_columns(df)
+    with span("preprocess", rows=len(df)):
+        df, target, language_column, bow_list = preprocess.preprocess_text_columns(df)
 
     regression = preprocess.is_continuous_data  # T- regression, F - classification
     
@@ -61,13 +65,14 @@ def run_classification(file_key, model_choice):
         
         model_scores = f"Score with {model_name}: {best_score: .4f}"
     
-    if y_type == 'categorical':
-        model = BestModel(model=best_model, label_mapping=label_map)
+    with span("save_model"):
+        if y_type == 'categorical':
+            model = BestModel(model=best_model, label_mapping=label_map)
+            
+            model_info_buffer, model_buffer = save_model_with_info(model=model, model_name=model_name, required_packages=required_packages)
         
-        model_info_buffer, model_buffer = save_model_with_info(model=model, model_name=model_name, required_packages=required_packages)
-    
-    else:
-        model_info_buffer, model_buffer = save_model_with_info(model=best_model, model_name=model_name, required_packages=required_packages)
+        else:
+            model_info_buffer, model_buffer = save_model_with_info(model=best_model, model_name=model_name, required_packages=required_packages)
     
     if regression:
         continuous_data = 'The Dataset is continuous. Use Regression'
@@ -105,10 +110,16 @@ def run_classification(file_key, model_choice):
         content = [title, Spacer(1, 24), file_name_para, line, continuous_text,language_column_text, bow_list_text,
                    Spacer(1, 12), model_scores_text, Spacer(1, 12), Spacer(1, 12), info_text]
 
+    # Stages finished so far; the PDF build, uploads and indexing are in the [TIMING] log record
+    stage_table = timing_table()
+    if stage_table is not None:
+        content += [Spacer(1, 12), Paragraph("Processing time", styles['Bold']), Spacer(1, 6), stage_table]
+
     try:
         pdf_buffer = io.BytesIO()
         doc = SimpleDocTemplate(pdf_buffer, pagesize=letter)
-        doc.build(content)
+        with span("pdf"):
+            doc.build(content)
 
         pdf_buffer.seek(0)
         model_info_buffer.seek(0)
@@ -116,8 +127,9 @@ def run_classification(file_key, model_choice):
         zip_buffer = io.BytesIO()
         with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
             # Add model info and model file to the zip buffer
-            zipf.writestr(f"{filename}_model_info.json", model_info_buffer.getvalue())  # Model info file
-            zipf.writestr(f"{filename}_model.pkl", model_buffer.getvalue())  # Model file
+            # getbuffer() hands zipfile a view of the buffers instead of a copy
+            zipf.writestr(f"{filename}_model_info.json", model_info_buffer.getbuffer())  # Model info file
+            zipf.writestr(f"{filename}_model.pkl", model_buffer.getbuffer())  # Model file
 
         
         zip_buffer.seek(0)
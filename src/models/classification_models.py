@@ -16,6 +16,7 @@ from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import StandardScaler
 import time
 from utils.logger_utils import logger
+from utils.timing_utils import span, timed, current_span
 
 
 class preprocess:
@@ -1452,6 +1453,7 @@ class select_model:
             return None
 
     # Model selection function
+    @timed("model_selection")
     def model_selection(models, X, y, mode='classification', k=5):
         '''
         Seleect the best model for the given dataset using k-fold cross-validation and Dask for parallel computation
@@ -1468,7 +1470,6 @@ class select_model:
             - best_score (float): The average score of the best model across all folds
         '''
         logger.info("Starting model selection...")
-        start_time = time.time()
         try:
             y_type = preprocess.check_target_type(y)
             if y_type == 'categorical':
@@ -1486,73 +1487,72 @@ class select_model:
                     continue
 
                 logger.info(f"Processing model: {model_name}")
-                model_start_time = time.time()
-
-                if model_name in [
-                    'Decision Tree classification',
-                    'Decision Tree regression',
-                    'Random Forest classification',
-                    'Random Forest regression',
-                    'Tuned Logistic Regression'
-                    ]:
-
-                    if model_name == 'Tuned Logistic Regression':
-                        logger.info(f"Applying scaler to Tuned Logistic Regression.")
-                        scaler = StandardScaler()
-                        X_scaled = scaler.fit_transform(X)
-
-                        train_X, test_X, train_y, test_y = train_test_split(X_scaled, y, test_size=0.2, random_state=42)
-
-                        train_X = pd.DataFrame(train_X).reset_index(drop=True)
-                        test_X = pd.DataFrame(test_X).reset_index(drop=True)
-                        train_y = train_y.reset_index(drop=True)
-                        test_y = test_y.reset_index(drop=True)
-
-                        model.fit(train_X, train_y)
+                with span(f"model:{model_name}", rows=len(X)) as model_span:
+                    if model_name in [
+                        'Decision Tree classification',
+                        'Decision Tree regression',
+                        'Random Forest classification',
+                        'Random Forest regression',
+                        'Tuned Logistic Regression'
+                        ]:
+
+                        if model_name == 'Tuned Logistic Regression':
+                            logger.info(f"Applying scaler to Tuned Logistic Regression.")
+                            scaler = StandardScaler()
+                            X_scaled = scaler.fit_transform(X)
+
+                            train_X, test_X, train_y, test_y = train_test_split(X_scaled, y, test_size=0.2, random_state=42)
+
+                            train_X = pd.DataFrame(train_X).reset_index(drop=True)
+                            test_X = pd.DataFrame(test_X).reset_index(drop=True)
+                            train_y = train_y.reset_index(drop=True)
+                            test_y = test_y.reset_index(drop=True)
+
+                            model.fit(train_X, train_y)
                     
-                    else:
-                        train_X, test_X, train_y, test_y = train_test_split(X, y, test_size=0.2, random_state=42)
-
-                        train_X = pd.DataFrame(train_X).reset_index(drop=True)
-                        test_X = pd.DataFrame(test_X).reset_index(drop=True)
-                        train_y = train_y.reset_index(drop=True)
-                        test_y = test_y.reset_index(drop=True)
-
-                        model.fit(train_X, train_y)
-
-                    if mode == 'classification':
-                        if isinstance(model, Pipeline):
-                            inner_model = None
-                            for step_name in ['Decision Tree classification', 'Decision Tree regression', 'Random Forest classification', 'Random Forest regression', 'Tuned Logistic Regression']:
-                                if step_name in model.named_steps:
-                                    inner_model = model.named_steps[step_name]
-                                    break
                         else:
-                            inner_model = model
-
-                        prob_y = model.predict_proba(test_X)
-                        if hasattr(inner_model, 'num_class') and inner_model.num_class == 2:
-                            score = roc_auc_score(test_y, prob_y)
-                            logger.info(f"[{model_name}] Classification ROC-AUC score (binary): {score: .4f}")
+                            train_X, test_X, train_y, test_y = train_test_split(X, y, test_size=0.2, random_state=42)
+
+                            train_X = pd.DataFrame(train_X).reset_index(drop=True)
+                            test_X = pd.DataFrame(test_X).reset_index(drop=True)
+                            train_y = train_y.reset_index(drop=True)
+                            test_y = test_y.reset_index(drop=True)
+
+                            model.fit(train_X, train_y)
+
+                        if mode == 'classification':
+                            if isinstance(model, Pipeline):
+                                inner_model = None
+                                for step_name in ['Decision Tree classification', 'Decision Tree regression', 'Random Forest classification', 'Random Forest regression', 'Tuned Logistic Regression']:
+                                    if step_name in model.named_steps:
+                                        inner_model = model.named_steps[step_name]
+                                        break
+                            else:
+                                inner_model = model
+
+                            prob_y = model.predict_proba(test_X)
+                            if hasattr(inner_model, 'num_class') and inner_model.num_class == 2:
+                                score = roc_auc_score(test_y, prob_y)
+                                logger.info(f"[{model_name}] Classification ROC-AUC score (binary): {score: .4f}")
+                            else:
+                                score = roc_auc_score(test_y, prob_y, multi_class='ovr', average='weighted')
+                                logger.info(f"[{model_name}] Classification ROC-AUC score (multi-class): {score: .4f}")
                         else:
-                            score = roc_auc_score(test_y, prob_y, multi_class='ovr', average='weighted')
-                            logger.info(f"[{model_name}] Classification ROC-AUC score (multi-class): {score: .4f}")
-                    else:
-                        predictions = model.predict(test_X)
-                        score = r2_score(test_y, predictions)
-                        logger.info(f"[{model_name}] Regression R^2 score: {score: .4f}")
+                            predictions = model.predict(test_X)
+                            score = r2_score(test_y, predictions)
+                            logger.info(f"[{model_name}] Regression R^2 score: {score: .4f}")
                     
-                    logger.debug(f"{model_name} evaluation score: {score}")
-                    results.append((model_name, model, score))
-                
-                else:
-                    # Perform cross-validation fro other models
-                    logger.info(f"Scheduling cross-validation fro model: {model_name}")
-                    score = select_model.cross_validation(model, X, y, k, mode=mode)
-                    results.append((model_name, model, score))
-                    logger.debug(f"{model_name} cross-validation score: {score}")
+                        logger.debug(f"{model_name} evaluation score: {score}")
+                        results.append((model_name, model, score))
                 
-                model_end_time = time.time() - model_start_time
+                    else:
+                        # Perform cross-validation fro other models
+                        logger.info(f"Scheduling cross-validation fro model: {model_name}")
+                        score = select_model.cross_validation(model, X, y, k, mode=mode)
+                        results.append((model_name, model, score))
+                        logger.debug(f"{model_name} cross-validation score: {score}")
+
+                model_end_time = model_span.duration
                 logger.info(f"Model {model_name} execution time: {model_end_time: .2f} seconds")
 
             # Find the best model based on score
@@ -1567,7 +1567,7 @@ class select_model:
                     best_model = model
                     best_model_name = model_name
             
-            total_time = time.time() - start_time
+            total_time = time.perf_counter() - current_span().start
             logger.info(f"Best Model: {best_model}, Best Score: {best_score: .4f}")
             logger.info(f"Model selection completed in {total_time: .2f} seconds.")
             
@@ -1765,38 +1765,37 @@ def individual_model(model_choice, X, y, mode='classification'):
     
     logger.info(f"Training {model_choice}...")
 
-    start_time = time.time()
-
-    try:
-        model.fit(train_X, train_y)
-    except Exception as e:
-        logger.error(f"Error training {model_choice}: {e}")
-        raise
+    with span("train", rows=len(train_X), model=model_choice) as train_span:
+        try:
+            model.fit(train_X, train_y)
+        except Exception as e:
+            logger.error(f"Error training {model_choice}: {e}")
+            raise
 
-    training_time = time.time() - start_time
+    training_time = train_span.duration
     logger.info(f"Training {model_choice} completed in {training_time: .2f} seconds.")
 
     logger.info(f"Evaluating {model_choice}...")
-
-    try:
-        predictions = model.predict(test_X)
-    except Exception as e:
-        logger.error(f"Error predicting with {model_choice}: {e}")
-        raise
-
-    accuracy = accuracy_score(test_y, predictions)
-
-    if mode == 'regression':      # Regression
-        score = r2_score(test_y, predictions)
-        logger.info(f"[{model_choice}] Regression R^2 score: {score: .4f}")
-    else:               # Classification
-        prob_y = model.predict_proba(test_X)
-        if hasattr(model, 'num_class') and model.num_class == 2:
-            score = roc_auc_score(test_y, prob_y)
-            logger.info(f"[{model_choice}] Classification ROC-AUC score (binary): {score: .4f}")
-        else:
-            score = roc_auc_score(test_y, prob_y, multi_class='ovr', average='weighted')
-            logger.info(f"[{model_choice}] Classification ROC-AUC score (multi-class): {score: .4f}")
+    with span("evaluate", rows=len(test_X), model=model_choice):
+        try:
+            predictions = model.predict(test_X)
+        except Exception as e:
+            logger.error(f"Error predicting with {model_choice}: {e}")
+            raise
+
+        accuracy = accuracy_score(test_y, predictions)
+
+        if mode == 'regression':      # Regression
+            score = r2_score(test_y, predictions)
+            logger.info(f"[{model_choice}] Regression R^2 score: {score: .4f}")
+        else:               # Classification
+            prob_y = model.predict_proba(test_X)
+            if hasattr(model, 'num_class') and model.num_class == 2:
+                score = roc_auc_score(test_y, prob_y)
+                logger.info(f"[{model_choice}] Classification ROC-AUC score (binary): {score: .4f}")
+            else:
+                score = roc_auc_score(test_y, prob_y, multi_class='ovr', average='weighted')
+                logger.info(f"[{model_choice}] Classification ROC-AUC score (multi-class): {score: .4f}")
     
     logger.info(f"{model_choice} evaluation completed with accuracy: {accuracy: .4f}, score: {score: .4f}")
     
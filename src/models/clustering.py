@@ -1,11 +1,12 @@
 # Load libraries
+import itertools
 import pandas as pd
-from .common import spark, spark_processing, pandas_processing
+from .common import spark_processing, pandas_processing
+from pyspark.sql import DataFrame as SparkDataFrame
+from pyspark.sql import functions as F
 import numpy as np
-import seaborn as sns
-import matplotlib.pyplot as plt
 import matplotlib
-from sklearn.decomposition import PCA
+from sklearn.decomposition import PCA, IncrementalPCA
 from sklearn.cluster import KMeans
 from sklearn.metrics import silhouette_score
 from sklearn.cluster import AgglomerativeClustering
@@ -23,7 +24,7 @@ def eliminate_high_correlation(data, threshold=0.8):
         to_drop = [column for column in upper_triangle.columns if any(upper_triangle[column] > threshold)]
         return data.drop(columns = to_drop)
     
-    elif isinstance(data, spark.sql.dataframe.DataFrame):
+    elif isinstance(data, SparkDataFrame):
         columns = data.columns
         to_drop = set()  # Set the stored the eliminated columns
 
@@ -44,40 +45,160 @@ def eliminate_low_variance(data, threshold=0.01):
     # Eliminate the low variacne features
     from sklearn.feature_selection import VarianceThreshold
 
+    if isinstance(data, SparkDataFrame):
+        # Same rule as VarianceThreshold (population variance > threshold), in one aggregation pass
+        variances = data.agg(*[F.var_pop(c).alias(c) for c in data.columns]).first().asDict()
+        keep = [c for c in data.columns if variances[c] is not None and variances[c] > threshold]
+        return data.select(*keep)
+
     selector = VarianceThreshold(threshold=threshold)
     reduce = selector.fit_transform(data)
     return pd.DataFrame(reduce, columns=data.columns[selector.get_support()])
 
+def frame_chunks(data, batch_size):
+    for start in range(0, data.shape[0], batch_size):
+        yield data.iloc[start:start + batch_size]
+
+def spark_chunks(data, batch_size=10000):
+    # Stream a Spark DataFrame to the driver one partition at a time, as pandas frames of batch_size rows
+    rows = []
+    for row in data.toLocalIterator():
+        rows.append(row)
+        if len(rows) == batch_size:
+            yield pd.DataFrame(rows, columns=data.columns)
+            rows = []
+    if rows:
+        yield pd.DataFrame(rows, columns=data.columns)
+
+# One PCA fit shared by the variance truncation and the 2-D plot projection
+class pcaReducer:
+    def __init__(self, max_component=10, batch_size=10000, random_state=42):
+        self.max_component = max_component
+        self.batch_size = batch_size
+        self.random_state = random_state
+        self.pca = None
+        self.columns = None
+        self.n_components = None
+
+    def _estimator(self, n_components, incremental):
+        if incremental:
+            return IncrementalPCA(n_components=n_components, batch_size=self.batch_size)
+        return PCA(n_components=n_components, svd_solver='randomized', random_state=self.random_state)
+
+    def fit(self, data):
+        return self.fit_chunks(frame_chunks(data, self.batch_size))
+
+    def fit_chunks(self, chunks):
+        # For data that does not fit in memory, e.g. spark_chunks(df) or pd.read_csv(path, chunksize=...)
+        batches = self._batches(chunks)
+        first = next(batches, None)
+        if first is None:
+            raise ValueError("No rows to fit PCA on")
+        self.columns = first.columns
+        # Fit only as many components as can ever be kept
+        n_fit = min(self.max_component, first.shape[1], first.shape[0])
+
+        second = next(batches, None)
+        if second is None:
+            # Everything fits in one batch: a single randomized fit
+            self.pca = self._estimator(n_fit, incremental=False)
+            self.pca.fit(first)
+            return self
+
+        self.pca = self._estimator(n_fit, incremental=True)
+        # Hold one batch back so a short last batch can be merged into it instead of dropped
+        pending = first
+        for batch in itertools.chain([second], batches):
+            if batch.shape[0] < n_fit:
+                pending = pd.concat([pending, batch])
+                continue
+            self.pca.partial_fit(pending)
+            pending = batch
+        self.pca.partial_fit(pending)
+
+        return self
+
+    def _batches(self, chunks):
+        # Regroup chunks of any size into batch_size rows; only the last batch may be shorter
+        buffer, rows = [], 0
+        for chunk in chunks:
+            buffer.append(chunk)
+            rows += chunk.shape[0]
+            while rows >= self.batch_size:
+                frame = pd.concat(buffer) if len(buffer) > 1 else buffer[0]
+                yield frame.iloc[:self.batch_size]
+                buffer, rows = [frame.iloc[self.batch_size:]], rows - self.batch_size
+        if rows:
+            yield pd.concat(buffer) if len(buffer) > 1 else buffer[0]
+
+    def choose_components(self, variance_threshold=0.95):
+        # explained_variance_ratio_ is relative to the total variance, so the truncated fit is enough
+        cumulative_variance = self.pca.explained_variance_ratio_.cumsum()
+        n_fitted = len(cumulative_variance)
+
+        n_components_by_variance = (cumulative_variance < variance_threshold).sum() + 1
+        n_components = min(n_components_by_variance, n_fitted)
+        self.n_components = max(n_components, 2) if n_fitted > 1 else 1
+
+        return self.n_components
+
+    def _project(self, data, n_components):
+        projected = [self.pca.transform(chunk)[:, :n_components] for chunk in frame_chunks(data, self.batch_size)]
+
+        return np.vstack(projected)
+
+    def transform(self, data, n_components=None):
+        n_components = n_components or self.n_components
+        reduced = self._project(data[self.columns], n_components)
+        return pd.DataFrame(reduced, columns=[f"PC{i+1}" for i in range(n_components)], index=data.index)
+
+    def transform_chunks(self, chunks, n_components=None):
+        n_components = n_components or self.n_components
+        for chunk in chunks:
+            yield self.transform(chunk, n_components)
+
+    def component_importance(self, n_components=None):
+        n_components = n_components or self.n_components
+        return pd.DataFrame(self.pca.components_[:n_components], columns=self.columns, index=[f"PC{i+1}" for i in range(n_components)])
+
+    def projection_2d(self, reduced_data):
+        # The first two components of the same fit are the 2-D plotting projection
+        return np.asarray(reduced_data)[:, :2]
+
 def apply_pca(data, variance_threshold=0.95, max_component=10):
     pca_info = ""
+    is_spark = isinstance(data, SparkDataFrame)
     # Check the number of variance
-    n_features = data.shape[1]
+    n_features = len(data.columns) if is_spark else data.shape[1]
     if n_features < 2:
         pca_info += "Insufficient features after filtering. Returning original data."
-        return data, pca_info
+        return (data.toPandas() if is_spark else data), None, pca_info, None
     
-    # Using PCA calculate the ratio of cumulative variance
-    pca = PCA()
-    pca.fit(data)
-    cumulative_variance = pca.explained_variance_ratio_.cumsum()
-
-    # Determining the minimum number of components based on variance ratio
-    n_components_by_variance = (cumulative_variance < variance_threshold).sum() + 1
-    n_components = min(n_components_by_variance, max_component, n_features)
+    # Single randomized (or incremental, for large data) PCA fit
+    reducer = pcaReducer(max_component=max_component)
+    if is_spark:
+        # Two passes over the rows (fit, then project); only batch_size rows and the reduced columns are held on the driver
+        data = data.persist()
+        try:
+            reducer.fit_chunks(spark_chunks(data, reducer.batch_size))
+            n_components = reducer.choose_components(variance_threshold)
+            reduced_data = pd.concat(reducer.transform_chunks(spark_chunks(data, reducer.batch_size), n_components), ignore_index=True)
+        finally:
+            data.unpersist()
+    else:
+        reducer.fit(data)
+        # Determining the minimum number of components based on variance ratio
+        n_components = reducer.choose_components(variance_threshold)
+        # Apply PCA
+        reduced_data = reducer.transform(data, n_components)
 
-    n_components = max(n_components, 2) if n_features > 1 else 1
     pca_info += f"(explained variance threshold: {variance_threshold * 100}%)."
+    component_importance = reducer.component_importance(n_components)
 
-    # Apply PCA
-    pca = PCA(n_components= n_components)
-    reduced_data = pca.fit_transform(data)
-    reduced_data = pd.DataFrame(reduced_data, columns=[f"PC{i+1}" for i in range(n_components)], index=data.index)
-
-    component_importance = pd.DataFrame(pca.components_, columns=data.columns, index=[f"PC{i+1}" for i in range(n_components)])
-
-    return reduced_data, component_importance, pca_info
+    return reduced_data, component_importance, pca_info, reducer
 
 def filter_data(data, threshold_corr=0.8, threshold_var=0.01, explained_variance=0.95, max_components=10):
+    # Spark input (files too large for pandas) is filtered in Spark and streamed through the PCA in chunks
     # Filter the highly correlated features
     data = eliminate_high_correlation(data, threshold=threshold_corr)
 
@@ -85,14 +206,18 @@ def filter_data(data, threshold_corr=0.8, threshold_var=0.01, explained_variance
     data = eliminate_low_variance(data, threshold=threshold_var)
 
     # Apply PCA
-    data, component_importane, pca_info = apply_pca(data, variance_threshold=explained_variance, max_component=max_components)
+    data, component_importane, pca_info, reducer = apply_pca(data, variance_threshold=explained_variance, max_component=max_components)
 
-    return data, component_importane, pca_info
+    return data, component_importane, pca_info, reducer
 
 # Perform PCA for visualization
-def visualize_pca(data, mode):
+def visualize_pca(data, mode, reducer=None):
+    # Reuse the filter_data fit instead of rescaling and fitting again
+    if reducer is not None:
+        return reducer.projection_2d(data)
+
     if mode == 'spark':
-        scaled_data = spark_processing.spark_scaled_df(data)
+        scaled_data = spark_processing.spark_scale_df(data)
     
     elif mode == 'pandas':
         scaled_data = pandas_processing.pandas_scale_df(data)
@@ -124,14 +249,6 @@ def elbow(data):
 
     return elbow_point, wcss
 
-def elbow_plot(elbow_point, wcss, file_name, algorithm, threshold):
-    plt.clf()
-    plt.plot(range(1, 11), wcss, marker='o')
-    plt.axvline(elbow_point, color='b', linestyle='-')
-    plt.xlabel('Number of clusters')
-    plt.ylabel('WCSS')
-    plt.title(f'{file_name}_{threshold}_Elbow Method')
-
 # Algorithm for choosing the number of clusters. 
 def choose_cluster(elbow, silhouette):
     chosen_cluster = 0
@@ -183,23 +300,6 @@ def choose_algo(data, n_cluster, algorithm):
     else:
         return kmeans(data, n_cluster), agglomerative(data, n_cluster)
 
-# Generate the cluster plots, depending on the user's choice
-def plot_cluster(pca_df, file_name, algorithm, threshold):
-    
-    # If user choose only Agglomerative clustering algorithm, then plot agglomerative cluster
-    if 'Agglomerative Cluster' in pca_df.columns:
-        axs = plt.subplots()
-        axs = sns.scatterplot(x=pca_df[0], y=pca_df[1], hue='Agglomerative Cluster', data=pca_df)
-        plt.title(f'{file_name} {threshold} {algorithm} Cluster')
-        #plt.savefig(f'./static/_img/{file_name}_{threshold}_Agglomerative_Cluster.png')
-    
-    # If user choose only k-Means clustering algorithm, then plot k-Means cluster
-    if 'k-Means Cluster' in pca_df.columns:
-        axs = plt.subplots()
-        axs = sns.scatterplot(x=pca_df[0], y=pca_df[1], hue='k-Means Cluster', data=pca_df)
-        plt.title(f'{file_name} {threshold} {algorithm} Cluster')
-        #plt.savefig(f'./static/_img/{file_name}_{threshold}_k-Means_Cluster.png')
-
 # Determine optimal number of clusters using silhouette method
 class silhouetteAnalyze:
     def __init__(self, data):
@@ -232,15 +332,3 @@ class silhouetteAnalyze:
             return None
         
         return self.silhouette_scores
-    
-    def plot(self, file_name, algorithm, threshold):
-        if self.silhouette_scores is None:
-            print("Call analyze() method first to compute silhouette scores.")
-            return
-        
-        plt.clf()
-        plt.plot(range(2, 11), self.silhouette_scores, marker='o')
-        plt.axvline(self.optimal_clusters, color='b', linestyle='-')
-        plt.xlabel('Number of clusters')
-        plt.ylabel('Silhouette Score')
-        plt.title(f'{file_name}_{threshold}_Silhouette Method')
@@ -1,5 +1,7 @@
 from models import common
-from .clustering import filter_data, elbow, elbow_plot, silhouetteAnalyze, choose_cluster, choose_algo, visualize_pca, plot_cluster, pd, plt
+from .clustering import filter_data, elbow, silhouetteAnalyze, choose_cluster, choose_algo, visualize_pca
+from utils.plot_utils import hash_dataset, render_plots
+from utils.timing_utils import span, timing_table
 from pathlib import Path
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import letter, landscape
@@ -12,11 +14,13 @@ from reportlab.lib.utils import ImageReader
 def run_cluster(file_key, threshold, algorithm, plot):
 
     # Call the file and save it to a variable, df
-    df, mode = common.load_file(file_key)
-    if mode == 'spark':
-        df = df.na.drop(how='all')
-    else:
-        df = df.dropna(how='all')
+    with span("load") as load_span:
+        df, mode = common.load_file(file_key)
+        if mode == 'spark':
+            df = df.na.drop(how='all')
+        else:
+            df = df.dropna(how='all')
+            load_span.rows = len(df)
     file_name = Path(file_key).stem
     
     # Create a PDF document
@@ -28,29 +32,33 @@ def run_cluster(file_key, threshold, algorithm, plot):
     title = Paragraph("Clustering Report", styles['Title'])
     file_name_para = Paragraph(f"File Name: {file_name}", styles['Normal'])
 
-    pre_df, gender_mapping = common.spark_processing.spark_preprocessing_data(df, mode)
+    with span("preprocess", mode=mode):
+        pre_df, gender_mapping = common.spark_processing.spark_preprocessing_data(df, mode)
 
     unique = list(gender_mapping.keys())
     label = list(gender_mapping.values())
 
     # Reduce columns with the most relevant columns
-    filtered_df, variables, pca_info = filter_data(pre_df, threshold_corr=0.85, threshold_var=0.02, explained_variance=0.95, max_components=10)
+    with span("feature_reduction"):
+        filtered_df, variables, pca_info, reducer = filter_data(pre_df, threshold_corr=0.85, threshold_var=0.02, explained_variance=0.95, max_components=10)
 
-    useful_variable = f"Use {variables.columns} to cluster. {pca_info}"
+    used_columns = variables.columns if variables is not None else filtered_df.columns
+    useful_variable = f"Use {used_columns} to cluster. {pca_info}"
 
     # Elbow method to determine the number of clusters
-    elbow_cluster, wcss = elbow(filtered_df)
+    with span("elbow", rows=len(filtered_df)):
+        elbow_cluster, wcss = elbow(filtered_df)
 
 
     # Silhouette method to determine the number of clusters
-    silhouette = silhouetteAnalyze(filtered_df)
-    silhouette.analyze()
-    silhou_cluster = silhouette.get_optimal_clusters()
-
-    # silhouette.plot(file_name, algorithm, threshold)
+    with span("silhouette", rows=len(filtered_df)):
+        silhouette = silhouetteAnalyze(filtered_df)
+        silhouette.analyze()
+        silhou_cluster = silhouette.get_optimal_clusters()
 
     n_cluster, cluster_info = choose_cluster(elbow_cluster, silhou_cluster)
-    cluster = choose_algo(filtered_df, n_cluster, algorithm)
+    with span("cluster", rows=len(filtered_df), algorithm=algorithm, n_clusters=int(n_cluster)):
+        cluster = choose_algo(filtered_df, n_cluster, algorithm)
     
     if algorithm == 'both':
         kmeans_label, agglom_label = cluster
@@ -65,36 +73,29 @@ def run_cluster(file_key, threshold, algorithm, plot):
         agglom_label = cluster
         df['Agglomerative Cluster'] = agglom_label
 
-    image_buffers = []
-
-    def add_plot_to_pdf(plot_func, *args):
-        img_buffer = io.BytesIO()
-        plot_func(*args)
-        plt.savefig(img_buffer, format='png')
-        plt.close()
-        img_buffer.seek(0)
-        image_buffers.append(img_buffer)
-    add_plot_to_pdf(elbow_plot, elbow_cluster, wcss, file_name, algorithm, threshold)
-    add_plot_to_pdf(silhouette.plot, file_name, algorithm, threshold)
+    # Figures are rendered with the Figure API in worker processes and cached per (dataset, parameters)
+    dataset_hash = hash_dataset(filtered_df)
+    plot_jobs = [
+        ("elbow", {"wcss": [float(w) for w in wcss], "elbow_point": int(elbow_cluster), "file_name": file_name, "threshold": threshold}, None),
+        ("silhouette", {"scores": [float(s) for s in silhouette.get_silhouette_scores()], "optimal_clusters": int(silhou_cluster),
+                        "file_name": file_name, "threshold": threshold}, None),
+    ]
 
     if plot == 'yes':
-        pca = visualize_pca(filtered_df, mode)
-        
-        pca_df = pd.DataFrame(pca)
-        if 'k-Means Cluster' in df.columns:
-            pca_df['k-Means Cluster'] = df['k-Means Cluster']
-        
-        if 'Agglomerative Cluster' in df.columns:
-            pca_df['Agglomerative Cluster'] = df['Agglomerative Cluster']
-        
+        pca = visualize_pca(filtered_df, mode, reducer)
+
         if algorithm == 'both':
-            add_plot_to_pdf(plot_cluster, pca_df, file_name, "k-Means", threshold)
-            add_plot_to_pdf(plot_cluster, pca_df, file_name, "Agglomerative", threshold)
-        elif algorithm =='k-Means':
-            add_plot_to_pdf(plot_cluster, pca_df, file_name, "k-Means", threshold)
-        elif algorithm == 'Agglomerative':
-            add_plot_to_pdf(plot_cluster, pca_df, file_name, "Agglomerative", threshold)
+            cluster_algorithms = ["k-Means", "Agglomerative"]
+        else:
+            cluster_algorithms = [algorithm]
 
+        for cluster_algorithm in cluster_algorithms:
+            labels = df[f'{cluster_algorithm} Cluster'].to_numpy()
+            plot_jobs.append(("cluster_scatter", {"file_name": file_name, "algorithm": cluster_algorithm, "threshold": threshold},
+                              (pca, labels)))
+
+    with span("plots", figures=len(plot_jobs)):
+        image_buffers = render_plots(plot_jobs, dataset_hash)
 
     scores = silhouette.get_silhouette_scores()
     scores = scores[n_cluster - 2]
@@ -137,10 +138,15 @@ def run_cluster(file_key, threshold, algorithm, plot):
         content.append(Image(img_buffer, width=400, height=300))
 
 
-    doc.build(content)
+    # Stages finished so far; the PDF build and upload are in the [TIMING] log record
+    stage_table = timing_table()
+    if stage_table is not None:
+        content += [Spacer(1, 12), Paragraph("Processing time", styles['Bold']), Spacer(1, 6), stage_table]
+
+    with span("pdf"):
+        doc.build(content)
 
-    csv_buffer = io.BytesIO()
-    df.to_csv(csv_buffer, index=False)
-    csv_buffer.seek(0)
+    pdf_buffer.seek(0)
 
-    return pdf_buffer, csv_buffer
+    # The labeled DataFrame is streamed to S3 as CSV by upload_to_s3_direct instead of being buffered here
+    return pdf_buffer, df
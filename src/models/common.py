@@ -3,26 +3,39 @@ from sklearn.preprocessing import StandardScaler as sklearnStandardScaler, Label
 from sklearn.impute import SimpleImputer
 from dotenv import load_dotenv
 import os
+from threading import Lock
 from utils.logger_utils import logger
 import boto3
 from botocore.exceptions import ClientError
 from pyspark.sql import SparkSession
-from pyspark.sql.functions import col, lower, udf
-from pyspark.ml.feature import Imputer, StringIndexer, StandardScaler as sparkStandardScaler, VectorAssembler
-from pyspark.sql.types import DoubleType, FloatType, IntegerType, LongType, StringType
+from pyspark.sql.functions import col, lower
+from pyspark.ml.feature import Imputer, StringIndexer
+from pyspark.sql.types import DoubleType, FloatType, IntegerType, LongType
 from pyspark.sql import functions as F
 
 load_dotenv()
 
-spark = SparkSession.builder \
-    .appName("DataPreprocessing") \
-    .master("local[*]") \
-    .config("spark.driver.memory", "2g")  \
-    .config("spark.executor.memory", "2g") \
-    .config("spark.driver.maxResultSize", "1g") \
-    .config("spark.executor.heartbeatInterval", "30s") \
-    .config("spark.network.timeout", "120s") \
-    .getOrCreate()
+_spark = None
+_spark_lock = Lock()
+
+def get_spark():
+    '''
+    Shared SparkSession, started on first use so processes that never read a large file
+    (e.g. LoRA training workers) do not launch a JVM
+    '''
+    global _spark
+    with _spark_lock:
+        if _spark is None:
+            _spark = SparkSession.builder \
+                .appName("DataPreprocessing") \
+                .master("local[*]") \
+                .config("spark.driver.memory", "2g")  \
+                .config("spark.executor.memory", "2g") \
+                .config("spark.driver.maxResultSize", "1g") \
+                .config("spark.executor.heartbeatInterval", "30s") \
+                .config("spark.network.timeout", "120s") \
+                .getOrCreate()
+        return _spark
 
 S3_REGION = "us-east-2"
 S3_BUCKET_NAME = "ml-platform-service"
@@ -62,9 +75,9 @@ def load_file(file_key):
     
         # Read the file based on its extension with PySpark
         if file_extension == 'csv':
-            return spark.read.csv(s3_path, header=True, inferSchema=True), mode
+            return get_spark().read.csv(s3_path, header=True, inferSchema=True), mode
         elif file_extension == 'json':
-            return spark.read.json(s3_path), mode
+            return get_spark().read.json(s3_path), mode
         else:
             raise ValueError("Unsupported file format. Supported formats are .csv, .xlsx, and .json")
     
@@ -90,11 +103,13 @@ class spark_processing:
 
         data = data.na.drop(how='all')
 
-        for col_name in data.columns:
-            try:
-                data = data.withColumn(col_name, col(col_name).cast(DoubleType()))
-            except Exception as e:
-                print(f"Error converting column {col_name}: {e}")
+        gender_column = next((c for c in ('sex', 'gender') if c in data.columns), None)
+
+        # Cast every column in a single projection; the gender column stays text for normalization
+        data = data.select(*[
+            F.col(col_name) if col_name == gender_column else F.col(col_name).cast(DoubleType()).alias(col_name)
+            for col_name in data.columns
+        ])
 
         numeric_cols = [field.name for field in data.schema.fields if isinstance(field.dataType, (DoubleType, FloatType, IntegerType, LongType))]
         imputer = Imputer(strategy="mean", inputCols=numeric_cols, outputCols=[f"{c}_imputed" for c in numeric_cols])
@@ -121,34 +136,27 @@ class spark_processing:
 
         gender_mapping = {}
         
-        if 'sex' in data.columns:
-            data, gender_mapping = spark_processing.spark_process_gender_column(data, 'sex')
-        elif 'gender' in data.columns:
-            data, gender_mapping = spark_processing.spark_process_gender_column(data, 'gender')
+        if gender_column is not None:
+            data, gender_mapping = spark_processing.spark_process_gender_column(data, gender_column)
 
         return data, gender_mapping
 
-    def spark_standardize_gender(value):
-        if value is None:
-            return "unknown"
-        
-        value = value.lower()
-        if "male" in value or "man" in value or "boy" in value:
-            return "male"
-        elif "female" in value or "woman" in value or "girl" in value:
-            return "female"
-        else:
-            return "unknown"
-
-    standardize_gender_udf = udf(spark_standardize_gender, StringType())
+    def spark_standardize_gender(column):
+        # Native Column expression, evaluated in the JVM instead of a Python UDF
+        value = lower(column)
+        return F.when(value.isNull(), F.lit("unknown")) \
+            .when(value.rlike("female|woman|girl"), F.lit("female")) \
+            .when(value.rlike("male|man|boy"), F.lit("male")) \
+            .otherwise(F.lit("unknown"))
 
     def spark_process_gender_column(data, column_name):
-        data = data.withColumn(column_name, spark_processing.standardize_gender_udf(lower(col(column_name))))
+        data = data.withColumn(column_name, spark_processing.spark_standardize_gender(col(column_name)))
 
-        indexer = StringIndexer(inputCol=column_name, outputCol=f'{column_name}')
+        indexer = StringIndexer(inputCol=column_name, outputCol=f'{column_name}_indexed')
         try:
             model = indexer.fit(data)
             gender_mapping = {value: index for index, value in enumerate(model.labels)}
+            data = model.transform(data).drop(column_name).withColumnRenamed(f'{column_name}_indexed', column_name)
             return data, gender_mapping
         except Exception as e:
             print(f"Error processing '{column_name}' column: {e}")
@@ -157,23 +165,29 @@ class spark_processing:
     def spark_scale_df(data):
         numeric_cols = [field.name for field in data.schema.fields if isinstance(field.dataType, (DoubleType, FloatType, IntegerType, LongType))]
 
-        for col_name in numeric_cols:
-            # Assemble the column into a vector
-            assembler = VectorAssembler(inputCols=[col_name], outputCol=f"{col_name}_vector")
-            data = assembler.transform(data)
+        if not numeric_cols:
+            return data
 
-            # Scale the vectorized column
-            scaler = sparkStandardScaler(inputCol=f"{col_name}_vector", outputCol=f"{col_name}_scaled_vector")
-            scaler_model = scaler.fit(data)
-            data = scaler_model.transform(data)
+        # Compute mean and standard deviation of every numeric column in a single aggregation
+        aggregations = []
+        for col_name in numeric_cols:
+            aggregations.append(F.mean(F.col(col_name)).alias(f"{col_name}__mean"))
+            aggregations.append(F.stddev_samp(F.col(col_name)).alias(f"{col_name}__std"))
+        stats = data.agg(*aggregations).first()
 
-            # Extract the scaled value from the vector and replace the original column
-            data = data.withColumn(col_name, F.col(f"{col_name}_scaled_vector")[0])
-            
-            # Drop intermediate vector columns
-            data = data.drop(f"{col_name}_vector", f"{col_name}_scaled_vector")
+        # Apply all scalings in one projection so the plan stays shallow
+        scaled_columns = []
+        for col_name in data.columns:
+            if col_name in numeric_cols:
+                mean = stats[f"{col_name}__mean"] or 0.0
+                std = stats[f"{col_name}__std"]
+                if not std:
+                    std = 1.0
+                scaled_columns.append(((F.col(col_name) - F.lit(mean)) / F.lit(std)).cast(DoubleType()).alias(col_name))
+            else:
+                scaled_columns.append(F.col(col_name))
 
-        return data
+        return data.select(*scaled_columns)
 
 class pandas_processing:
     def pandas_preprocessing_data(data, mode):
@@ -0,0 +1,351 @@
+import os
+import json
+import shutil
+import hashlib
+import sqlite3
+import time
+from functools import lru_cache
+from threading import Lock
+import numpy as np
+from dotenv import load_dotenv
+from langchain_core.embeddings import Embeddings
+from langchain_huggingface import HuggingFaceEmbeddings
+from utils.download_utils import directory_lock, publish_directory
+
+load_dotenv()
+
+EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+EMBED_THREADS = int(os.getenv("EMBED_THREADS", "0"))      # onnxruntime intra-op threads, 0 uses every core
+EMBED_QUERY_CACHE_SIZE = int(os.getenv("EMBED_QUERY_CACHE_SIZE", "1024"))
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", "/tmp/embedding_cache.sqlite")
+# Least recently used vectors beyond this many rows are deleted (about 1.5 KB each for MiniLM)
+EMBED_CACHE_MAX_ROWS = int(os.getenv("EMBED_CACHE_MAX_ROWS", "200000"))
+# Seconds a connection waits on another process's write lock before failing
+EMBED_CACHE_BUSY_TIMEOUT = float(os.getenv("EMBED_CACHE_BUSY_TIMEOUT", "30"))
+
+# "onnx" serves the int8-quantized ONNX export, "torch" the sentence-transformers model
+EMBED_BACKEND = os.getenv("EMBED_BACKEND", "onnx")
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", "/tmp/onnx_minilm")
+ONNX_MAX_LENGTH = 256
+ONNX_PARITY_MIN_COSINE = 0.98
+# Parity of the published export against the float model, so workers do not reload torch to recheck it
+ONNX_PARITY_FILE = "parity.json"
+PARITY_SENTENCES = [
+    "This dataset appears to contain structured information.",
+    "age: 42\nsex: 1\nincome: 53000.0\ntarget: 0",
+    "sepal_length: 5.1\nsepal_width: 3.5\npetal_length: 1.4\npetal_width: 0.2\nspecies: setosa",
+    "What is the average age of the customers?",
+]
+
+_embeddings = None
+_embeddings_lock = Lock()
+
+
+class VectorCache:
+    """
+    On-disk content-hash -> vector cache shared by every dataset and re-upload
+
+    The database is shared by every worker process, so it runs in WAL mode with a busy timeout, and it is
+    kept to max_rows by deleting the least recently used vectors after each write.
+
+    Parameters
+    - path: SQLite database file
+    - max_rows: number of vectors kept, 0 disables pruning
+    - busy_timeout: seconds to wait for another process's write lock
+    """
+    def __init__(self, path: str, max_rows=EMBED_CACHE_MAX_ROWS, busy_timeout=EMBED_CACHE_BUSY_TIMEOUT):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.max_rows = max_rows
+        self._lock = Lock()
+        self._conn = sqlite3.connect(path, timeout=busy_timeout, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(f"PRAGMA busy_timeout={int(busy_timeout * 1000)}")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS vectors (key TEXT PRIMARY KEY, vector BLOB, last_used REAL NOT NULL DEFAULT 0)")
+        # Caches written before last_used existed
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(vectors)")]
+        if "last_used" not in columns:
+            self._conn.execute("ALTER TABLE vectors ADD COLUMN last_used REAL NOT NULL DEFAULT 0")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS vectors_last_used ON vectors (last_used)")
+        self._conn.commit()
+
+    def get_many(self, keys: list[str]) -> dict:
+        found = {}
+        now = time.time()
+        with self._lock:
+            # Stay below SQLite's bound-parameter limit
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(f"SELECT key, vector FROM vectors WHERE key IN ({placeholders})", chunk).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+                if rows:
+                    self._conn.execute(f"UPDATE vectors SET last_used = ? WHERE key IN ({placeholders})", [now, *chunk])
+            self._conn.commit()
+        return found
+
+    def put_many(self, items: dict):
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO vectors (key, vector, last_used) VALUES (?, ?, ?)",
+                [(key, np.asarray(vector, dtype=np.float32).tobytes(), now) for key, vector in items.items()]
+            )
+            self._prune()
+            self._conn.commit()
+
+    def _prune(self):
+        # Must hold self._lock; runs in the same transaction as the write that grew the table
+        if self.max_rows <= 0:
+            return
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM vectors").fetchone()
+        if count > self.max_rows:
+            self._conn.execute(
+                "DELETE FROM vectors WHERE key IN (SELECT key FROM vectors ORDER BY last_used LIMIT ?)",
+                (count - self.max_rows,)
+            )
+
+
+class OnnxEmbeddings(Embeddings):
+    """
+    all-MiniLM-L6-v2 exported to ONNX with dynamic int8 quantization, run with onnxruntime on CPU
+
+    Mean pooling and L2 normalization reproduce the sentence-transformers output.
+
+    Parameters
+    - model_name: Hugging Face model id to export
+    - model_dir: where the exported and quantized model and tokenizer are kept
+    - batch_size: encode batch size
+    - num_threads: onnxruntime intra-op threads, 0 uses every available core
+    """
+    def __init__(self, model_name=EMBEDDING_MODEL_NAME, model_dir=ONNX_MODEL_DIR, batch_size=EMBED_BATCH_SIZE, num_threads=EMBED_THREADS):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        quantized_path = os.path.join(model_dir, "model_int8.onnx")
+        if not os.path.exists(quantized_path):
+            ensure_onnx_export(model_name, model_dir)
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.intra_op_num_threads = num_threads if num_threads > 0 else (os.cpu_count() or 1)
+        options.inter_op_num_threads = 1
+
+        self.model_name = f"{model_name}-onnx-int8"
+        self.batch_size = batch_size
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.session = ort.InferenceSession(quantized_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+    def _encode(self, texts: list[str]) -> np.ndarray:
+        outputs = []
+        for start in range(0, len(texts), self.batch_size):
+            encoded = self.tokenizer(texts[start:start + self.batch_size], padding=True, truncation=True,
+                                     max_length=ONNX_MAX_LENGTH, return_tensors="np")
+            feed = {name: value.astype(np.int64) for name, value in encoded.items() if name in self.input_names}
+            last_hidden_state = self.session.run(None, feed)[0]
+
+            # Mean pooling over real tokens, then L2 normalization
+            mask = encoded["attention_mask"][..., None].astype(np.float32)
+            pooled = (last_hidden_state * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            outputs.append(pooled)
+
+        return np.vstack(outputs) if outputs else np.zeros((0, 0), dtype=np.float32)
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self._encode(list(texts)).tolist()
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._encode([text])[0].tolist()
+
+
+def export_quantized_onnx(model_name=EMBEDDING_MODEL_NAME, model_dir=ONNX_MODEL_DIR):
+    """
+    Export the float model to ONNX and write a dynamically int8-quantized copy and the tokenizer next to it
+    """
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    os.makedirs(model_dir, exist_ok=True)
+    float_path = os.path.join(model_dir, "model.onnx")
+    quantized_path = os.path.join(model_dir, "model_int8.onnx")
+
+    print(f"[DEBUG] Exporting {model_name} to ONNX at {model_dir}")
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModel.from_pretrained(model_name).eval()
+
+    dummy = tokenizer(["export sample"], return_tensors="pt")
+    input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in dummy]
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            tuple(dummy[name] for name in input_names),
+            float_path,
+            input_names=input_names,
+            output_names=["last_hidden_state"],
+            dynamic_axes=dynamic_axes,
+            opset_version=14
+        )
+
+    quantize_dynamic(float_path, quantized_path, weight_type=QuantType.QInt8)
+    tokenizer.save_pretrained(model_dir)
+    print(f"[DEBUG] Quantized ONNX model saved: {quantized_path}")
+
+    return quantized_path
+
+
+def read_onnx_parity(model_dir=ONNX_MODEL_DIR):
+    """
+    Parity result stored with a published export, or None if there is no complete export
+    """
+    try:
+        with open(os.path.join(model_dir, ONNX_PARITY_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def ensure_onnx_export(model_name=EMBEDDING_MODEL_NAME, model_dir=ONNX_MODEL_DIR):
+    """
+    Make sure model_dir holds a complete export with its parity result, exporting it once per host
+
+    The export and its parity check run in a temporary directory that is swapped into place under
+    a file lock, so concurrent workers never load a half-written model; the others wait and reuse it.
+
+    Returns
+    - the stored parity result
+    """
+    parity = read_onnx_parity(model_dir)
+    if parity is not None:
+        return parity
+
+    with directory_lock(model_dir):
+        parity = read_onnx_parity(model_dir)
+        if parity is not None:
+            return parity
+
+        tmp_dir = f"{model_dir}.{os.getpid()}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        try:
+            export_quantized_onnx(model_name, tmp_dir)
+            passed, min_cos, mean_cos = check_onnx_parity(OnnxEmbeddings(model_name, tmp_dir), load_torch_embeddings(model_name))
+            parity = {"model_name": model_name, "passed": passed, "min_cosine": min_cos, "mean_cosine": mean_cos}
+            with open(os.path.join(tmp_dir, ONNX_PARITY_FILE), "w") as f:
+                json.dump(parity, f, indent=2)
+            publish_directory(tmp_dir, model_dir)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    return parity
+
+
+def check_onnx_parity(onnx_model, reference_model, texts=PARITY_SENTENCES, min_cosine=ONNX_PARITY_MIN_COSINE):
+    """
+    Compare the quantized ONNX embeddings against the float model
+
+    Returns
+    - (passed, min_cosine_similarity, mean_cosine_similarity)
+    """
+    onnx_vectors = np.asarray(onnx_model.embed_documents(texts), dtype=np.float32)
+    reference_vectors = np.asarray(reference_model.embed_documents(texts), dtype=np.float32)
+
+    onnx_vectors /= np.linalg.norm(onnx_vectors, axis=1, keepdims=True)
+    reference_vectors /= np.linalg.norm(reference_vectors, axis=1, keepdims=True)
+    cosines = (onnx_vectors * reference_vectors).sum(axis=1)
+
+    return bool(cosines.min() >= min_cosine), float(cosines.min()), float(cosines.mean())
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embedding backend wrapped with a disk cache for documents and an LRU cache for queries
+
+    Parameters
+    - model: LangChain embeddings backend (sentence-transformers or ONNX)
+    - model_name: name used in cache keys, so vectors of different backends never mix
+    - query_cache_size: number of query embeddings kept in memory
+    - cache_path: SQLite file for the content-hash -> vector cache, None disables it
+    """
+    def __init__(self, model, model_name, query_cache_size=EMBED_QUERY_CACHE_SIZE, cache_path=EMBED_CACHE_PATH):
+        self.model_name = model_name
+        self.model = model
+        self.vector_cache = VectorCache(cache_path) if cache_path else None
+        self._embed_query_cached = lru_cache(maxsize=query_cache_size)(self._embed_query)
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha1(f"{self.model_name}\n{text}".encode("utf-8")).hexdigest()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        if self.vector_cache is None:
+            return self.model.embed_documents(texts)
+
+        keys = [self._key(text) for text in texts]
+        cached = self.vector_cache.get_many(list(set(keys)))
+
+        # Encode each distinct uncached text once
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached and key not in missing:
+                missing[key] = text
+
+        if missing:
+            vectors = self.model.embed_documents(list(missing.values()))
+            new_vectors = dict(zip(missing.keys(), vectors))
+            self.vector_cache.put_many(new_vectors)
+            cached.update(new_vectors)
+
+        return [cached[key] for key in keys]
+
+    def _embed_query(self, text: str) -> tuple:
+        return tuple(self.model.embed_query(text))
+
+    def embed_query(self, text: str) -> list[float]:
+        return list(self._embed_query_cached(text))
+
+    def cache_info(self):
+        return self._embed_query_cached.cache_info()
+
+
+def load_torch_embeddings(model_name=EMBEDDING_MODEL_NAME, batch_size=EMBED_BATCH_SIZE):
+    # torch's thread pool is process-wide and shared with LoRA generation, so it is left at its default here
+    return HuggingFaceEmbeddings(model_name=model_name, encode_kwargs={"batch_size": batch_size})
+
+
+def load_embedding_backend():
+    """
+    Pick the ONNX int8 backend when it is available and matches the float model, else sentence-transformers
+    """
+    if EMBED_BACKEND == "onnx":
+        try:
+            # Checked once when the model is exported; later processes reuse the stored result
+            parity = ensure_onnx_export()
+            min_cos, mean_cos = parity["min_cosine"], parity["mean_cosine"]
+            print(f"[DEBUG] ONNX embedding parity: min cosine {min_cos:.4f}, mean cosine {mean_cos:.4f}")
+
+            if min_cos >= ONNX_PARITY_MIN_COSINE:
+                onnx_model = OnnxEmbeddings()
+                return onnx_model, onnx_model.model_name
+            print("[ERROR] ONNX embeddings failed the parity check. Using the sentence-transformers model.")
+        except Exception as e:
+            print(f"[ERROR] ONNX embedding backend unavailable ({e}). Using the sentence-transformers model.")
+
+    return load_torch_embeddings(), EMBEDDING_MODEL_NAME
+
+
+def get_embeddings() -> CachedEmbeddings:
+    """
+    Process-wide embedding model, loaded once and shared by indexing and QA
+    """
+    global _embeddings
+    with _embeddings_lock:
+        if _embeddings is None:
+            print(f"[DEBUG] Loading embedding model {EMBEDDING_MODEL_NAME} (backend: {EMBED_BACKEND})")
+            model, model_name = load_embedding_backend()
+            _embeddings = CachedEmbeddings(model, model_name)
+        return _embeddings
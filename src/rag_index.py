@@ -1,27 +1,43 @@
 import os
+import re
+import json
+import hashlib
+import tempfile
 import pandas as pd
+from queue import Queue, Full
+from threading import Thread, RLock, Event
+import chromadb
 from dotenv import load_dotenv
 from langchain_community.vectorstores import Chroma
-from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_community.docstore.document import Document
 from models.common import load_file
+from models.classification_models import preprocess
+from rag_embeddings import get_embeddings
+from utils.text_utils import format_rows
+from utils.hash_utils import hash_dataframe
+from utils.download_utils import directory_lock
 
 load_dotenv()
 
 CHROMA_PATH = os.getenv("CHROMA_PATH", "./chroma_db")
-EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
 
-def df_to_docs(df: pd.DataFrame) -> list[Document]:
+DOC_BATCH_SIZE = int(os.getenv("DOC_BATCH_SIZE", "1000"))
+
+# filename -> collection name of the currently indexed version of that file
+REGISTRY_PATH = os.path.join(CHROMA_PATH, "collections.json")
+
+_chroma_client = None
+_chroma_lock = RLock()
+_vectordbs = {}
+
+def summary_doc(df: pd.DataFrame) -> Document:
     """
-    Converting row including numeric, categorical, and date types into natural language text
+    Dataset-level summary placed before the row documents
     """
-    docs = []
-
-    # Add dataset-level summary at the beginning
     summary_parts = [
         "This dataset appears to contain structured information.",
         f"It has {df.shape[0]} rows and {df.shape[1]} columns.",
-        "Here are the columns: " + ", ".join(df.columns)
+        "Here are the columns: " + ", ".join(map(str, df.columns))
     ]
 
     # Add sample row preview
@@ -32,24 +48,292 @@ def df_to_docs(df: pd.DataFrame) -> list[Document]:
         pass
 
     summary_text = "\n".join(summary_parts)
-    docs.append(Document(page_content=summary_text))
+    return Document(page_content=summary_text, metadata={"row_id": -1, "doc_type": "profile", "column": ""})
+
+def detect_target(df: pd.DataFrame):
+    try:
+        target = preprocess.find_target_column(df)
+    except Exception:
+        return None
+    if isinstance(target, list):
+        target = target[0] if target else None
+    return target if target in df.columns else None
+
+def _format_value(value) -> str:
+    if isinstance(value, float):
+        return f"{value:.4g}"
+    return str(value)
+
+def profile_docs(df: pd.DataFrame) -> list[Document]:
+    """
+    Compact per-column profile documents (dtype, missing rate, quantiles, top categories,
+    correlation with the detected target), computed with whole-frame operations
+    """
+    docs = [summary_doc(df)]
+    target = detect_target(df)
+
+    missing_rate = df.isna().mean()
+    numeric = df.select_dtypes(include="number")
+    categorical_cols = df.columns.difference(numeric.columns)
+
+    quantiles = numeric.quantile([0.0, 0.25, 0.5, 0.75, 1.0]) if not numeric.empty else None
+    means = numeric.mean()
+    stds = numeric.std()
+
+    correlations = None
+    if target is not None and not numeric.empty:
+        target_values = df[target]
+        if not pd.api.types.is_numeric_dtype(target_values):
+            target_values = target_values.astype("category").cat.codes
+        correlations = numeric.corrwith(target_values)
+
+    overview = [f"Dataset profile: {df.shape[0]} rows, {df.shape[1]} columns."]
+    overview.append(f"Detected target column: {target}." if target is not None else "No clear target column detected.")
+    overview.append("Columns: " + ", ".join(f"{col} ({df[col].dtype})" for col in df.columns))
+    most_missing = missing_rate[missing_rate > 0].sort_values(ascending=False).head(5)
+    if not most_missing.empty:
+        overview.append("Missing values: " + ", ".join(f"{col} {rate:.1%}" for col, rate in most_missing.items()))
+    else:
+        overview.append("There are no missing values.")
+    if correlations is not None:
+        strongest = correlations.drop(labels=[target], errors="ignore").abs().sort_values(ascending=False).head(5)
+        overview.append(f"Strongest correlations with {target}: " + ", ".join(f"{col} {correlations[col]:.3f}" for col in strongest.index))
+    docs.append(Document(page_content="\n".join(overview), metadata={"row_id": -1, "doc_type": "profile", "column": ""}))
+
+    for col in numeric.columns:
+        q = quantiles[col]
+        parts = [
+            f"Column {col} ({df[col].dtype}) profile:",
+            f"missing {missing_rate[col]:.1%}, mean {_format_value(means[col])}, std {_format_value(stds[col])},",
+            f"min {_format_value(q[0.0])}, 25% {_format_value(q[0.25])}, median {_format_value(q[0.5])}, 75% {_format_value(q[0.75])}, max {_format_value(q[1.0])}."
+        ]
+        if correlations is not None and col != target and pd.notna(correlations.get(col)):
+            parts.append(f"Correlation with target {target}: {correlations[col]:.3f}.")
+        docs.append(Document(page_content=" ".join(parts), metadata={"row_id": -1, "doc_type": "profile", "column": str(col)}))
+
+    for col in categorical_cols:
+        counts = df[col].value_counts(normalize=True, dropna=True)
+        top = ", ".join(f"{value} ({share:.1%})" for value, share in counts.head(5).items())
+        parts = [
+            f"Column {col} ({df[col].dtype}) profile:",
+            f"missing {missing_rate[col]:.1%}, {counts.size} distinct values.",
+            f"Top values: {top}."
+        ]
+        if col == target:
+            parts.append("This is the detected target column.")
+        docs.append(Document(page_content=" ".join(parts), metadata={"row_id": -1, "doc_type": "profile", "column": str(col)}))
 
-    for _, row in df.iterrows():
-        # Converting column names and their values to natural language text
-        content = "\n".join([f"{col}: {row[col]}" for col in df.columns])
-        docs.append(Document(page_content=content))
-    
     return docs
 
+def iter_doc_batches(df: pd.DataFrame, batch_size: int = DOC_BATCH_SIZE):
+    """
+    Yield lists of Documents: the dataset profile first, then batch_size rows at a time with row-id metadata
+    """
+    yield profile_docs(df)
+
+    for start in range(0, len(df), batch_size):
+        chunk = df.iloc[start:start + batch_size]
+        contents = format_rows(chunk)
+        yield [
+            Document(page_content=content, metadata={"row_id": row_id, "doc_type": "row"})
+            for row_id, content in zip(range(start, start + len(chunk)), contents.tolist())
+        ]
+
+def prefetch(iterable, depth: int = 2, put_timeout: float = 0.5):
+    """
+    Run a generator on a background thread so the consumer can work on one item while the next is produced
+
+    If the consumer stops early or raises, the producer notices within put_timeout seconds and exits,
+    releasing the generator (and the data it references).
+    """
+    queue = Queue(maxsize=depth)
+    done = object()
+    stop = Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=put_timeout)
+                return True
+            except Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except Exception as e:
+            put(e)
+        finally:
+            put(done)
+
+    Thread(target=produce, daemon=True).start()
+
+    try:
+        while True:
+            item = queue.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+def df_to_docs(df: pd.DataFrame) -> list[Document]:
+    """
+    Converting row including numeric, categorical, and date types into natural language text
+    """
+    return [doc for batch in iter_doc_batches(df) for doc in batch]
+
+def get_chroma_client():
+    """
+    Process-wide persistent Chroma client
+    """
+    global _chroma_client
+    with _chroma_lock:
+        if _chroma_client is None:
+            _chroma_client = chromadb.PersistentClient(path=CHROMA_PATH)
+        return _chroma_client
+
+def dataset_hash(df: pd.DataFrame) -> str:
+    """
+    Content hash of the dataset; a changed file with the same name gets a new collection
+    """
+    return hash_dataframe(df)
+
+def collection_name_for(filename: str, content_hash: str) -> str:
+    """
+    Chroma collection name for a (filename, content hash) pair (3-63 chars of [a-zA-Z0-9._-])
+    """
+    stem = re.sub(r"[^a-zA-Z0-9_-]", "_", os.path.splitext(os.path.basename(filename))[0]).strip("_-")
+    return f"ds_{stem[:40]}_{content_hash[:16]}"
+
+def doc_id(content: str) -> str:
+    """
+    Deterministic document id derived from the row text
+    """
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+def _load_registry() -> dict:
+    try:
+        with open(REGISTRY_PATH, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def _save_registry(registry: dict):
+    # Callers hold directory_lock(CHROMA_PATH); readers see either the old or the new file
+    os.makedirs(CHROMA_PATH, exist_ok=True)
+    with tempfile.NamedTemporaryFile("w", dir=CHROMA_PATH, suffix=".tmp", delete=False) as f:
+        json.dump(registry, f, indent=2)
+    os.replace(f.name, REGISTRY_PATH)
+
+def get_collection_name(filename: str):
+    """
+    Name of the collection currently indexed for an uploaded file, or None
+    """
+    return _load_registry().get(os.path.basename(filename))
+
+def get_vectordb(filename: str):
+    """
+    LangChain Chroma store over the collection of one uploaded file
+    """
+    collection_name = get_collection_name(filename)
+    if collection_name is None:
+        raise ValueError(f"No vector index found for {filename}")
+
+    with _chroma_lock:
+        if collection_name not in _vectordbs:
+            _vectordbs[collection_name] = Chroma(client=get_chroma_client(), collection_name=collection_name,
+                                                 embedding_function=get_embeddings())
+        return _vectordbs[collection_name]
+
+def _upsert_batch(collection, previous, batch, embedding_function):
+    # Duplicate rows share an id, keep the first occurrence
+    docs_by_id = {}
+    for doc in batch:
+        docs_by_id.setdefault(doc_id(doc.page_content), doc)
+    ids = list(docs_by_id)
+
+    existing = set(collection.get(ids=ids, include=[])["ids"])
+    missing = [i for i in ids if i not in existing]
+    if not missing:
+        return 0, 0
+
+    # Rows unchanged since the previous version of this file reuse their stored embeddings
+    reused = 0
+    if previous is not None:
+        found = previous.get(ids=missing, include=["embeddings"])
+        if found["ids"]:
+            collection.upsert(
+                ids=found["ids"],
+                embeddings=found["embeddings"],
+                documents=[docs_by_id[i].page_content for i in found["ids"]],
+                metadatas=[docs_by_id[i].metadata for i in found["ids"]]
+            )
+            reused = len(found["ids"])
+            found_ids = set(found["ids"])
+            missing = [i for i in missing if i not in found_ids]
+
+    if missing:
+        texts = [docs_by_id[i].page_content for i in missing]
+        collection.upsert(
+            ids=missing,
+            embeddings=embedding_function.embed_documents(texts),
+            documents=texts,
+            metadatas=[docs_by_id[i].metadata for i in missing]
+        )
+
+    return len(missing), reused
+
 def create_vectorstore_from_s3(file_key: str):
     """
-    Import the dataset, convert it into a sentence, and embed it in Chroma
+    Import the dataset, convert it into a sentence, and embed it in its own Chroma collection
+
+    Only rows that are not already stored (by content id) are embedded, so re-indexing
+    an unchanged file costs a hash and an id lookup per batch.
     """
     df, _ = load_file(file_key)
-    documents = df_to_docs(df)
+    filename = os.path.basename(file_key)
+    collection_name = collection_name_for(filename, dataset_hash(df))
+
+    client = get_chroma_client()
+    collection = client.get_or_create_collection(collection_name)
+
+    previous_name = get_collection_name(filename)
+    previous = None
+    if previous_name and previous_name != collection_name:
+        try:
+            previous = client.get_collection(previous_name)
+        except Exception:
+            previous = None
+
+    embedding_function = get_embeddings()
+
+    embedded, reused = 0, 0
+    # Embedding starts on the first batch while the next one is being formatted
+    for batch in prefetch(iter_doc_batches(df)):
+        batch_embedded, batch_reused = _upsert_batch(collection, previous, batch, embedding_function)
+        embedded += batch_embedded
+        reused += batch_reused
+    print(f"[DEBUG] Indexed {filename} into {collection_name}: {embedded} embedded, {reused} reused")
+
+    # The registry and the collections are shared by every worker process, so the swap is done under a host-wide lock
+    with _chroma_lock, directory_lock(CHROMA_PATH):
+        registry = _load_registry()
+        # Re-read: another worker may have indexed a newer version of this file since previous_name was looked up
+        replaced_name = registry.get(filename)
+        registry[filename] = collection_name
+        _save_registry(registry)
 
-    embedding_function = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_NAME)
-    vectordb = Chroma.from_documents(documents, embedding=embedding_function, persist_directory=CHROMA_PATH)
-    vectordb.persist()
+        if replaced_name and replaced_name != collection_name:
+            try:
+                client.delete_collection(replaced_name)
+            except Exception:
+                pass
+            _vectordbs.pop(replaced_name, None)
 
-    return vectordb
+    return get_vectordb(filename)
@@ -1,22 +1,46 @@
 import os
 from dotenv import load_dotenv
-from langchain_chroma import Chroma
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_huggingface import HuggingFacePipeline
 from langchain.chains import LLMChain
 from langchain.prompts import PromptTemplate
 from langchain.schema.output_parser import StrOutputParser
 from langchain_core.runnables import RunnableLambda, RunnableMap
 from langchain_core.output_parsers import StrOutputParser
-from transformers import pipeline, AutoTokenizer, GPT2LMHeadModel,TextGenerationPipeline, GPT2Config
-from lora_train import get_finedtuned_model_path
+from lora_train import get_finedtuned_model_path, read_training_key
+from lora_serving import adapter_name_for, load_adapter, unload_adapter, adapter_size_bytes, get_llm_pipeline, hold_adapter, release_adapter
+from rag_index import get_vectordb
+from rag_router import route_question
+from generation_scheduler import get_scheduler
+from utils.cache_utils import BoundedLRUCache
 import wordninja
+from threading import Event
+from contextlib import contextmanager
 import re
 import unicodedata
 
 load_dotenv()
+
+# Bounds for the lazy-load cache; each entry holds one LoRA adapter on the shared base model
+QA_CACHE_MAX_ENTRIES = int(os.getenv("QA_CACHE_MAX_ENTRIES", "16"))
+QA_CACHE_MAX_BYTES = int(os.getenv("QA_CACHE_MAX_BYTES", "0"))
+
+def pipeline_size_bytes(entry) -> int:
+    """
+    Memory held by the LoRA adapter of a cached (chain, pipeline, adapter_name) entry
+    """
+    return adapter_size_bytes(entry[2])
+
+def release_pipeline(key, entry):
+    # Free the adapter weights once no request is using them; the shared base model stays resident
+    unload_adapter(entry[2])
+
 # Lazy-load cache
-_qa_pipeline = {}
+_qa_pipeline = BoundedLRUCache(
+    max_entries=QA_CACHE_MAX_ENTRIES,
+    max_bytes=QA_CACHE_MAX_BYTES,
+    size_fn=pipeline_size_bytes,
+    on_evict=release_pipeline,
+    name="qa_pipeline"
+)
 
 CUSTOM_TEMPLATE = """You are a helpful AI assistant. Use the context below to answer the user's question.
 
@@ -35,51 +59,47 @@ prompt = PromptTemplate(
 
 
 def get_qa_pipeline(filename: str, model_choice: str):
-    global _qa_pipeline
-    key = f"{filename}_{model_choice}"
-    if key in _qa_pipeline:
-        return _qa_pipeline[key]
+    # The training key changes when the file is re-uploaded with new content, so a stale adapter is not reused
+    training_key = read_training_key(get_finedtuned_model_path(filename, model_choice)) or "untracked"
+    key = f"{filename}_{model_choice}_{training_key[:12]}"
+    pair = _qa_pipeline.get_or_load(key, lambda: load_qa_pipeline(filename, model_choice, key))
+    print(f"[DEBUG] QA pipeline cache: {_qa_pipeline.stats()}")
+    return pair
 
+@contextmanager
+def qa_pipeline_in_use(filename: str, model_choice: str):
+    """
+    QA pipeline whose adapter stays attached until the block exits, even if the cache evicts it meanwhile
+    """
+    pair = get_qa_pipeline(filename, model_choice)
+    if pair is not None and not hold_adapter(pair[2]):
+        # Evicted and unloaded between the cache lookup and the hold; the next lookup loads it again
+        pair = get_qa_pipeline(filename, model_choice)
+        if pair is not None and not hold_adapter(pair[2]):
+            raise RuntimeError(f"LoRA adapter {pair[2]} was unloaded while loading")
+    try:
+        yield pair
+    finally:
+        if pair is not None:
+            release_adapter(pair[2])
+
+def load_qa_pipeline(filename: str, model_choice: str, key: str):
     try:
         print("[DEBUG] Loading RAG pipeline")
 
-        model_path = get_finedtuned_model_path(filename, model_choice)
-        tokenizer_path = os.path.join(model_path, "_tokenizer")
-        
-        if not os.path.isdir(model_path):
-            raise ValueError(f"Model path {model_path} is not a directory. Cannot load locally.")
+        adapter_path = get_finedtuned_model_path(filename, model_choice)
         
-        HF_CACHE = "/tmp/hf_cache"
+        if not os.path.isdir(adapter_path):
+            raise ValueError(f"Model path {adapter_path} is not a directory. Cannot load locally.")
 
-        print("[DEBUG] Loading tokenizer...")
-        
-        model = GPT2LMHeadModel.from_pretrained( 
-            pretrained_model_name_or_path=model_path,
-            cache_dir=HF_CACHE,
-            local_files_only=True,
-            trust_remote_code=True,
-            use_safetensors=True
-        )
-        model.to("cpu")
-
-        tokenizer = AutoTokenizer.from_pretrained(tokenizer_path, cache_dir=HF_CACHE, use_fast=False, local_files_only=True, add_prefix_space=True)
-
-        llm_pipeline = TextGenerationPipeline(
-            model=model,
-            tokenizer=tokenizer,
-            max_new_tokens=200,
-            do_sample=True,
-            temperature=0.7,
-            top_p=0.95,
-            clean_up_tokenization_spaces=True,
-            return_full_text=False
-        )
-
-        print("[DEBUG] Testing pipeline output...")
-        test_out = llm_pipeline("Hello, world!")
-        print("[DEBUG] llm_pipeline output:", test_out)
-
-        llm = HuggingFacePipeline(pipeline=llm_pipeline, model_id=None)
+        # Only the LoRA adapter is loaded per dataset; the base model is shared
+        adapter_name = adapter_name_for(key)
+        load_adapter(adapter_name, adapter_path)
+        llm_pipeline = get_llm_pipeline(adapter_name)
+
+        # Generation goes through the scheduler so concurrent questions share one batched forward pass
+        # Looked up per call, so a restarted scheduler is picked up
+        llm = RunnableLambda(lambda prompt_value: get_scheduler().submit(adapter_name, prompt_value.to_string()))
         
         def parse_output(x):
             if isinstance(x, list):
@@ -95,16 +115,9 @@ def get_qa_pipeline(filename: str, model_choice: str):
             "question": lambda x: x["question"]
         }) | prompt | llm | RunnableLambda(parse_output)
 
-        EMBED_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
-        CHROMA_PATH = os.getenv("CHROMA_PATH", "./chroma_db")
-        embedding_function = HuggingFaceEmbeddings(model_name=EMBED_MODEL_NAME)
-        vectordb = Chroma(persist_directory=CHROMA_PATH, embedding_function=embedding_function)
-
-
-        _qa_pipeline[key] = (chain, vectordb)
-
         print("✅ QA Pipeline loaded successfully.")
-        return _qa_pipeline[key]
+        # The raw pipeline is kept for token streaming, which bypasses the chain
+        return (chain, llm_pipeline, adapter_name)
 
     except Exception as e:
         print(f"❌ Failed to load QA pipeline: {e}")
@@ -133,19 +146,59 @@ def clean_response(text: str) -> str:
 
     return text.strip()
     
+# L2 distance under which a profile document is close enough to answer on its own
+PROFILE_MAX_DISTANCE = float(os.getenv("PROFILE_MAX_DISTANCE", "1.0"))
+
+# Seconds to wait for the next streamed token before giving up
+STREAM_TOKEN_TIMEOUT = float(os.getenv("STREAM_TOKEN_TIMEOUT", "60"))
+
+def retrieve_context(vectordb, query: str, k: int = 4):
+    """
+    Prefer the compact dataset profile documents; fall back to row documents when none match
+    """
+    try:
+        profile_hits = vectordb.similarity_search_with_score(query, k=2, filter={"doc_type": "profile"})
+    except Exception as e:
+        print(f"[ERROR] Profile search failed: {e}")
+        profile_hits = []
+
+    if profile_hits and profile_hits[0][1] <= PROFILE_MAX_DISTANCE:
+        return [doc for doc, _ in profile_hits]
+
+    return vectordb.similarity_search(query, k=k)
+
 def run_qa(query: str, filename: str, model_choice: str) -> str:
     """
     Create a RAG QA response to a user's question
     """
     print(f"[DEBUG] run_qa() called with filename={filename}, model_choice={model_choice}")
+
+    # Aggregate, filter and count questions are answered from the dataset itself
+    try:
+        routed = route_question(query, filename)
+        if routed is not None:
+            print(f"[DEBUG] Answered by structured retrieval: {routed}")
+            return routed
+    except Exception as e:
+        print(f"[ERROR] Structured retrieval failed, falling back to vector search: {e}")
+
     print("[DEBUG] Running get_qa_pipeline()")
-    pair = get_qa_pipeline(filename, model_choice)
+    with qa_pipeline_in_use(filename, model_choice) as pair:
+        return answer_with_pipeline(pair, query, filename)
 
+def answer_with_pipeline(pair, query: str, filename: str) -> str:
     if pair is None:
         return "QA pipeline is not ready"
     
-    chain, vectordb = pair
-    relevant_docs = vectordb.similarity_search(query, k=4)
+    chain, _, _ = pair
+    
+    # Search only the collection of this dataset
+    try:
+        vectordb = get_vectordb(filename)
+    except ValueError as e:
+        return f"RAG error: {str(e)}"
+
+    relevant_docs = retrieve_context(vectordb, query)
     context = "\n".join([doc.page_content for doc in relevant_docs])
 
     try:
@@ -155,3 +208,51 @@ def run_qa(query: str, filename: str, model_choice: str) -> str:
     except Exception as e:
         print(f"Error during RAG invoke: {e}")
         return f"RAG error: {str(e)}"
+
+
+def stream_qa(query: str, filename: str, model_choice: str, stop_event: Event = None):
+    """
+    Yield the RAG answer piece by piece as tokens are generated
+
+    Structured answers are yielded in one piece. Setting stop_event (or closing the
+    generator) stops generation at the next token.
+    """
+    stop_event = stop_event or Event()
+
+    try:
+        routed = route_question(query, filename)
+        if routed is not None:
+            yield routed
+            return
+    except Exception as e:
+        print(f"[ERROR] Structured retrieval failed, falling back to vector search: {e}")
+
+    # The adapter stays attached until the stream ends, even if the cache evicts it meanwhile
+    with qa_pipeline_in_use(filename, model_choice) as pair:
+        yield from stream_with_pipeline(pair, query, filename, stop_event)
+
+def stream_with_pipeline(pair, query: str, filename: str, stop_event: Event):
+    if pair is None:
+        yield "QA pipeline is not ready"
+        return
+    _, _, adapter_name = pair
+
+    try:
+        vectordb = get_vectordb(filename)
+    except ValueError as e:
+        yield f"RAG error: {str(e)}"
+        return
+
+    context = "\n".join([doc.page_content for doc in retrieve_context(vectordb, query)])
+
+    # Streams share micro-batches with /ask requests; the scheduler keeps the end of an over-long prompt
+    pieces = get_scheduler().stream(adapter_name, prompt.format(context=context, question=query),
+                                    stop_event=stop_event, timeout=STREAM_TOKEN_TIMEOUT)
+    try:
+        for text in pieces:
+            if text:
+                yield unicodedata.normalize("NFKC", text)
+    finally:
+        # Reached on completion and on client disconnect (GeneratorExit)
+        stop_event.set()
+        pieces.close()
@@ -0,0 +1,247 @@
+import re
+import os
+import pandas as pd
+from models.common import load_file, s3, S3_BUCKET_NAME
+from utils.cache_utils import BoundedLRUCache
+
+# Aggregate keyword -> pandas reduction
+AGGREGATES = [
+    (r"\b(average|mean|avg)\b", "mean"),
+    (r"\b(median)\b", "median"),
+    (r"\b(maximum|max|highest|largest|biggest|oldest)\b", "max"),
+    (r"\b(minimum|min|lowest|smallest|youngest)\b", "min"),
+    (r"\b(sum|total)\b", "sum"),
+    (r"\b(standard deviation|std|stdev)\b", "std"),
+    (r"\b(unique|distinct)\b", "nunique"),
+]
+COUNT_PATTERN = r"\b(how many|count|number of)\b"
+
+# Comparison phrase -> operator
+OPERATORS = [
+    (r">=|at least|greater than or equal to", ">="),
+    (r"<=|at most|less than or equal to", "<="),
+    (r">|greater than|more than|above|over|older than", ">"),
+    (r"<|less than|fewer than|below|under|younger than", "<"),
+    (r"==|=|equal to|equals|is", "=="),
+]
+
+# Bounds for the parsed datasets kept for structured answers
+DATASET_CACHE_MAX_ENTRIES = int(os.getenv("DATASET_CACHE_MAX_ENTRIES", "8"))
+DATASET_CACHE_MAX_BYTES = int(os.getenv("DATASET_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+# Words and symbols that signal a filter; if none could be parsed, an unfiltered answer would be wrong
+FILTER_HINT_PATTERN = (r"[<>=]|\d|\b(where|whose|with|between|at least|at most|greater|less|more|fewer|"
+                       r"above|below|over|under|older|younger|equal|equals|not)\b")
+TRUE_VALUES = {"true", "yes", "1"}
+FALSE_VALUES = {"false", "no", "0"}
+
+
+def dataset_size_bytes(dataset) -> int:
+    df = dataset["df"]
+    return int(df.memory_usage(deep=True).sum()) if df is not None else 0
+
+
+_datasets = BoundedLRUCache(
+    max_entries=DATASET_CACHE_MAX_ENTRIES,
+    max_bytes=DATASET_CACHE_MAX_BYTES,
+    size_fn=dataset_size_bytes,
+    name="router_datasets"
+)
+
+
+def load_dataset(file_key: str) -> dict:
+    """
+    Parsed dataset entry; Spark-sized files are recorded without a dataframe so they are not reloaded
+    """
+    df, mode = load_file(file_key)
+    if mode != "pandas":
+        return {"mode": mode, "df": None, "stats": None}
+    return {"mode": mode, "df": df, "stats": column_statistics(df)}
+
+
+def get_dataset(filename: str):
+    """
+    Uploaded dataset and its per-column statistics, loaded once per file content
+
+    The cache key includes the S3 ETag, so a re-upload under the same name is loaded again.
+    Returns None for Spark-sized files, which are only answered through vector search.
+    """
+    file_key = f"uploaded/{os.path.basename(filename)}"
+    etag = s3.head_object(Bucket=S3_BUCKET_NAME, Key=file_key)["ETag"].strip('"')
+    dataset = _datasets.get_or_load(f"{filename}:{etag}", lambda: load_dataset(file_key))
+    if dataset["df"] is None:
+        return None
+    return dataset["df"], dataset["stats"]
+
+
+def column_statistics(df: pd.DataFrame) -> dict:
+    """
+    Per-column statistics computed once, used for unfiltered aggregate questions
+    """
+    stats = {}
+    numeric = df.select_dtypes(include="number")
+    if not numeric.empty:
+        described = numeric.agg(["count", "mean", "median", "std", "min", "max", "sum", "nunique"])
+        for col in numeric.columns:
+            stats[col] = described[col].to_dict()
+
+    for col in df.columns.difference(numeric.columns):
+        counts = df[col].value_counts(dropna=True)
+        stats[col] = {
+            "count": int(df[col].notna().sum()),
+            "nunique": int(counts.size),
+            "top": counts.head(10).to_dict(),
+        }
+    return stats
+
+
+def _normalize(text: str) -> str:
+    # A "-" directly before a digit is a minus sign, not a word separator
+    return re.sub(r"_+|-+(?!\d)", " ", str(text)).lower().strip()
+
+
+def find_columns(question: str, df: pd.DataFrame) -> list:
+    """
+    Columns mentioned in the question, longest names first so "petal length" wins over "length"
+    """
+    q = _normalize(question)
+    found = []
+    for col in sorted(df.columns, key=lambda c: -len(str(c))):
+        name = _normalize(col)
+        if name and re.search(rf"\b{re.escape(name)}\b", q) and not any(name in _normalize(f) for f in found):
+            found.append(col)
+    return found
+
+
+def find_filter(question: str, df: pd.DataFrame, columns: list):
+    """
+    Parse a single "<column> <operator> <value>" condition, or a bare category value such as "female"
+    """
+    q = _normalize(question)
+    for col in columns:
+        name = re.escape(_normalize(col))
+        for phrase, op in OPERATORS:
+            match = re.search(rf"\b{name}\s*(?:{phrase})\s*([-+]?\d*\.?\d+|[\w\s]+?)(?:\?|$|,| and )", q)
+            if match:
+                return col, op, match.group(1).strip()
+
+    # Bare category values, e.g. "how many female passengers"
+    for col in df.select_dtypes(exclude="number").columns:
+        for value in df[col].dropna().astype(str).unique()[:50]:
+            if len(value) > 1 and re.search(rf"\b{re.escape(value.lower())}\b", q):
+                return col, "==", value
+    return None
+
+
+def has_filter_hint(question: str, columns: list) -> bool:
+    """
+    True if the question seems to restrict the rows (comparison words or numbers outside column names)
+    """
+    q = _normalize(question)
+    for col in columns:
+        q = q.replace(_normalize(col), " ")
+    return re.search(FILTER_HINT_PATTERN, q) is not None
+
+
+def apply_filter(df: pd.DataFrame, condition):
+    col, op, value = condition
+    series = df[col]
+
+    if pd.api.types.is_bool_dtype(series):
+        value = str(value).lower()
+        if op != "==" or value not in TRUE_VALUES | FALSE_VALUES:
+            return None
+        return df[series == (value in TRUE_VALUES)]
+
+    if pd.api.types.is_numeric_dtype(series):
+        try:
+            value = float(value)
+        except ValueError:
+            return None
+    else:
+        series = series.astype(str).str.lower()
+        value = str(value).lower()
+        if op != "==":
+            return None
+
+    ops = {">=": series >= value, "<=": series <= value, ">": series > value, "<": series < value, "==": series == value}
+    return df[ops[op]]
+
+
+def _format(value) -> str:
+    if isinstance(value, float):
+        return f"{value:.4g}"
+    return str(value)
+
+
+def route_question(question: str, filename: str):
+    """
+    Answer aggregate, filter and count questions directly from the dataset
+
+    Returns
+    - answer text, or None when the question should go to vector search
+    """
+    q = question.lower()
+    aggregate = next((agg for pattern, agg in AGGREGATES if re.search(pattern, q)), None)
+    is_count = re.search(COUNT_PATTERN, q) is not None
+
+    if aggregate is None and not is_count:
+        return None
+
+    dataset = get_dataset(filename)
+    if dataset is None:
+        return None
+    df, stats = dataset
+
+    columns = find_columns(question, df)
+    condition = find_filter(question, df, columns)
+    subset = df
+    condition_text = ""
+
+    # e.g. "average age of passengers older than 30": a filter this parser missed must not be ignored
+    if condition is None and has_filter_hint(question, columns):
+        return None
+
+    if condition is not None:
+        subset = apply_filter(df, condition)
+        if subset is None:
+            return None
+        condition_text = f" where {condition[0]} {condition[1]} {condition[2]}"
+        # The filtered column is not the one being aggregated
+        columns = [c for c in columns if c != condition[0]] or columns
+
+    if is_count and aggregate != "nunique":
+        # Without a parsed condition the question is about something this router cannot see
+        # (e.g. "how many customers churned"); retrieval answers it better than a row count
+        if condition is None:
+            return None
+        return f"{len(subset)} of {len(df)} rows match{condition_text}."
+
+    if not columns:
+        return None
+    col = columns[0]
+
+    if aggregate == "nunique":
+        value = subset[col].nunique() if condition is not None else stats[col]["nunique"]
+        return f"{col} has {value} distinct values{condition_text}."
+
+    if pd.api.types.is_bool_dtype(df[col]):
+        # The mean of a boolean column is the share of True values, the sum their count
+        if aggregate not in ("mean", "sum"):
+            return None
+        value = getattr(subset[col].astype(int), aggregate)()
+        return f"The {aggregate} of {col}{condition_text} is {_format(value)} (over {len(subset)} rows)."
+
+    if not pd.api.types.is_numeric_dtype(df[col]):
+        if aggregate in ("max", "min") or condition is not None:
+            return None
+        top = stats[col]["top"]
+        most_common = ", ".join(f"{k} ({v})" for k, v in list(top.items())[:5])
+        return f"{col} is categorical; the most common values are {most_common}."
+
+    if condition is None:
+        value = stats[col][aggregate]
+    else:
+        value = getattr(subset[col], aggregate)()
+
+    return f"The {aggregate} of {col}{condition_text} is {_format(value)} (over {len(subset)} rows)."
@@ -0,0 +1,265 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock
+from utils.logger_utils import logger
+from lora_train import run_training_job
+
+# Number of LoRA trainings that may run at once across all web workers; the cores are split evenly between them
+LORA_MAX_CONCURRENT_JOBS = int(os.getenv("LORA_MAX_CONCURRENT_JOBS", "1"))
+# Job records shared by every web worker on this host (one JSON file per job)
+LORA_JOB_DIR = os.getenv("LORA_JOB_DIR", "/tmp/lora_jobs")
+# Finished jobs are forgotten after this many seconds
+LORA_JOB_TTL = int(os.getenv("LORA_JOB_TTL", str(24 * 3600)))
+LORA_SLOT_POLL_SECONDS = 5
+
+ACTIVE_STATUSES = ("queued", "running")
+
+
+@contextmanager
+def _file_lock(path):
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _registry_lock(job_dir):
+    return _file_lock(os.path.join(job_dir, "registry.lock"))
+
+
+def _job_path(job_dir, job_id):
+    return os.path.join(job_dir, f"{job_id}.json")
+
+
+def _read_job(job_dir, job_id):
+    try:
+        with open(_job_path(job_dir, job_id), "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def _write_job(job_dir, job):
+    path = _job_path(job_dir, job["job_id"])
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(job, f)
+    os.replace(tmp_path, path)
+
+
+def _update_job(job_dir, job_id, **fields):
+    with _registry_lock(job_dir):
+        job = _read_job(job_dir, job_id)
+        if job is None:
+            return None
+        job.update(fields)
+        _write_job(job_dir, job)
+        return job
+
+
+def _pid_alive(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+@contextmanager
+def _training_slot(job_dir, max_jobs):
+    '''
+    Hold one of max_jobs host-wide slot locks for the duration of a training; waits until one is free
+    '''
+    handles = [open(os.path.join(job_dir, f"slot-{i}.lock"), "a") for i in range(max_jobs)]
+    try:
+        while True:
+            for handle in handles:
+                try:
+                    fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                try:
+                    yield
+                finally:
+                    fcntl.flock(handle, fcntl.LOCK_UN)
+                return
+            time.sleep(LORA_SLOT_POLL_SECONDS)
+    finally:
+        for handle in handles:
+            handle.close()
+
+
+def run_scheduled_job(job_dir, max_jobs, job_id, s3_path, filename, model_choice, num_threads):
+    '''
+    Entry point of a training process: waits for a free slot, runs the job and records its outcome
+
+    The slot locks are released by the kernel if the process dies, so a crashed job never holds a slot.
+    '''
+    _update_job(job_dir, job_id, worker_pid=os.getpid())
+    with _training_slot(job_dir, max_jobs):
+        _update_job(job_dir, job_id, status="running", started=time.time())
+        try:
+            training_key = run_training_job(s3_path, filename, model_choice, num_threads, job_id)
+        except Exception as e:
+            _update_job(job_dir, job_id, status="failed", finished=time.time(), error=str(e))
+            raise
+        # Readiness checks compare the published adapter against this key
+        _update_job(job_dir, job_id, status="done", finished=time.time(), training_key=training_key)
+
+
+class TrainingScheduler:
+    '''
+    Runs LoRA training jobs in separate processes with a fixed host-wide concurrency
+
+    Job state lives in job_dir, so every gunicorn worker sees the same jobs: a (filename, model_choice,
+    dataset_version) triple that is already queued or running in any worker is not submitted again, and the
+    existing job id is returned. A re-upload with new content under the same name is a new job. At most max_jobs trainings run at once on the host (file-lock slots); others wait as "queued".
+    Each worker process handles a single job, so its memory is returned to the OS afterwards.
+
+    Parameters
+    - max_jobs: Maximum number of concurrent training processes on the host
+    - job_dir: Directory for the shared job records and locks
+    - ttl: Seconds after which finished jobs are forgotten
+    '''
+    def __init__(self, max_jobs=LORA_MAX_CONCURRENT_JOBS, job_dir=LORA_JOB_DIR, ttl=LORA_JOB_TTL):
+        self.max_jobs = max(1, max_jobs)
+        self.job_dir = job_dir
+        self.ttl = ttl
+        self.threads_per_job = max(1, (os.cpu_count() or 1) // self.max_jobs)
+        os.makedirs(self.job_dir, exist_ok=True)
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.max_jobs,
+            # spawn: never fork the web worker with its live threads; one job per process
+            mp_context=multiprocessing.get_context("spawn"),
+            max_tasks_per_child=1
+        )
+        self._lock = Lock()
+        self._futures = {}    # job_id -> Future, for jobs submitted by this web worker
+
+    def _jobs(self):
+        jobs = []
+        for name in os.listdir(self.job_dir):
+            if name.endswith(".json"):
+                job = _read_job(self.job_dir, name[:-len(".json")])
+                if job is not None:
+                    jobs.append(job)
+        return jobs
+
+    def _reconcile(self, job):
+        '''
+        Mark a queued/running job as failed if the web worker that owns it has exited; must hold the registry lock
+        '''
+        if job["status"] in ACTIVE_STATUSES and not _pid_alive(job["owner_pid"]):
+            job.update(status="failed", finished=time.time(), error="Web worker exited before the job finished")
+            _write_job(self.job_dir, job)
+        return job
+
+    def _prune(self):
+        '''
+        Delete finished jobs older than the TTL; must hold the registry lock
+        '''
+        now = time.time()
+        for job in self._jobs():
+            job = self._reconcile(job)
+            if job["status"] not in ACTIVE_STATUSES and now - (job["finished"] or now) > self.ttl:
+                try:
+                    os.remove(_job_path(self.job_dir, job["job_id"]))
+                except FileNotFoundError:
+                    pass
+                with self._lock:
+                    self._futures.pop(job["job_id"], None)
+
+    def submit(self, s3_path, filename, model_choice, dataset_version=None):
+        '''
+        Queue a training, or return the id of an active job for the same file content and model
+
+        Parameters
+        - dataset_version: content version of the uploaded file (its S3 ETag)
+        '''
+        with _registry_lock(self.job_dir):
+            self._prune()
+            for job in self._jobs():
+                if (job["filename"], job["model_choice"], job.get("dataset_version")) == (filename, model_choice, dataset_version) \
+                        and job["status"] in ACTIVE_STATUSES:
+                    logger.info(f"Training for {filename} ({model_choice}) already {job['status']}: {job['job_id']}")
+                    return job["job_id"]
+
+            job_id = uuid.uuid4().hex
+            _write_job(self.job_dir, {
+                "job_id": job_id,
+                "filename": filename,
+                "model_choice": model_choice,
+                "dataset_version": dataset_version,
+                "status": "queued",
+                "submitted": time.time(),
+                "started": None,
+                "finished": None,
+                "error": None,
+                "owner_pid": os.getpid(),
+                "worker_pid": None,
+                "training_key": None,
+            })
+
+        future = self._executor.submit(run_scheduled_job, self.job_dir, self.max_jobs, job_id,
+                                       s3_path, filename, model_choice, self.threads_per_job)
+        with self._lock:
+            self._futures[job_id] = future
+        future.add_done_callback(lambda f: self._on_done(job_id, f))
+        logger.info(f"Queued training job {job_id} for {filename} ({model_choice})")
+        return job_id
+
+    def _on_done(self, job_id, future):
+        with self._lock:
+            self._futures.pop(job_id, None)
+
+        error = future.exception()
+        if error is not None:
+            job = self.status(job_id)
+            # The job records its own failure; this covers a process that died before it could (e.g. OOM kill)
+            if job is not None and job["status"] in ACTIVE_STATUSES:
+                job = _update_job(self.job_dir, job_id, status="failed", finished=time.time(), error=str(error))
+            logger.error(f"Training job {job_id} failed: {error}")
+        else:
+            job = self.status(job_id)
+            if job is not None and job["finished"]:
+                logger.info(f"Training job {job_id} finished in {job['finished'] - job['submitted']:.0f}s")
+
+    def status(self, job_id):
+        with _registry_lock(self.job_dir):
+            job = _read_job(self.job_dir, job_id)
+            return self._reconcile(job) if job is not None else None
+
+    def find(self, filename, model_choice):
+        '''
+        Most recent job for a (filename, model_choice) pair, submitted by any web worker
+        '''
+        with _registry_lock(self.job_dir):
+            matches = [job for job in self._jobs()
+                       if job["filename"] == filename and job["model_choice"] == model_choice]
+            if not matches:
+                return None
+            return self._reconcile(max(matches, key=lambda job: job["submitted"]))
+
+
+_scheduler = None
+_scheduler_lock = Lock()
+
+
+def get_training_scheduler() -> TrainingScheduler:
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = TrainingScheduler()
+        return _scheduler
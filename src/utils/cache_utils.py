@@ -0,0 +1,122 @@
+import gc
+from collections import OrderedDict
+from threading import Lock
+from utils.logger_utils import logger
+
+
+class BoundedLRUCache:
+    '''
+    Thread-safe LRU cache bounded by entry count and/or estimated size in bytes
+
+    Each key is loaded at most once at a time: concurrent callers asking for the same
+    missing key wait on a per-key lock instead of loading it again.
+
+    Parameters
+    - max_entries: Maximum number of cached entries (0 = unlimited)
+    - max_bytes: Maximum total size reported by size_fn (0 = unlimited)
+    - size_fn: Function returning the size of a value in bytes
+    - on_evict: Function called with (key, value) after a value is evicted
+    - name: Name used in log messages
+    '''
+    def __init__(self, max_entries=0, max_bytes=0, size_fn=None, on_evict=None, name="cache"):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size_fn = size_fn or (lambda value: 0)
+        self.on_evict = on_evict
+        self.name = name
+
+        self._entries = OrderedDict()    # key -> (value, size)
+        self._total_bytes = 0
+        self._lock = Lock()
+        self._key_locks = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+        return None
+
+    def get_or_load(self, key, loader):
+        '''
+        Return the cached value for key, calling loader() once on a miss
+
+        A loader returning None is not cached, so the next call retries.
+        '''
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        with self._lock:
+            # [lock, number of callers holding or waiting on it]; the lock is dropped only when nobody uses it,
+            # so callers arriving after a failed load wait on the same lock as the ones already queued
+            key_lock = self._key_locks.setdefault(key, [Lock(), 0])
+            key_lock[1] += 1
+
+        try:
+            with key_lock[0]:
+                # Another thread may have finished loading while we waited
+                value = self.get(key)
+                if value is not None:
+                    return value
+
+                with self._lock:
+                    self.misses += 1
+
+                value = loader()
+                if value is not None:
+                    self.put(key, value)
+                return value
+        finally:
+            with self._lock:
+                key_lock[1] -= 1
+                if key_lock[1] == 0:
+                    self._key_locks.pop(key, None)
+
+    def put(self, key, value):
+        size = self.size_fn(value)
+        evicted = []
+
+        with self._lock:
+            if key in self._entries:
+                self._total_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self._total_bytes += size
+
+            # Never evict the entry that was just added
+            while len(self._entries) > 1 and self._over_limit():
+                old_key, (old_value, old_size) = self._entries.popitem(last=False)
+                self._total_bytes -= old_size
+                self.evictions += 1
+                evicted.append((old_key, old_value))
+
+        for old_key, old_value in evicted:
+            logger.info(f"[{self.name}] Evicted {old_key}")
+            if self.on_evict is not None:
+                self.on_evict(old_key, old_value)
+        if evicted:
+            del old_value
+            evicted.clear()
+            gc.collect()
+
+    def _over_limit(self):
+        if self.max_entries and len(self._entries) > self.max_entries:
+            return True
+        if self.max_bytes and self._total_bytes > self.max_bytes:
+            return True
+        return False
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -1,12 +1,250 @@
 import os
 import io
+import json
+import math
+import fnmatch
+import fcntl
+import hashlib
 import shutil
 import boto3
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from botocore.exceptions import NoCredentialsError
 import zipfile
 import pickle
 from utils.logger_utils import logger
-from huggingface_hub import snapshot_download
+from huggingface_hub import snapshot_download, HfApi
+
+# A published model directory records what it was downloaded from in this file
+MANIFEST_FILE = ".manifest.json"
+# Manifest of the download in progress, kept in the staging directory so it can be resumed
+PENDING_MANIFEST_FILE = ".pending.json"
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "8"))
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DOWNLOAD_CHUNK_SIZE", str(8 * 1024 * 1024)))
+MB = 1024 * 1024
+
+
+@contextmanager
+def directory_lock(local_dir):
+    """
+    Exclusive lock on local_dir shared by every process on the host (gunicorn workers, training processes)
+
+    Held while a directory is staged and published, so only one process fills its staging directory.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(local_dir)), exist_ok=True)
+    with open(f"{local_dir}.lock", "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _read_manifest(directory, name=MANIFEST_FILE):
+    try:
+        with open(os.path.join(directory, name)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _write_manifest(directory, manifest, name=MANIFEST_FILE):
+    path = os.path.join(directory, name)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def _file_digest(path, algorithm, block_size=MB):
+    digest = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _multipart_etag(path, part_size):
+    part_digests = []
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(part_size), b""):
+            part_digests.append(hashlib.md5(block).digest())
+    return f"{hashlib.md5(b''.join(part_digests)).hexdigest()}-{len(part_digests)}"
+
+def verify_etag(path, size, etag):
+    """
+    Check a downloaded file against its S3 ETag
+
+    Returns
+    - True or False, or None when the ETag cannot be reproduced (multipart upload with an unknown part size)
+    """
+    if "-" not in etag:
+        return _file_digest(path, "md5") == etag
+
+    # A multipart ETag is the md5 of the part md5s; S3 does not record the part size, so try the usual ones
+    parts = int(etag.split("-")[1])
+    candidates = {8 * MB, 5 * MB, 16 * MB, 64 * MB, 100 * MB, math.ceil(size / parts / MB) * MB}
+    for part_size in sorted(candidates):
+        if math.ceil(size / part_size) == parts and _multipart_etag(path, part_size) == etag:
+            return True
+    return None
+
+def verify_file(path, entry):
+    """
+    Check a downloaded file against its manifest entry (size, and sha256 or S3 ETag when known)
+    """
+    if not os.path.isfile(path) or os.path.getsize(path) != entry["size"]:
+        return False
+    if entry.get("sha256"):
+        return _file_digest(path, "sha256") == entry["sha256"]
+    if entry.get("etag"):
+        verified = verify_etag(path, entry["size"], entry["etag"])
+        if verified is None:
+            logger.warning(f"Could not reproduce multipart ETag of {path}; checked size only")
+        return verified is not False
+    return True
+
+def is_artifact_complete(local_dir, manifest=None):
+    """
+    True if local_dir was published from a verified download (of manifest, when given) and no file has changed size since
+    """
+    recorded = _read_manifest(local_dir)
+    if recorded is None or (manifest is not None and recorded != manifest):
+        return False
+    return all(
+        os.path.isfile(os.path.join(local_dir, name)) and os.path.getsize(os.path.join(local_dir, name)) == entry["size"]
+        for name, entry in recorded.items()
+    )
+
+def publish_directory(staging_dir, local_dir):
+    """
+    Swap a fully downloaded staging directory into place, so loaders never see a partial model
+
+    Not atomic: between the two renames local_dir does not exist. Callers hold directory_lock(local_dir),
+    so processes that check the directory under the same lock wait for the swap. A loader reading local_dir
+    without the lock can get FileNotFoundError in that window, or old and new files if its reads span the swap.
+    """
+    shutil.rmtree(os.path.join(staging_dir, ".chunks"), ignore_errors=True)
+    old_dir = f"{local_dir}.old"
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(local_dir):
+        os.replace(local_dir, old_dir)
+    os.replace(staging_dir, local_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+def s3_manifest(s3, bucket, prefix, required_files=None):
+    """
+    Size and ETag of every artifact file under prefix, keyed by path relative to prefix
+    """
+    manifest = {}
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            key = obj["Key"]
+            filename = os.path.basename(key)
+            if not filename or filename.startswith(".") or key.endswith("/"):
+                continue
+            if required_files is not None and filename not in required_files:
+                continue
+            manifest[os.path.relpath(key, prefix)] = {"key": key, "size": obj["Size"], "etag": obj["ETag"].strip('"')}
+    return manifest
+
+def _download_range(s3, bucket, entry, start, end, chunk_path):
+    # Chunks that were fully written before an interruption are kept
+    if os.path.exists(chunk_path) and os.path.getsize(chunk_path) == end - start + 1:
+        return
+    # IfMatch fails the request if the object was replaced since it was listed
+    response = s3.get_object(Bucket=bucket, Key=entry["key"], Range=f"bytes={start}-{end}", IfMatch=f'"{entry["etag"]}"')
+    with open(f"{chunk_path}.tmp", "wb") as f:
+        shutil.copyfileobj(response["Body"], f)
+    os.replace(f"{chunk_path}.tmp", chunk_path)
+
+def _assemble(chunk_dir, chunk_count, dest_path):
+    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+    with open(f"{dest_path}.tmp", "wb") as out:
+        for i in range(chunk_count):
+            with open(os.path.join(chunk_dir, f"{i:06d}"), "rb") as f:
+                shutil.copyfileobj(f, out)
+    os.replace(f"{dest_path}.tmp", dest_path)
+    shutil.rmtree(chunk_dir, ignore_errors=True)
+
+def fetch_s3_artifacts(s3, bucket, prefix, local_dir, required_files=None, max_workers=DOWNLOAD_WORKERS, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """
+    Download a model directory from S3 with concurrent ranged GETs, verify it and publish it atomically
+
+    Files are fetched in chunk_size ranges into local_dir + ".partial"; chunks already on disk from
+    an interrupted run are reused as long as the object's ETag has not changed. Processes fetching
+    the same local_dir take turns on a file lock, and later ones reuse the published result.
+
+    Parameters
+    - s3: boto3 S3 client
+    - bucket: S3 bucket name
+    - prefix: path of the model inside the bucket
+    - local_dir: directory the model is published to
+    - required_files: optional set of file names to download; if None, download all found files
+
+    Returns
+    - True if files were downloaded, False if local_dir was already up to date
+    """
+    manifest = s3_manifest(s3, bucket, prefix, required_files)
+    if not manifest:
+        raise FileNotFoundError(f"No model files found in S3 path: {prefix}")
+    if is_artifact_complete(local_dir, manifest):
+        logger.info(f"Model at {local_dir} matches s3://{bucket}/{prefix}")
+        return False
+
+    with directory_lock(local_dir):
+        # Another process may have published it while we waited for the lock
+        if is_artifact_complete(local_dir, manifest):
+            logger.info(f"Model at {local_dir} was published by another process")
+            return False
+        _stage_s3_artifacts(s3, bucket, prefix, manifest, local_dir, max_workers, chunk_size)
+    logger.info(f"Model published to {local_dir}")
+    return True
+
+def _stage_s3_artifacts(s3, bucket, prefix, manifest, local_dir, max_workers, chunk_size):
+    # Callers hold directory_lock(local_dir), so the staging directory has a single writer
+    staging_dir = f"{local_dir}.partial"
+    os.makedirs(staging_dir, exist_ok=True)
+
+    # Drop staged data for files that changed on S3 since the interrupted download
+    pending = _read_manifest(staging_dir, PENDING_MANIFEST_FILE) or {}
+    for name, entry in manifest.items():
+        if pending.get(name) != entry:
+            shutil.rmtree(os.path.join(staging_dir, ".chunks", name), ignore_errors=True)
+            if os.path.exists(os.path.join(staging_dir, name)):
+                os.remove(os.path.join(staging_dir, name))
+    _write_manifest(staging_dir, manifest, PENDING_MANIFEST_FILE)
+
+    ranges, to_assemble = [], []
+    for name, entry in manifest.items():
+        dest_path = os.path.join(staging_dir, name)
+        if os.path.isfile(dest_path) and os.path.getsize(dest_path) == entry["size"]:
+            continue
+        chunk_dir = os.path.join(staging_dir, ".chunks", name)
+        os.makedirs(chunk_dir, exist_ok=True)
+        chunk_count = max(1, math.ceil(entry["size"] / chunk_size))
+        if entry["size"] == 0:
+            open(os.path.join(chunk_dir, f"{0:06d}"), "wb").close()
+        else:
+            for i in range(chunk_count):
+                end = min((i + 1) * chunk_size, entry["size"]) - 1
+                ranges.append((entry, i * chunk_size, end, os.path.join(chunk_dir, f"{i:06d}")))
+        to_assemble.append((name, chunk_dir, chunk_count))
+
+    logger.info(f"Downloading {len(to_assemble)} of {len(manifest)} file(s) from s3://{bucket}/{prefix} in {len(ranges)} range(s)")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for future in [executor.submit(_download_range, s3, bucket, *r) for r in ranges]:
+            future.result()
+
+    for name, chunk_dir, chunk_count in to_assemble:
+        _assemble(chunk_dir, chunk_count, os.path.join(staging_dir, name))
+
+    for name, entry in manifest.items():
+        path = os.path.join(staging_dir, name)
+        if not verify_file(path, entry):
+            os.remove(path)
+            raise ValueError(f"Downloaded file failed verification: {name}")
+
+    os.remove(os.path.join(staging_dir, PENDING_MANIFEST_FILE))
+    _write_manifest(staging_dir, manifest)
+    publish_directory(staging_dir, local_dir)
 
 def download_llm_model_from_s3(S3_REGION, S3_BUCKET_NAME, s3_model_path, local_dir, required_files):
     """
@@ -19,54 +257,12 @@ def download_llm_model_from_s3(S3_REGION, S3_BUCKET_NAME, s3_model_path, local_d
     - local_dir: local directory to save model files (e.g. "/tmp/tinyllama_model")
     - required_files: optional set of file name to download; if None, download all found files
     """
-    from botocore.exceptions import ClientError
     logger.info(f"Checking if model exists at: {local_dir}")
 
-    if os.path.exists(local_dir) and len(os.listdir(local_dir)) > 0:
-        logger.info("Model already exists locally.")
-        return
-    
-    logger.info(f"Model not found locally. Downloading from S3: {s3_model_path}")
-
-    if os.path.exists(local_dir):
-        shutil.rmtree(local_dir)
-    
-    os.makedirs(local_dir, exist_ok=True)
-
     s3 = boto3.client('s3', region_name=S3_REGION, config=boto3.session.Config(signature_version='s3v4'))
 
     try:
-        response = s3.list_objects_v2(Bucket=S3_BUCKET_NAME, Prefix=s3_model_path)
-
-        if "Contents" not in response:
-            logger.error(f"No files found in S3 at {s3_model_path}")
-            return
-
-        for obj in response["Contents"]:
-            key = obj["Key"]
-            filename = os.path.basename(key)
-
-            if not filename or filename.startswith(".") or filename.endswith("/"):
-                continue
-
-            for obj in response["Contents"]:
-                key = obj["Key"]
-                logger.info(f"[S3] Found key: {key}")
-
-            if required_files is None or filename in required_files:
-                dest_path = os.path.join(local_dir, filename)
-                logger.info(f"files: {filename}")
-                
-                try:
-                    logger.debug(f"Downloading: {filename}")
-                    s3.download_file(S3_BUCKET_NAME, key, dest_path)
-                    logger.info("Completed to download the model")
-                except ClientError as e:
-                    logger.error(f"Failed to download {filename} from S3: {e}")
-
-        else:
-            logger.error(f"No model files found in S3 path: {s3_model_path}")
-    
+        fetch_s3_artifacts(s3, S3_BUCKET_NAME, s3_model_path, local_dir, required_files)
     except NoCredentialsError:
         print("AWS credentials not found! Run 'aws configure' or check environment.")
     except Exception as e:
@@ -108,7 +304,27 @@ def load_model_from_s3(s3_key, model_filename="model.pkl"):
         return None
 
 
+def hf_manifest(repo_id, allow_patterns):
+    """
+    Size (and sha256 for LFS files) of every file in a Hugging Face repo matching allow_patterns
+    """
+    info = HfApi().model_info(repo_id, files_metadata=True)
+    manifest = {}
+    for sibling in info.siblings:
+        if not any(fnmatch.fnmatch(sibling.rfilename, pattern) for pattern in allow_patterns):
+            continue
+        lfs = sibling.lfs
+        sha256 = lfs.get("sha256") if isinstance(lfs, dict) else getattr(lfs, "sha256", None)
+        manifest[sibling.rfilename] = {"size": sibling.size, "sha256": sha256}
+    return manifest
+
 def download_model_from_huggingface():
+    """
+    Make sure the distilgpt2 base model is in /tmp/distilgpt2, downloading it from the Hub if needed
+
+    Cheap when the model is already there, so loaders call it before every first use.
+    Raises if the model is missing and the Hub cannot be reached.
+    """
     HF_MODEL_ID = "distilgpt2"
     HF_LOCAL_DIR = "/tmp/distilgpt2"
 
@@ -120,20 +336,60 @@ def download_model_from_huggingface():
         "generation_config.json",
         "model.safetensors",
     ]
+    # Only the safetensors weights are loaded; vocab.json and merges.txt are needed by the slow tokenizer
+    ALLOW_PATTERNS = ["*.json", "*.txt", "model.safetensors"]
 
-    if all(os.path.exists(os.path.join(HF_LOCAL_DIR, f)) for f in REQUIRED_FILES):
+    # Warm start: a verified download is trusted without contacting the Hub (read-only, so no lock)
+    if is_artifact_complete(HF_LOCAL_DIR):
         print("[DEBUG] Model already fully exists. Skipping download.")
         return
 
+    # Every gunicorn worker and training process may get here; one at a time checks, verifies and downloads
+    with directory_lock(HF_LOCAL_DIR):
+        if is_artifact_complete(HF_LOCAL_DIR):
+            print("[DEBUG] Model was downloaded by another process. Skipping download.")
+            return
+
+        try:
+            manifest = hf_manifest(HF_MODEL_ID, ALLOW_PATTERNS)
+        except Exception as e:
+            if all(os.path.exists(os.path.join(HF_LOCAL_DIR, f)) for f in REQUIRED_FILES):
+                logger.warning(f"Could not fetch the model manifest ({e}); using the unverified model in {HF_LOCAL_DIR}")
+                return
+            raise
+
+        # A directory downloaded before manifests existed is verified once instead of downloaded again
+        if all(verify_file(os.path.join(HF_LOCAL_DIR, name), entry) for name, entry in manifest.items()):
+            _write_manifest(HF_LOCAL_DIR, manifest)
+            print("[DEBUG] Existing model verified. Skipping download.")
+            return
+
+        _stage_huggingface_model(HF_MODEL_ID, HF_LOCAL_DIR, ALLOW_PATTERNS, manifest)
+    print("[DEBUG] Model download complete.")
+
+def _stage_huggingface_model(repo_id, local_dir, allow_patterns, manifest):
+    # Callers hold directory_lock(local_dir), so the staging directory has a single writer
     print("[DEBUG] Downloading model from Hugging Face...")
     os.environ["HF_HUB_DISABLE_SYMLINKS_WARNING"] = "1" 
 
+    # Downloaded into a staging directory, which snapshot_download resumes after an interruption
+    staging_dir = f"{local_dir}.partial"
     snapshot_download(
-        repo_id=HF_MODEL_ID,
-        local_dir=HF_LOCAL_DIR,
+        repo_id=repo_id,
+        local_dir=staging_dir,
         local_dir_use_symlinks=False,
         resume_download=True,
-        max_workers=1,
-        ignore_patterns=["*.tflite", "*.ot", "*.mlmodel"],
+        max_workers=DOWNLOAD_WORKERS,
+        allow_patterns=allow_patterns,
     )
-    print("[DEBUG] Model download complete.")
\ No newline at end of file
+
+    for name, entry in manifest.items():
+        path = os.path.join(staging_dir, name)
+        if not verify_file(path, entry):
+            if os.path.exists(path):
+                os.remove(path)
+            raise ValueError(f"Downloaded file failed verification: {name}")
+
+    shutil.rmtree(os.path.join(staging_dir, ".cache"), ignore_errors=True)
+    _write_manifest(staging_dir, manifest)
+    publish_directory(staging_dir, local_dir)
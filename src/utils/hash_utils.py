@@ -0,0 +1,11 @@
+import hashlib
+import pandas as pd
+
+
+def hash_dataframe(df: pd.DataFrame) -> str:
+    '''
+    SHA-256 of a DataFrame's content and column names, independent of its index
+    '''
+    digest = hashlib.sha256(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    digest.update(",".join(map(str, df.columns)).encode("utf-8"))
+    return digest.hexdigest()
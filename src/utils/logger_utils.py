@@ -1,17 +1,263 @@
 import logging
-import io
+import logging.handlers
+import os
+import queue
+import shutil
+import atexit
+import itertools
+import time
+import uuid
+import contextvars
 import boto3
+from contextlib import contextmanager
+from collections import OrderedDict
+from threading import Thread
 from datetime import datetime
 
 S3_BUCKET_NAME = "ml-platform-service"
 s3 = boto3.client("s3")
 
-log_buffer = io.StringIO()
+# Per-job logs are spooled to disk and rotated by size, so memory use does not grow with log volume
+LOG_SPOOL_DIR = os.getenv("LOG_SPOOL_DIR", "/tmp/app_logs")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "3"))
+# Records logged while the queue is full are dropped rather than blocking the caller
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_MAX_OPEN_JOBS = 32
+# Seconds a ship request waits for room in a full queue before it is counted as dropped
+LOG_SHIP_PUT_TIMEOUT = 1.0
+# Spools of jobs that never ship (e.g. requests without a report) are deleted after this many idle seconds;
+# their records are still in the local log file
+LOG_SPOOL_IDLE_SECONDS = int(os.getenv("LOG_SPOOL_IDLE_SECONDS", "3600"))
+LOG_SPOOL_SWEEP_SECONDS = 60
+# Log name for records logged outside any request or job
+DEFAULT_LOG_NAME = "default_log"
+
+log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+_listener = None
+_segment_handler = None
+_queue_handler = None
+
+# (job id, log name) of the request or job running in the current thread/context
+log_context = contextvars.ContextVar("log_context", default=None)
+
+
+class UTCFormatter(logging.Formatter):
+    def formatTime(self, record, datefmt=None):
+        utc_dt = datetime.utcfromtimestamp(record.created)
+        return utc_dt.strftime('%Y-%m-%d %H:%M:%S')  # UTC 시간 저장
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    '''
+    QueueHandler that never blocks the logging thread; records are counted and dropped when the queue is full
+    '''
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def bind_log_context(log_name, job_id=None):
+    '''
+    Route records logged in the current context to the log of log_name
+
+    Returns
+    - token to pass to reset_log_context
+    '''
+    return log_context.set((job_id or uuid.uuid4().hex[:8], log_name))
+
+
+def reset_log_context(token):
+    try:
+        log_context.reset(token)
+    except ValueError:
+        # Token from another context (e.g. a response streamed after the request ended)
+        log_context.set(None)
+
+
+@contextmanager
+def job_log_context(log_name, job_id=None):
+    token = bind_log_context(log_name, job_id)
+    try:
+        yield
+    finally:
+        reset_log_context(token)
+
+
+def current_log_name():
+    context = log_context.get()
+    return context[1] if context else DEFAULT_LOG_NAME
+
+
+def current_job_id():
+    context = log_context.get()
+    return context[0] if context else "-"
+
+
+class LogContextFilter(logging.Filter):
+    '''
+    Stamp each record with the job id and log name of the context it was logged in, on the caller's thread
+    '''
+    def filter(self, record):
+        job_id, log_name = log_context.get() or ("-", DEFAULT_LOG_NAME)
+        record.job_id = job_id
+        if not hasattr(record, "log_name"):
+            record.log_name = log_name
+        return True
+
+
+def is_log_record(record):
+    # Ship requests travel through the queue to keep their order, but are not log lines
+    return not getattr(record, "ship_log", False)
+
+
+class S3SegmentHandler(logging.Handler):
+    '''
+    Spool records into one size-rotated file per job and ship them to S3 in the background
+
+    Runs on the QueueListener thread. A segment rotated out by size is uploaded as
+    logs/<name>_log.<job id>.<timestamp>-<n>.log and then deleted; a ship request uploads the job's
+    records since its last ship as logs/<name>_log.log and removes them from the spool, so a
+    log never carries records of earlier jobs for the same file. Uploads run on a single background thread.
+    Spools idle for LOG_SPOOL_IDLE_SECONDS are deleted, and the process's spool directory is removed on close.
+
+    Parameters
+    - spool_dir: Directory for the spool files (one subdirectory per process)
+    - max_bytes: Size at which a segment is rotated out and shipped
+    '''
+    def __init__(self, spool_dir=LOG_SPOOL_DIR, max_bytes=LOG_MAX_BYTES):
+        super().__init__()
+        self.spool_dir = os.path.join(spool_dir, str(os.getpid()))
+        self.max_bytes = max_bytes
+        self._spools = OrderedDict()    # job id -> RotatingFileHandler, least recently used first
+        self._segment_ids = itertools.count(1)
+        self._dropped_reported = 0
+        self._next_sweep = time.monotonic() + LOG_SPOOL_SWEEP_SECONDS
+        # A plain thread rather than an executor: executors refuse new work once interpreter shutdown begins,
+        # which is exactly when the last segments are shipped
+        self._uploads = queue.Queue()
+        self._uploader = Thread(target=self._upload_worker, daemon=True, name="log-upload")
+        self._uploader.start()
+        os.makedirs(self.spool_dir, exist_ok=True)
+
+    def _spool_path(self, job_id):
+        return os.path.join(self.spool_dir, f"{os.path.basename(str(job_id))}.log")
+
+    def _spool(self, job_id, name):
+        handler = self._spools.get(job_id)
+        if handler is None:
+            handler = logging.handlers.RotatingFileHandler(self._spool_path(job_id), maxBytes=self.max_bytes,
+                                                           backupCount=1, encoding='utf-8')
+            handler.setFormatter(self.formatter)
+            handler.rotator = lambda source, dest: self._ship_segment(job_id, name, source)
+            self._spools[job_id] = handler
+
+            # Close idle spool files; they are reopened in append mode on the next record
+            while len(self._spools) > LOG_MAX_OPEN_JOBS:
+                _, old_handler = self._spools.popitem(last=False)
+                old_handler.close()
+        self._spools.move_to_end(job_id)
+        return handler
+
+    def _close_spool(self, job_id):
+        handler = self._spools.pop(job_id, None)
+        if handler is not None:
+            handler.close()
+
+    def _ship_segment(self, job_id, name, source):
+        segment_id = next(self._segment_ids)
+        segment_path = f"{source}.{segment_id}"
+        os.replace(source, segment_path)
+        s3_key = f"logs/{name}_log.{job_id}.{datetime.utcnow().strftime('%Y%m%d%H%M%S')}-{segment_id}.log"
+        self._uploads.put((segment_path, s3_key))
+
+    def _report_dropped(self, job_id, name):
+        # Written into the job being shipped, so the gap is visible in the log it affects
+        dropped = _queue_handler.dropped if _queue_handler is not None else 0
+        if dropped > self._dropped_reported:
+            message = f"{dropped - self._dropped_reported} log record(s) dropped since the last ship because the log queue was full"
+            print(f"[WARNING] {message}")
+            self._spool(job_id, name).handle(logging.makeLogRecord({"levelno": logging.WARNING, "levelname": "WARNING", "msg": message}))
+            self._dropped_reported = dropped
+
+    def _sweep_idle_spools(self):
+        now = time.time()
+        for filename in os.listdir(self.spool_dir):
+            # Only active spools; rotated segments and shipped files belong to the uploader
+            if not filename.endswith(".log"):
+                continue
+            path = os.path.join(self.spool_dir, filename)
+            try:
+                if now - os.path.getmtime(path) > LOG_SPOOL_IDLE_SECONDS:
+                    self._close_spool(filename[:-len(".log")])
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _ship_current(self, job_id, name):
+        self._report_dropped(job_id, name)
+        self._close_spool(job_id)
+        path = self._spool_path(job_id)
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            print(f"[ERROR] Log file is empty! Check log writing process! ({name}, job {job_id})")
+            return
+        # The spool is handed to the uploader as is; later records of the job start a new spool
+        shipped_path = f"{path}.{next(self._segment_ids)}.shipped"
+        os.replace(path, shipped_path)
+        self._uploads.put((shipped_path, f"logs/{name}_log.log"))
+
+    def _upload_worker(self):
+        while True:
+            item = self._uploads.get()
+            if item is None:
+                return
+            path, s3_key = item
+            try:
+                s3.upload_file(path, S3_BUCKET_NAME, s3_key)
+                print(f"[DEBUG] Log uploaded to S3: {s3_key}")
+                os.remove(path)
+            except Exception as e:
+                # Not logged through the logger, which would feed back into this handler
+                print(f"[ERROR] Log upload to S3 failed ({s3_key}): {e}")
+
+    def emit(self, record):
+        try:
+            name = getattr(record, "log_name", DEFAULT_LOG_NAME)
+            job_id = getattr(record, "job_id", "-")
+            if getattr(record, "ship_log", False):
+                self._ship_current(job_id, name)
+            else:
+                self._spool(job_id, name).handle(record)
+
+            if time.monotonic() >= self._next_sweep:
+                self._next_sweep = time.monotonic() + LOG_SPOOL_SWEEP_SECONDS
+                self._sweep_idle_spools()
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        for handler in self._spools.values():
+            handler.close()
+        self._spools.clear()
+        self._uploads.put(None)
+        self._uploader.join()
+        dropped = _queue_handler.dropped if _queue_handler is not None else 0
+        if dropped > self._dropped_reported:
+            print(f"[WARNING] {dropped - self._dropped_reported} log record(s) dropped because the log queue was full")
+        # Everything worth shipping has been uploaded; unshipped records are still in the local log file
+        shutil.rmtree(self.spool_dir, ignore_errors=True)
+        super().close()
+
 
 def setup_global_logger(log_level=logging.DEBUG, log_filename='default_log'):
     '''
     Setup a global logger with the specified log file name and level.
-    If `s3` is provided, it will upload logs to S3.
+    Records are handed to a background QueueListener, which writes the size-rotated
+    local log file and the per-job spool files shipped to S3.
 
     Parameters:
     - log_level (int): Logging level (e.g., DEBUG, INFO)
@@ -19,49 +265,76 @@ def setup_global_logger(log_level=logging.DEBUG, log_filename='default_log'):
 
     Returns:
     - logger: Configured logger
-    - upload_log_to_s3: Function to upload log to S3
     '''
+    global _listener, _segment_handler, _queue_handler
+
     logger = logging.getLogger('AppLogger')
     logger.setLevel(log_level)
 
     for handler in logger.handlers[:]:
         logger.removeHandler(handler)
-
-    class UTCFormatter(logging.Formatter):
-        def formatTime(self, record, datefmt=None):
-            utc_dt = datetime.utcfromtimestamp(record.created)
-            return utc_dt.strftime('%Y-%m-%d %H:%M:%S')  # UTC 시간 저장
+    if _listener is not None:
+        _listener.stop()
+        _segment_handler.close()
 
     formatter = UTCFormatter('%(asctime)s - %(levelname)s - %(message)s')
 
-    # Memory Log Storage Handler
-    stream_handler = logging.StreamHandler(log_buffer)
-    stream_handler.setFormatter(formatter)
-    logger.addHandler(stream_handler)
+    # Log File Storage Handler; interleaves all jobs, so each line carries its job id
+    file_handler = logging.handlers.RotatingFileHandler(log_filename, mode='a', maxBytes=LOG_MAX_BYTES,
+                                                        backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+    file_handler.setFormatter(UTCFormatter('%(asctime)s - %(levelname)s - [%(job_id)s] - %(message)s'))
+    file_handler.addFilter(is_log_record)
 
-    # Log File Storage Handler
-    file_handler = logging.FileHandler(log_filename, mode='a', encoding='utf-8')
-    file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
-    
-    # Save log file name
-    logger.log_filename = log_filename
-    logger.log_buffer = log_buffer
+    # Per-job S3 Log Handler
+    _segment_handler = S3SegmentHandler()
+    _segment_handler.setFormatter(formatter)
 
+    # The caller only enqueues; formatting, file I/O and uploads happen on the listener thread
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(LogContextFilter())
+    logger.addHandler(queue_handler)
+    _queue_handler = queue_handler
+
+    _listener = logging.handlers.QueueListener(log_queue, file_handler, _segment_handler)
+    _listener.start()
+
+    logger.queue_handler = queue_handler
 
     return logger
 
-def upload_log_to_s3():
-    if log_buffer.getvalue():
-        log_content = log_buffer.getvalue()
-        log_buffer.seek(0)
 
-        s3_key = f"logs/{logger.log_filename}_log.log"
-        s3.put_object(Bucket=S3_BUCKET_NAME, Key=s3_key, Body=log_content)
+def upload_log_to_s3(log_name=None):
+    '''
+    Ship the records the current job logged since its last ship to S3 without waiting for the upload
+
+    The request goes through the log queue, so every record logged before this call is included.
+    If the queue stays full for LOG_SHIP_PUT_TIMEOUT seconds the request is dropped and counted like a
+    dropped record; the job's records stay in its spool and go out with its next ship.
+
+    Parameters
+    - log_name: Log to ship (default: the log of the current request or job)
+    '''
+    name = log_name or current_log_name()
+    try:
+        log_queue.put(logging.makeLogRecord({"ship_log": True, "log_name": name, "job_id": current_job_id(), "msg": ""}),
+                      timeout=LOG_SHIP_PUT_TIMEOUT)
+    except queue.Full:
+        if _queue_handler is not None:
+            _queue_handler.dropped += 1
+        print(f"[WARNING] Log queue full, upload of logs/{name}_log.log skipped")
+        return
+    print(f"[DEBUG] Log upload to S3 scheduled: logs/{name}_log.log")
+
+
+@atexit.register
+def shutdown_logging():
+    '''
+    Drain queued records and finish pending uploads; called at exit and by worker processes when a job ends
+    '''
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _segment_handler.close()
+        _listener = None
 
-        print(f"[DEBUG] Log uploaded to S3: {s3_key}")
-    
-    else:
-        print("[ERROR] Log file is empty! Check log writing process!")
-    
-logger = setup_global_logger()
\ No newline at end of file
+logger = setup_global_logger()
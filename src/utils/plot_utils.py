@@ -0,0 +1,212 @@
+import os
+import io
+import json
+import time
+import hashlib
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from utils.hash_utils import hash_dataframe
+
+# Kept free of Spark/model imports so spawned workers start quickly
+PLOT_CACHE_DIR = os.getenv("PLOT_CACHE_DIR", "/tmp/plot_cache")
+PLOT_WORKERS = int(os.getenv("PLOT_WORKERS", "2"))
+# Worker processes are only started when the figures to draw cover at least this many points in total;
+# below that, starting a spawned interpreter costs more than drawing inline
+PLOT_PARALLEL_MIN_POINTS = int(os.getenv("PLOT_PARALLEL_MIN_POINTS", "500000"))
+# The PNG cache is trimmed to this size (least recently used first) and files older than the max age are removed
+PLOT_CACHE_MAX_BYTES = int(os.getenv("PLOT_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+PLOT_CACHE_MAX_AGE_SECONDS = int(os.getenv("PLOT_CACHE_MAX_AGE_SECONDS", str(7 * 24 * 3600)))
+
+# Above SCATTER_MAX_POINTS rows the scatter is downsampled, above HEXBIN_THRESHOLD a density plot is drawn
+SCATTER_MAX_POINTS = 20000
+HEXBIN_THRESHOLD = 200000
+
+
+def hash_dataset(df):
+    '''
+    Content hash of a DataFrame, used as the first part of every plot cache key
+    '''
+    return hash_dataframe(df)
+
+
+def _cache_path(dataset_hash, kind, params):
+    key = json.dumps([dataset_hash, kind, params], sort_keys=True, default=str)
+    return os.path.join(PLOT_CACHE_DIR, f"{hashlib.sha256(key.encode('utf-8')).hexdigest()}.png")
+
+
+def _figure_to_png(fig):
+    FigureCanvasAgg(fig)
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png')
+    return buffer.getvalue()
+
+
+def render_elbow(params, data=None):
+    fig = Figure()
+    ax = fig.add_subplot()
+    wcss = params["wcss"]
+    ax.plot(range(1, len(wcss) + 1), wcss, marker='o')
+    ax.axvline(params["elbow_point"], color='b', linestyle='-')
+    ax.set_xlabel('Number of clusters')
+    ax.set_ylabel('WCSS')
+    ax.set_title(f'{params["file_name"]}_{params["threshold"]}_Elbow Method')
+    return _figure_to_png(fig)
+
+
+def render_silhouette(params, data=None):
+    fig = Figure()
+    ax = fig.add_subplot()
+    scores = params["scores"]
+    ax.plot(range(2, len(scores) + 2), scores, marker='o')
+    ax.axvline(params["optimal_clusters"], color='b', linestyle='-')
+    ax.set_xlabel('Number of clusters')
+    ax.set_ylabel('Silhouette Score')
+    ax.set_title(f'{params["file_name"]}_{params["threshold"]}_Silhouette Method')
+    return _figure_to_png(fig)
+
+
+def render_cluster_scatter(params, data):
+    '''
+    Scatter of the 2-D PCA projection colored by cluster label
+
+    Parameters
+    - params: file_name, algorithm and threshold used in the title
+    - data: tuple of (xy array with two columns, label array)
+    '''
+    xy, labels = data
+    fig = Figure()
+    ax = fig.add_subplot()
+    n_rows = len(labels)
+
+    if n_rows > HEXBIN_THRESHOLD:
+        hb = ax.hexbin(xy[:, 0], xy[:, 1], gridsize=60, bins='log', cmap='viridis')
+        fig.colorbar(hb, ax=ax, label='log10(count)')
+    else:
+        if n_rows > SCATTER_MAX_POINTS:
+            rng = np.random.default_rng(42)
+            keep = rng.choice(n_rows, size=SCATTER_MAX_POINTS, replace=False)
+            xy, labels = xy[keep], labels[keep]
+
+        scatter = ax.scatter(xy[:, 0], xy[:, 1], c=labels, cmap='tab10', s=10)
+        handles, legend_labels = scatter.legend_elements()
+        ax.legend(handles, legend_labels, title=f'{params["algorithm"]} Cluster')
+
+    ax.set_xlabel('0')
+    ax.set_ylabel('1')
+    ax.set_title(f'{params["file_name"]} {params["threshold"]} {params["algorithm"]} Cluster')
+    return _figure_to_png(fig)
+
+
+RENDERERS = {
+    "elbow": render_elbow,
+    "silhouette": render_silhouette,
+    "cluster_scatter": render_cluster_scatter,
+}
+
+
+def _render_points(kind, data):
+    # Only the cluster scatter grows with the dataset; line plots have a handful of points
+    if kind != "cluster_scatter":
+        return 0
+    return len(data[1])
+
+
+def prune_plot_cache(max_bytes=PLOT_CACHE_MAX_BYTES, max_age=PLOT_CACHE_MAX_AGE_SECONDS):
+    '''
+    Remove cached PNGs older than max_age, then the least recently used ones until the cache fits in max_bytes
+    '''
+    entries = []
+    now = time.time()
+    for name in os.listdir(PLOT_CACHE_DIR):
+        if not name.endswith(".png"):
+            continue
+        path = os.path.join(PLOT_CACHE_DIR, name)
+        try:
+            stat = os.stat(path)
+            if now - stat.st_mtime > max_age:
+                os.remove(path)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, path))
+        except FileNotFoundError:
+            # Removed by another worker
+            continue
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def _read_cached(path):
+    try:
+        with open(path, "rb") as f:
+            png = f.read()
+        # Cache hits count as use, so pruning removes the least recently used figures
+        os.utime(path)
+        return png
+    except FileNotFoundError:
+        return None
+
+
+def _render(kind, params, data, path):
+    png = RENDERERS[kind](params, data)
+
+    os.makedirs(PLOT_CACHE_DIR, exist_ok=True)
+    # Unique per call: gthread workers render inline from several threads of one process
+    with tempfile.NamedTemporaryFile(dir=PLOT_CACHE_DIR, suffix=".tmp", delete=False) as f:
+        f.write(png)
+    os.replace(f.name, path)
+
+    return png
+
+
+def render_plots(plot_jobs, dataset_hash, max_workers=PLOT_WORKERS):
+    '''
+    Render report figures, reusing cached PNGs and drawing the rest inline, or in worker
+    processes when they are large enough (PLOT_PARALLEL_MIN_POINTS) to pay for the process start
+
+    Parameters
+    - plot_jobs: list of (kind, params, data); params must be JSON-serializable and
+      together with dataset_hash fully determine the figure
+    - dataset_hash: content hash of the clustered dataset (see hash_dataset)
+    - max_workers: number of worker processes, 1 renders in the calling process
+
+    Returns
+    - list of BytesIO PNG buffers in the same order as plot_jobs
+    '''
+    results = [None] * len(plot_jobs)
+    pending = []
+
+    for i, (kind, params, data) in enumerate(plot_jobs):
+        path = _cache_path(dataset_hash, kind, params)
+        results[i] = _read_cached(path)
+        if results[i] is None:
+            pending.append((i, kind, params, data, path))
+
+    print(f"[DEBUG] Plot cache: {len(plot_jobs) - len(pending)} hit(s), {len(pending)} to render")
+
+    points = sum(_render_points(kind, data) for _, kind, _, data, _ in pending)
+    if len(pending) > 1 and max_workers > 1 and points >= PLOT_PARALLEL_MIN_POINTS:
+        # spawn avoids forking the web worker together with its Spark/py4j threads
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=min(max_workers, len(pending)), mp_context=context) as executor:
+            futures = [(i, executor.submit(_render, kind, params, data, path)) for i, kind, params, data, path in pending]
+            for i, future in futures:
+                results[i] = future.result()
+    else:
+        for i, kind, params, data, path in pending:
+            results[i] = _render(kind, params, data, path)
+
+    if pending:
+        prune_plot_cache()
+
+    return [io.BytesIO(png) for png in results]
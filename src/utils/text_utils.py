@@ -0,0 +1,12 @@
+import pandas as pd
+
+
+def format_rows(chunk: pd.DataFrame) -> pd.Series:
+    '''
+    Format every row of a DataFrame as "col: value" lines, one column at a time
+    '''
+    text = None
+    for col in chunk.columns:
+        part = f"{col}: " + chunk[col].astype(str)
+        text = part if text is None else text + "\n" + part
+    return text
@@ -0,0 +1,193 @@
+import os
+import io
+import sys
+import json
+import time
+import pstats
+import cProfile
+import resource
+import functools
+import contextvars
+from contextlib import contextmanager
+from reportlab.lib import colors
+from reportlab.platypus import Table, TableStyle
+from utils.logger_utils import logger
+
+# PROFILE=1 also runs every top-level span under cProfile and writes the stats to PROFILE_DIR
+PROFILE_ENABLED = os.getenv("PROFILE", "0") == "1"
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/profiles")
+PROFILE_TOP_N = 20
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def process_peak_rss_mb():
+    '''
+    Peak resident set size of this process so far, in MB
+
+    A process-wide high-water mark: it includes every earlier job and every concurrent request
+    in the worker, so it is not the memory used by one job or stage.
+    '''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+class Span:
+    '''
+    One timed stage of a job; spans opened inside it become its children
+
+    Parameters
+    - name: Stage name
+    - rows: Number of rows the stage worked on, if known (can be set later)
+    - attrs: Extra JSON-serializable fields recorded with the span
+    '''
+    def __init__(self, name, rows=None, **attrs):
+        self.name = name
+        self.rows = rows
+        self.attrs = attrs
+        self.children = []
+        self.start = time.perf_counter()
+        self.duration = None
+        self.process_peak_rss_mb = None
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.start
+        # Process-wide high-water mark when the stage ended, so it never decreases along a job
+        self.process_peak_rss_mb = process_peak_rss_mb()
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "seconds": round(self.duration, 4) if self.duration is not None else None,
+            "rows": self.rows,
+            "process_peak_rss_mb": round(self.process_peak_rss_mb, 1) if self.process_peak_rss_mb is not None else None,
+            **self.attrs,
+            "children": [child.to_dict() for child in self.children],
+        }
+
+    def rows_table(self, depth=0):
+        '''
+        (indented name, seconds, rows, process peak RSS) for this span and its finished descendants
+        '''
+        if self.duration is None:
+            seconds = f"{time.perf_counter() - self.start:.2f} (running)"
+        else:
+            seconds = f"{self.duration:.2f}"
+        rows = [(f"{'  ' * depth}{self.name}", seconds, "" if self.rows is None else str(self.rows),
+                 "" if self.process_peak_rss_mb is None else f"{self.process_peak_rss_mb:.0f}")]
+        for child in self.children:
+            if child.duration is not None:
+                rows.extend(child.rows_table(depth + 1))
+        return rows
+
+
+def current_span():
+    return _current_span.get()
+
+
+def root_span():
+    '''
+    Top-level span of the job running in this context, or None
+    '''
+    span_ = _current_span.get()
+    return getattr(span_, "root", None) if span_ is not None else None
+
+
+def _write_profile(profiler, name):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, f"{name}_{time.strftime('%Y%m%d%H%M%S')}_{os.getpid()}.prof")
+    profiler.dump_stats(path)
+
+    summary = io.StringIO()
+    pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(PROFILE_TOP_N)
+    logger.info(f"[PROFILE] {name} written to {path}\n{summary.getvalue()}")
+
+
+@contextmanager
+def span(name, rows=None, **attrs):
+    '''
+    Time a stage of the pipeline; nested spans are recorded as children
+
+    A top-level span is logged as one JSON record ("[TIMING] {...}") when it ends,
+    and is profiled with cProfile when PROFILE=1.
+    '''
+    parent = _current_span.get()
+    current = Span(name, rows, **attrs)
+    current.root = parent.root if parent is not None else current
+    if parent is not None:
+        parent.children.append(current)
+
+    profiler = None
+    if parent is None and PROFILE_ENABLED:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Only one profiler can be active at a time (Python 3.12+); concurrent jobs go unprofiled
+            profiler = None
+
+    token = _current_span.set(current)
+    try:
+        yield current
+    finally:
+        current.finish()
+        _current_span.reset(token)
+
+        if parent is None:
+            if profiler is not None:
+                profiler.disable()
+                _write_profile(profiler, name)
+            logger.info(f"[TIMING] {json.dumps(current.to_dict(), default=str)}")
+
+
+def record_span(name, seconds, rows=None, **attrs):
+    '''
+    Add a stage that was timed elsewhere (e.g. by a training loop) as a finished child of the current span
+    '''
+    parent = _current_span.get()
+    recorded = Span(name, rows, **attrs)
+    recorded.finish()
+    recorded.duration = seconds
+    if parent is not None:
+        recorded.root = parent.root
+        parent.children.append(recorded)
+    else:
+        logger.info(f"[TIMING] {json.dumps(recorded.to_dict(), default=str)}")
+    return recorded
+
+
+def timed(name=None):
+    '''
+    Decorator form of span; the span is named after the function unless name is given
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name or func.__name__):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def timing_table(root=None):
+    '''
+    ReportLab table summarizing the stages of the current job that have finished so far
+
+    Returns
+    - Table, or None outside of a span
+    '''
+    root = root or root_span()
+    if root is None:
+        return None
+
+    data = [("Stage", "Seconds", "Rows", "Process peak RSS (MB)")] + root.rows_table()
+    table = Table(data, hAlign='LEFT')
+    table.setStyle(TableStyle([
+        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+        ('FONTSIZE', (0, 0), (-1, -1), 9),
+        ('BACKGROUND', (0, 0), (-1, 0), colors.lightgrey),
+        ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
+        ('ALIGN', (1, 1), (-1, -1), 'RIGHT'),
+    ]))
+    return table
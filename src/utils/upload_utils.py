@@ -0,0 +1,123 @@
+import io
+from utils.logger_utils import logger
+
+# S3 requires every part except the last to be at least 5MB
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+CSV_CHUNK_ROWS = 50000
+
+
+class S3MultipartWriter(io.RawIOBase):
+    '''
+    Write-only file object that streams into an S3 multipart upload in fixed-size parts
+
+    Only one part is held in memory at a time. Objects smaller than one part are
+    sent with a single put_object. On error the multipart upload is aborted.
+
+    Parameters
+    - s3_client: boto3 S3 client
+    - bucket_name: The name of the S3 bucket
+    - s3_key: The destination key
+    - part_size: Size of each uploaded part in bytes (minimum 5MB)
+    '''
+    def __init__(self, s3_client, bucket_name, s3_key, part_size=DEFAULT_PART_SIZE):
+        super().__init__()
+        self.s3 = s3_client
+        self.bucket_name = bucket_name
+        self.s3_key = s3_key
+        self.part_size = max(part_size, 5 * 1024 * 1024)
+        self.upload_id = None
+        self.parts = []
+        self.bytes_written = 0
+        self._buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("I/O operation on closed S3MultipartWriter")
+
+        self._buffer.extend(data)
+        self.bytes_written += len(data)
+
+        while len(self._buffer) >= self.part_size:
+            self._upload_part(bytes(self._buffer[:self.part_size]))
+            del self._buffer[:self.part_size]
+
+        return len(data)
+
+    def _upload_part(self, body):
+        if self.upload_id is None:
+            response = self.s3.create_multipart_upload(Bucket=self.bucket_name, Key=self.s3_key)
+            self.upload_id = response["UploadId"]
+
+        part_number = len(self.parts) + 1
+        response = self.s3.upload_part(Bucket=self.bucket_name, Key=self.s3_key, UploadId=self.upload_id,
+                                       PartNumber=part_number, Body=body)
+        self.parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+
+    def close(self):
+        if self.closed:
+            return
+
+        try:
+            if self.upload_id is None:
+                self.s3.put_object(Bucket=self.bucket_name, Key=self.s3_key, Body=bytes(self._buffer))
+            else:
+                if self._buffer:
+                    self._upload_part(bytes(self._buffer))
+                self.s3.complete_multipart_upload(Bucket=self.bucket_name, Key=self.s3_key, UploadId=self.upload_id,
+                                                  MultipartUpload={"Parts": self.parts})
+            logger.debug(f"Streamed {self.bytes_written} bytes to s3://{self.bucket_name}/{self.s3_key} in {max(len(self.parts), 1)} part(s)")
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self._buffer = bytearray()
+            super().close()
+
+    def abort(self):
+        if self.upload_id is not None:
+            try:
+                self.s3.abort_multipart_upload(Bucket=self.bucket_name, Key=self.s3_key, UploadId=self.upload_id)
+            except Exception as e:
+                logger.error(f"Failed to abort multipart upload for {self.s3_key}: {e}")
+            self.upload_id = None
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+            self._buffer = bytearray()
+            super().close()
+            return False
+        self.close()
+        return False
+
+
+def stream_dataframe_to_s3(df, s3_client, bucket_name, s3_key, chunk_rows=CSV_CHUNK_ROWS, part_size=DEFAULT_PART_SIZE):
+    '''
+    Write a DataFrame as CSV straight into S3, formatting chunk_rows rows at a time
+
+    Peak memory is one CSV chunk plus one upload part instead of the whole CSV text.
+    '''
+    with S3MultipartWriter(s3_client, bucket_name, s3_key, part_size=part_size) as writer:
+        for start in range(0, max(len(df), 1), chunk_rows):
+            chunk = df.iloc[start:start + chunk_rows]
+            writer.write(chunk.to_csv(index=False, header=(start == 0)).encode('utf-8'))
+
+        return writer.bytes_written
+
+
+def stream_fileobj_to_s3(file_obj, s3_client, bucket_name, s3_key, part_size=DEFAULT_PART_SIZE):
+    '''
+    Copy an existing file object (e.g. a PDF BytesIO) to S3 part by part without duplicating it
+    '''
+    file_obj.seek(0)
+    with S3MultipartWriter(s3_client, bucket_name, s3_key, part_size=part_size) as writer:
+        while True:
+            chunk = file_obj.read(part_size)
+            if not chunk:
+                break
+            writer.write(chunk)
+
+        return writer.bytes_written